@@ -12,14 +12,15 @@ from jobTree.scriptTree.stack import Stack
 from lib.psl_lib import PslRow, remove_augustus_alignment_number, remove_alignment_number
 from lib.general_lib import tokenize_stream, grouper
 from sonLib.bioio import fastaWrite, popenCatch, system, TempFileTree, catFiles
-from pyfasta import Fasta
 from lib.general_lib import format_ratio
+from lib.seq_lib import get_genome_sequence
 from lib.sql_lib import ExclusiveSqlConnection
+from lib.cache_lib import record_generation
 
 
 def align(target, target_fasta, chunk, ref_fasta, file_tree):
-    g_f = Fasta(target_fasta)
-    r_f = Fasta(ref_fasta)
+    g_f = get_genome_sequence(target_fasta)
+    r_f = get_genome_sequence(ref_fasta)
     results = []
     tmp_aug = os.path.join(target.getGlobalTempDir(), "tmp_aug")
     tmp_gencode = os.path.join(target.getGlobalTempDir(), "tmp_gencode")
@@ -28,8 +29,8 @@ def align(target, target_fasta, chunk, ref_fasta, file_tree):
         for tgt_id in chunk:
             query_id = remove_augustus_alignment_number(tgt_id)
             gencode_id = remove_alignment_number(query_id)
-            gencode_seq = str(r_f[gencode_id])
-            aug_seq = str(g_f[tgt_id])
+            gencode_seq = r_f[gencode_id][:]
+            aug_seq = g_f[tgt_id][:]
             fastaWrite(tmp_aug_h, tgt_id, aug_seq)
             fastaWrite(tmp_gencode_h, gencode_id, gencode_seq)
     system("blat {} {} -out=psl -noHead {}".format(tmp_aug, tmp_gencode, tmp_psl))
@@ -73,6 +74,7 @@ def load_db(target, genome, tmp_file, out_db):
     df = df.sort_index()
     with ExclusiveSqlConnection(out_db) as con:
         df.to_sql(genome, con, if_exists="replace", index=True)
+        record_generation(con, genome)
 
 
 def main():
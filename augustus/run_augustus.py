@@ -6,11 +6,10 @@ import os
 import argparse
 import itertools
 import sqlite3 as sql
-from pyfasta import Fasta
 from jobTree.scriptTree.target import Target
 from jobTree.scriptTree.stack import Stack
 from sonLib.bioio import system, popenCatch, getRandomAlphaNumericString, catFiles, TempFileTree
-from lib.seq_lib import GenePredTranscript
+from lib.seq_lib import GenePredTranscript, get_genome_sequence
 from lib.general_lib import mkdir_p
 
 
@@ -142,7 +141,7 @@ def transmap_2_aug(target, gp_string, genome, sizes_path, fasta_path, out_file_t
     """
     Runs Augustus on one individual genePred string. Augustus is ran with each cfg file in cfgs
     """
-    fasta = Fasta(fasta_path)
+    fasta = get_genome_sequence(fasta_path)
     chrom_sizes = {x.split()[0]: x.split()[1] for x in open(sizes_path)}
     gp = GenePredTranscript(gp_string.rstrip().split("\t"))
     # ignore genes with no coding region or longer than max_gene_size
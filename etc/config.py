@@ -65,27 +65,27 @@ clustering_classifiers = tm_excel_classifiers + ["AlnExtendsOffContig", "CodingM
 
 
 def refClassifiers(genome):
-    base_query = "SELECT {} FROM details.'{}'"
+    base_query = "SELECT TranscriptId,{} FROM details.'{}'"
     query = base_query.format(",".join(ref_classifiers), genome)
     return query
 
 
 def allClassifiers(genome):
-    base_query = "SELECT {} FROM details.'{}'"
+    base_query = "SELECT AlignmentId,{} FROM details.'{}'"
     query = base_query.format(",".join(all_classifiers), genome)
     return query
 
 
 def allAugustusClassifiers(genome):
-    base_query = "SELECT {} FROM augustus_details.'{}'"
+    base_query = "SELECT AugustusAlignmentId,{} FROM augustus_details.'{}'"
     query = base_query.format(",".join(aug_classifiers), genome)
     return query
 
 
 def potentiallyInterestingBiology(genome):
-    query = ("SELECT details.'{0}'.InFrameStop,details.'{0}'.CodingMult3Insertions,details.'{0}'."
-             "CodingMult3Deletions,details.'{0}'.Nonsynonymous,details.'{0}'.FrameShift FROM details.'{0}' "
-             "JOIN main.'{0}' USING ('AlignmentId') JOIN attributes.'{0}' USING ('AlignmentId') "
+    query = ("SELECT details.'{0}'.AlignmentId,details.'{0}'.InFrameStop,details.'{0}'.CodingMult3Insertions,"
+             "details.'{0}'.CodingMult3Deletions,details.'{0}'.Nonsynonymous,details.'{0}'.FrameShift "
+             "FROM details.'{0}' JOIN main.'{0}' USING ('AlignmentId') JOIN attributes.'{0}' USING ('AlignmentId') "
              "WHERE main.'{0}'.BadFrame = 0 AND main.'{0}'.BeginStart "
              "= 0 AND main.'{0}'.EndStop = 0 AND main.'{0}'.CdsGap = 0 AND main.'{0}'.CdsUnknownSplice = 0 "
              "AND main.'{0}'.UtrUnknownSplice = 0 AND main.'{0}'.StartOutOfFrame = 0 AND "
@@ -103,8 +103,9 @@ def assemblyErrors(genome, biotype=None, details=True):
              "WHERE main.'{0}'.AlignmentPartialMap > 0 OR main.'{0}'.UnknownBases > 0 OR main.'{0}'.UnknownGap > 0 "
              "OR main.'{0}'.ShortCds > 0 OR main.'{0}'.AlnAbutsUnknownBases > 0 OR main.'{0}'.AlnExtendsOffContig = 1")
     if details is True:
-        query = ("SELECT details.'{0}'.AlignmentPartialMap,details.'{0}'.UnknownBases,details.'{0}'.UnknownGap,details."
-                 "'{0}'.ShortCds,details.'{0}'.AlnAbutsUnknownBases,details.'{0}'.AlnExtendsOffContig ") + query
+        query = ("SELECT details.'{0}'.AlignmentId,details.'{0}'.AlignmentPartialMap,details.'{0}'.UnknownBases,"
+                 "details.'{0}'.UnknownGap,details.'{0}'.ShortCds,details.'{0}'.AlnAbutsUnknownBases,"
+                 "details.'{0}'.AlnExtendsOffContig ") + query
     else:
         query = "SELECT main.'{0}'.AlignmentId " + query
     if biotype is not None:
@@ -122,9 +123,9 @@ def alignmentErrors(genome, biotype=None, details=True):
              "(main.'{0}'.HasOriginalIntrons >= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 AND "
              "attributes.'{0}'.NumberIntrons != 0) OR main.'{0}'.StartOutOfFrame = 1")
     if details is True:
-        query = ("SELECT details.'{0}'.BadFrame,details.'{0}'.CdsGap,details.'{0}'.CdsMult3Gap,"
-                 "details.'{0}'.UtrGap,details.'{0}'.Paralogy,details.'{0}'.HasOriginalIntrons,"
-                 "details.'{0}'.StartOutOfFrame") + query
+        query = ("SELECT details.'{0}'.AlignmentId,details.'{0}'.BadFrame,details.'{0}'.CdsGap,"
+                 "details.'{0}'.CdsMult3Gap,details.'{0}'.UtrGap,details.'{0}'.Paralogy,"
+                 "details.'{0}'.HasOriginalIntrons,details.'{0}'.StartOutOfFrame") + query
     else:
         query = "SELECT main.'{0}'.AlignmentId " + query
     if biotype is not None:
@@ -135,54 +136,70 @@ def alignmentErrors(genome, biotype=None, details=True):
     return query
 
 
-def transMapEval(ref_genome, genome, biotype, passing=False):
-    if biotype == "protein_coding" and passing is False:
-        query = ("SELECT AlignmentId FROM attributes.'{2}' JOIN main.'{2}' USING (TranscriptId) JOIN "
-                 "attributes.'{0}' USING (TranscriptId) JOIN main.'{0}' USING (AlignmentId) WHERE NOT "
-                 "(main.'{2}'.BadFrame = 0 AND main.'{0}'.BadFrame > 0) AND NOT (main.'{2}'.BeginStart = 0 "
-                  "AND main.'{0}'.BeginStart > 0) AND NOT (main.'{2}'.EndStop = 0 AND main.'{0}'.EndStop > 0) "
-                  "AND NOT (main.'{2}'.CdsGap = 0 AND main.'{0}'.CdsGap > 0) AND NOT (main.'{2}'.CdsUnknownSplice"
-                  " = 0 AND main.'{0}'.CdsUnknownSplice > 0) AND NOT (main.'{2}'.UtrUnknownSplice = 0 AND "
-                  "main.'{0}'.UtrUnknownSplice > 0) AND NOT (main.'{2}'.StartOutOfFrame = 0 AND "
-                  "main.'{0}'.StartOutOfFrame > 0) AND NOT (main.'{2}'.InFrameStop = 0 AND "
-                  "main.'{0}'.InFrameStop > 0) AND NOT (main.'{2}'.ShortCds = 0 AND main.'{0}'.ShortCds > 0) AND "
-                  "main.'{0}'.CodingInsertions = 0 AND main.'{0}'.CodingDeletions = 0 AND main.'{0}'.FrameShift = 0 "
-                  "AND main.'{0}'.HasOriginalStop = 0 AND attributes.'{0}'.AlignmentCoverage = 100.0 AND "
-                  "attributes.'{0}'.PercentUnknownBases <= 1.0 AND attributes.'{0}'.PercentUnknownCodingBases <= 0.2 "
+# transMap evaluation criteria, formatted with the target genome as {0} and the reference genome as {2}
+tm_coding_excel = ("NOT (main.'{2}'.BadFrame = 0 AND main.'{0}'.BadFrame > 0) AND NOT (main.'{2}'.BeginStart = 0 "
+                   "AND main.'{0}'.BeginStart > 0) AND NOT (main.'{2}'.EndStop = 0 AND main.'{0}'.EndStop > 0) "
+                   "AND NOT (main.'{2}'.CdsGap = 0 AND main.'{0}'.CdsGap > 0) AND NOT (main.'{2}'.CdsUnknownSplice"
+                   " = 0 AND main.'{0}'.CdsUnknownSplice > 0) AND NOT (main.'{2}'.UtrUnknownSplice = 0 AND "
+                   "main.'{0}'.UtrUnknownSplice > 0) AND NOT (main.'{2}'.StartOutOfFrame = 0 AND "
+                   "main.'{0}'.StartOutOfFrame > 0) AND NOT (main.'{2}'.InFrameStop = 0 AND "
+                   "main.'{0}'.InFrameStop > 0) AND NOT (main.'{2}'.ShortCds = 0 AND main.'{0}'.ShortCds > 0) AND "
+                   "main.'{0}'.CodingInsertions = 0 AND main.'{0}'.CodingDeletions = 0 AND main.'{0}'.FrameShift = 0 "
+                   "AND main.'{0}'.HasOriginalStop = 0 AND attributes.'{0}'.AlignmentCoverage = 100.0 AND "
+                   "attributes.'{0}'.PercentUnknownBases <= 1.0 AND attributes.'{0}'.PercentUnknownCodingBases <= 0.2 "
+                   "AND (main.'{0}'.HasOriginalIntrons <= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 OR "
+                   "attributes.'{0}'.NumberIntrons = 0)")
+tm_coding_pass = ("NOT (main.'{2}'.CdsUnknownSplice = 0 AND main.'{0}'.CdsUnknownSplice > 0) AND "
+                  "main.'{0}'.FrameShift = 0 AND main.'{0}'.CodingInsertions = 0 AND main.'{0}'.CodingDeletions = 0 "
+                  "AND attributes.'{0}'.AlignmentCoverage >= 95.0 AND "
+                  "attributes.'{0}'.PercentUnknownBases <= 5.0 AND attributes.'{0}'.PercentUnknownCodingBases <= 1.0 "
                   "AND (main.'{0}'.HasOriginalIntrons <= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 OR "
-                  "attributes.'{0}'.NumberIntrons = 0) AND "
-                  "attributes.'{0}'.TranscriptType = '{1}' AND attributes.'{0}'.GeneType = '{1}'")
-    elif biotype == "protein_coding" and passing is True:
-        query = ("SELECT AlignmentId FROM attributes.'{2}' JOIN main.'{2}' USING (TranscriptId) JOIN "
-                 "attributes.'{0}' USING (TranscriptId) JOIN main.'{0}' USING (AlignmentId) WHERE NOT "
-                 "(main.'{2}'.CdsUnknownSplice = 0 AND main.'{0}'.CdsUnknownSplice > 0) AND "
-                 "main.'{0}'.FrameShift = 0 AND main.'{0}'.CodingInsertions = 0 AND main.'{0}'.CodingDeletions = 0 "
-                 "AND attributes.'{0}'.AlignmentCoverage >= 95.0 AND "
-                 "attributes.'{0}'.PercentUnknownBases <= 5.0 AND attributes.'{0}'.PercentUnknownCodingBases <= 1.0 "
-                 "AND (main.'{0}'.HasOriginalIntrons <= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 OR "
-                 "attributes.'{0}'.NumberIntrons = 0) AND "
-                 "attributes.'{0}'.TranscriptType = '{1}' AND attributes.'{0}'.GeneType = '{1}'")
-    elif passing is False:
-        query = ("SELECT AlignmentId FROM attributes.'{2}' JOIN main.'{2}' USING (TranscriptId) JOIN "
-                 "attributes.'{0}' USING (TranscriptId) JOIN main.'{0}' USING (AlignmentId) WHERE NOT "
-                 "(main.'{2}'.UtrUnknownSplice = 0 AND main.'{0}'.UtrUnknownSplice > 0) AND "
-                 "attributes.'{0}'.AlignmentCoverage = 100.0 AND attributes.'{0}'.PercentUnknownBases <= 1.0 AND "
-                 "(main.'{0}'.HasOriginalIntrons <= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 OR "
-                 "attributes.'{0}'.NumberIntrons = 0) AND "
-                 "attributes.'{0}'.TranscriptType = '{1}' AND attributes.'{0}'.GeneType = '{1}'")
+                  "attributes.'{0}'.NumberIntrons = 0)")
+tm_noncoding_excel = ("NOT (main.'{2}'.UtrUnknownSplice = 0 AND main.'{0}'.UtrUnknownSplice > 0) AND "
+                      "attributes.'{0}'.AlignmentCoverage = 100.0 AND attributes.'{0}'.PercentUnknownBases <= 1.0 AND "
+                      "(main.'{0}'.HasOriginalIntrons <= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 OR "
+                      "attributes.'{0}'.NumberIntrons = 0)")
+tm_noncoding_pass = ("NOT (main.'{2}'.UtrUnknownSplice = 0 AND main.'{0}'.UtrUnknownSplice > 0) AND "
+                     "main.'{0}'.UtrGap = 0 AND attributes.'{0}'.AlignmentCoverage >= 95.0 AND "
+                     "(main.'{0}'.HasOriginalIntrons <= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 OR "
+                     "attributes.'{0}'.NumberIntrons = 0) AND "
+                     "attributes.'{0}'.PercentUnknownBases <= 5.0")
+
+
+def transMapEval(ref_genome, genome, biotype, passing=False):
+    if biotype == "protein_coding":
+        condition = tm_coding_pass if passing is True else tm_coding_excel
     else:
-        query = ("SELECT AlignmentId FROM attributes.'{2}' JOIN main.'{2}' USING (TranscriptId) JOIN "
-                 "attributes.'{0}' USING (TranscriptId) JOIN main.'{0}' USING (AlignmentId) WHERE NOT "
-                 "(main.'{2}'.UtrUnknownSplice = 0 AND main.'{0}'.UtrUnknownSplice > 0) AND "
-                 "main.'{0}'.UtrGap = 0 AND attributes.'{0}'.AlignmentCoverage >= 95.0 AND "
-                 "(main.'{0}'.HasOriginalIntrons <= 0.5 * attributes.'{0}'.NumberIntrons - 0.5 OR "
-                 "attributes.'{0}'.NumberIntrons = 0) AND "
-                 "attributes.'{0}'.PercentUnknownBases <= 5.0 AND attributes.'{0}'.TranscriptType = '{1}' AND "
-                 "attributes.'{0}'.GeneType = '{1}'")
+        condition = tm_noncoding_pass if passing is True else tm_noncoding_excel
+    query = ("SELECT AlignmentId FROM attributes.'{2}' JOIN main.'{2}' USING (TranscriptId) JOIN "
+             "attributes.'{0}' USING (TranscriptId) JOIN main.'{0}' USING (AlignmentId) WHERE " + condition +
+             " AND attributes.'{0}'.TranscriptType = '{1}' AND attributes.'{0}'.GeneType = '{1}'")
     query = query.format(genome, biotype, ref_genome)
     return query
 
 
+def transMapEvalTable(ref_genome, genome):
+    """
+    Evaluates every alignment of genome in one pass. Each alignment is Excellent, Pass or Fail under the criteria of
+    its biotype, exactly as transMapEval would classify it. Alignments whose reference transcript is missing from the
+    reference tables are Fail.
+    """
+    query = ("SELECT attributes.'{0}'.AlignmentId,attributes.'{0}'.TranscriptId,attributes.'{0}'.TranscriptType,"
+             "attributes.'{0}'.GeneType,CASE "
+             "WHEN main.'{0}'.AlignmentId IS NULL OR attributes.'{2}'.TranscriptId IS NULL OR "
+             "main.'{2}'.TranscriptId IS NULL THEN 'Fail' "
+             "WHEN attributes.'{0}'.TranscriptType = '{1}' AND attributes.'{0}'.GeneType = '{1}' THEN "
+             "CASE WHEN " + tm_coding_excel + " THEN 'Excellent' WHEN " + tm_coding_pass + " THEN 'Pass' "
+             "ELSE 'Fail' END "
+             "ELSE CASE WHEN " + tm_noncoding_excel + " THEN 'Excellent' WHEN " + tm_noncoding_pass + " THEN 'Pass' "
+             "ELSE 'Fail' END END "
+             "FROM attributes.'{0}' LEFT JOIN main.'{0}' ON attributes.'{0}'.AlignmentId = main.'{0}'.AlignmentId "
+             "LEFT JOIN attributes.'{2}' ON attributes.'{0}'.TranscriptId = attributes.'{2}'.TranscriptId "
+             "LEFT JOIN main.'{2}' ON attributes.'{0}'.TranscriptId = main.'{2}'.TranscriptId")
+    query = query.format(genome, "protein_coding", ref_genome)
+    return query
+
+
 def refEval(genome):
     query = ("SELECT TranscriptId FROM main.'{}' WHERE BadFrame = 0 AND BeginStart = 0 AND EndStop = 0 AND CdsGap = 0 "
              "AND CdsUnknownSplice = 0 AND UtrUnknownSplice = 0 AND StartOutOfFrame = 0 AND "
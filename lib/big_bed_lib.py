@@ -0,0 +1,445 @@
+"""
+Writes sorted BED and bigBed files in process, replacing bedSort and bedToBigBed.
+
+The bigBed follows the layout written by bedToBigBed -extraIndex=name:
+- a header and zoom headers;
+- the autoSql definition of the BED fields, the total summary, and an extension header listing the extra indices;
+- a B+ tree of chromosomes;
+- zlib compressed blocks of records and an R-tree index of the blocks;
+- zoom levels summarizing coverage, each with their own R-tree;
+- a B+ tree mapping each record name to the block holding it.
+
+Records are sorted in memory, or, once more than max_records have been added, spilled to disk as sorted runs that
+are merged while the bigBed is written.
+"""
+import os
+import heapq
+import itertools
+import struct
+import tempfile
+import zlib
+import numpy as np
+from lib.general_lib import tokenize_stream
+
+__author__ = "Ian Fiddes"
+
+
+_big_bed_magic = 0x8789F2EB
+_big_bed_version = 4
+_b_plus_tree_magic = 0x78CA8C91
+_r_tree_magic = 0x2468ACE0
+_max_zoom_levels = 10
+_zoom_increment = 4
+_header_size = 64
+_zoom_header_size = 24
+_summary_size = 40
+_extension_header_size = 64
+_extra_index_size = 20
+
+_bed_fields = [("string", "chrom", "Reference sequence chromosome or scaffold"),
+               ("uint", "chromStart", "Start position in chromosome"),
+               ("uint", "chromEnd", "End position in chromosome"),
+               ("string", "name", "Name of item"),
+               ("uint", "score", "Score from 0-1000"),
+               ("char[1]", "strand", "+ or -"),
+               ("uint", "thickStart", "Start of where display should be thick (start codon)"),
+               ("uint", "thickEnd", "End of where display should be thick (stop codon)"),
+               ("uint", "reserved", "Used as itemRgb as of 2004-11-22"),
+               ("int", "blockCount", "Number of blocks"),
+               ("int[blockCount]", "blockSizes", "Comma separated list of block sizes"),
+               ("int[blockCount]", "chromStarts", "Start positions relative to chromStart")]
+
+
+def read_chrom_sizes(sizes_path):
+    """
+    Reads a chrom.sizes file into a dict of chromosome -> size.
+    """
+    return {x[0]: int(x[1]) for x in tokenize_stream(open(sizes_path))}
+
+
+def bed_auto_sql(field_count):
+    """
+    Returns the autoSql definition of a BED with field_count standard fields.
+    """
+    if not 3 <= field_count <= len(_bed_fields):
+        raise ValueError("Can only define BED records with 3 to {} fields.".format(len(_bed_fields)))
+    lines = ["table bed", '"Browser Extensible Data"', "    ("]
+    lines.extend('    {} {}; "{}"'.format(*x) for x in _bed_fields[:field_count])
+    lines.append("    )")
+    return "\n".join(lines) + "\n"
+
+
+def _field_count(rec):
+    """
+    Returns the number of fields of a (chrom, start, end, rest) record.
+    """
+    return 4 + rec[3].count("\t") if len(rec[3]) > 0 else 3
+
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def _write_b_plus_tree(outf, items, key_size, val_size, block_size=256):
+    """
+    Writes a B+ tree of (key, packed value) pairs, which must be sorted by key, at the current position of outf.
+    Nodes are laid out level by level from the root down, each padded to block_size slots.
+    """
+    item_count = len(items)
+    block_size = max(1, min(block_size, item_count))
+    outf.write(struct.pack("<IIIIQQ", _b_plus_tree_magic, block_size, key_size, val_size, item_count, 0))
+    levels = 1
+    n = item_count
+    while n > block_size:
+        n = (n + block_size - 1) // block_size
+        levels += 1
+    index_block = 4 + block_size * (key_size + 8)
+    leaf_block = 4 + block_size * (key_size + val_size)
+    offset = outf.tell()
+    for level in xrange(levels - 1, 0, -1):
+        slot_size = block_size ** level
+        node_size = slot_size * block_size
+        node_count = (item_count + node_size - 1) // node_size
+        next_child = offset + node_count * index_block
+        child_block = leaf_block if level == 1 else index_block
+        for i in xrange(0, item_count, node_size):
+            count = min(block_size, (item_count - i + slot_size - 1) // slot_size)
+            node = [struct.pack("<BBH", 0, 0, count)]
+            for j in xrange(count):
+                node.append(items[i + j * slot_size][0].ljust(key_size, "\0"))
+                node.append(struct.pack("<Q", next_child))
+                next_child += child_block
+            node.append("\0" * ((block_size - count) * (key_size + 8)))
+            outf.write("".join(node))
+        offset = outf.tell()
+    for node_items in _chunks(items, block_size) or [[]]:
+        node = [struct.pack("<BBH", 1, 0, len(node_items))]
+        for key, val in node_items:
+            node.append(key.ljust(key_size, "\0"))
+            node.append(val)
+        node.append("\0" * ((block_size - len(node_items)) * (key_size + val_size)))
+        outf.write("".join(node))
+
+
+def _write_r_tree(outf, blocks, end_file_offset, block_size=256):
+    """
+    Writes an R-tree indexing blocks, a list of (start_chrom, start_base, end_chrom, end_base, file_offset) in file
+    order, at the current position of outf. The size of each block runs up to the next block or end_file_offset.
+    """
+    offsets = [x[4] for x in blocks] + [end_file_offset]
+    leaves = [x[:4] + (offsets[i], offsets[i + 1] - offsets[i]) for i, x in enumerate(blocks)]
+    bounds = lambda entries: (min(x[:2] for x in entries) + max(x[2:4] for x in entries)) if entries else (0, 0, 0, 0)
+    levels = [_chunks(leaves, block_size) or [[]]]
+    while len(levels[-1]) > 1:
+        levels.append(_chunks([bounds(node) for node in levels[-1]], block_size))
+    levels.reverse()
+    header = bounds(leaves)
+    outf.write(struct.pack("<IIQIIIIQII", _r_tree_magic, block_size, len(blocks), header[0], header[1], header[2],
+                           header[3], end_file_offset, 1, 0))
+    index_node = 4 + block_size * 24
+    leaf_node = 4 + block_size * 32
+    level_offset = outf.tell()
+    for depth, nodes in enumerate(levels[:-1]):
+        child_offset = level_offset + len(nodes) * index_node
+        child_size = leaf_node if depth == len(levels) - 2 else index_node
+        for i, node in enumerate(nodes):
+            data = [struct.pack("<BBH", 0, 0, len(node))]
+            for j, entry in enumerate(node):
+                data.append(struct.pack("<IIIIQ", *(entry + (child_offset + (i * block_size + j) * child_size,))))
+            data.append("\0" * ((block_size - len(node)) * 24))
+            outf.write("".join(data))
+        level_offset = child_offset
+    for node in levels[-1]:
+        data = [struct.pack("<BBH", 1, 0, len(node))]
+        data.extend(struct.pack("<IIIIQQ", *x) for x in node)
+        data.append("\0" * ((block_size - len(node)) * 32))
+        outf.write("".join(data))
+
+
+def _coverage(starts, ends):
+    """
+    Returns the intervals of non-zero coverage depth of a set of intervals on one chromosome as arrays of starts,
+    ends and depths.
+    """
+    pos = np.concatenate([starts, ends])
+    order = np.argsort(pos, kind="mergesort")
+    pos = pos[order]
+    depths = np.cumsum(np.concatenate([np.ones(len(starts), dtype=np.int64),
+                                       -np.ones(len(ends), dtype=np.int64)])[order])
+    keep = (pos[1:] > pos[:-1]) & (depths[:-1] > 0)
+    return pos[:-1][keep], pos[1:][keep], depths[:-1][keep]
+
+
+def _summarize(starts, ends, depths, reduction):
+    """
+    Reduces coverage intervals into summaries of reduction bases. Returns arrays of summary starts, ends, valid
+    counts, minimum, maximum, sum and sum of squares of the coverage depth.
+    """
+    if len(starts) == 0:
+        return (starts,) * 7
+    first = starts // reduction
+    pieces = (ends - 1) // reduction - first + 1
+    seg = np.repeat(np.arange(len(starts)), pieces)
+    bins = first[seg] + np.arange(len(seg)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    piece_starts = np.maximum(starts[seg], bins * reduction)
+    piece_ends = np.minimum(ends[seg], (bins + 1) * reduction)
+    sizes = piece_ends - piece_starts
+    d = depths[seg]
+    first_pieces = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+    last_pieces = np.concatenate([first_pieces[1:], [len(bins)]]) - 1
+    return (piece_starts[first_pieces], piece_ends[last_pieces], np.add.reduceat(sizes, first_pieces),
+            np.minimum.reduceat(d, first_pieces), np.maximum.reduceat(d, first_pieces),
+            np.add.reduceat(d * sizes, first_pieces), np.add.reduceat(d * d * sizes, first_pieces))
+
+
+class BigBedWriter(object):
+    """
+    Accumulates BED records and writes them out as a bigBed, and optionally as a sorted BED, in one pass.
+
+    Records are sorted by chromosome then position. Every record must have the same number of fields, between 3 and
+    12. The names of the records are indexed as with bedToBigBed -extraIndex=name when extra_index is True.
+    """
+    def __init__(self, sizes, extra_index=True, max_records=500000, tmp_dir=None, block_size=256,
+                 items_per_slot=512):
+        self.sizes = read_chrom_sizes(sizes) if isinstance(sizes, str) else sizes
+        self.extra_index = extra_index
+        self.max_records = max_records
+        self.tmp_dir = tmp_dir
+        self.block_size = block_size
+        self.items_per_slot = items_per_slot
+        self.records = []
+        self.runs = []
+        self.chroms = set()
+        self.count = 0
+
+    def add(self, bed):
+        """
+        Adds a BED string, which may hold several newline separated records.
+        """
+        for line in bed.split("\n"):
+            if len(line) == 0 or line.isspace():
+                continue
+            fields = line.rstrip("\r").split("\t", 3)
+            if len(fields) < 3:
+                raise ValueError("BED record has fewer than 3 fields: {}".format(line))
+            chrom, start, end = fields[0], int(fields[1]), int(fields[2])
+            if chrom not in self.sizes:
+                raise ValueError("{} is not in the chromosome sizes.".format(chrom))
+            if not 0 <= start <= end <= self.sizes[chrom]:
+                raise ValueError("BED record is outside of {} or has a negative size: {}".format(chrom, line))
+            self.records.append((chrom, start, end, fields[3] if len(fields) == 4 else ""))
+            self.chroms.add(chrom)
+            self.count += 1
+            if len(self.records) >= self.max_records:
+                self._spill()
+
+    def _spill(self):
+        """
+        Writes the records held in memory to disk as a sorted run.
+        """
+        self.records.sort()
+        fd, path = tempfile.mkstemp(suffix=".bed", dir=self.tmp_dir)
+        with os.fdopen(fd, "w") as outf:
+            for rec in self.records:
+                outf.write("{}\t{}\t{}\t{}\n".format(*rec))
+        self.runs.append(path)
+        self.records = []
+
+    @staticmethod
+    def _read_run(path):
+        with open(path) as inf:
+            for line in inf:
+                chrom, start, end, rest = line[:-1].split("\t", 3)
+                yield chrom, int(start), int(end), rest
+
+    def sorted_records(self):
+        """
+        Iterates over all records added so far in sorted order as (chrom, start, end, rest) tuples, where rest holds
+        the remaining fields joined by tabs.
+        """
+        self.records.sort()
+        if len(self.runs) == 0:
+            return iter(self.records)
+        return heapq.merge(self.records, *[self._read_run(x) for x in self.runs])
+
+    def cleanup(self):
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
+        self.records = []
+
+    def write(self, big_bed_path, bed_path=None):
+        """
+        Writes the bigBed to big_bed_path. If bed_path is given, the sorted records are also written there as BED.
+        """
+        try:
+            with open(big_bed_path, "wb") as outf:
+                if bed_path is None:
+                    self._write(outf, None)
+                else:
+                    with open(bed_path, "w") as bed_outf:
+                        self._write(outf, bed_outf)
+        except Exception:
+            for path in [big_bed_path, bed_path]:
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            raise
+        finally:
+            self.cleanup()
+
+    def _write(self, outf, bed_outf):
+        records = self.sorted_records()
+        first = next(records, None)
+        field_count = 3 if first is None else _field_count(first)
+        extra_index = self.extra_index is True and field_count >= 4
+        # reserve the header, zoom headers and summary, to be filled in at the end
+        outf.write("\0" * (_header_size + _max_zoom_levels * _zoom_header_size))
+        auto_sql_offset = outf.tell()
+        outf.write(bed_auto_sql(field_count) + "\0")
+        total_summary_offset = outf.tell()
+        outf.write("\0" * _summary_size)
+        extension_offset = extra_index_list_offset = 0
+        if extra_index is True:
+            extension_offset = outf.tell()
+            outf.write("\0" * _extension_header_size)
+            extra_index_list_offset = outf.tell()
+            outf.write("\0" * _extra_index_size)
+        chroms = sorted(self.chroms)
+        chrom_ids = {chrom: i for i, chrom in enumerate(chroms)}
+        chrom_tree_offset = outf.tell()
+        chrom_key_size = max([1] + [len(x) for x in chroms])
+        _write_b_plus_tree(outf, [(x, struct.pack("<II", chrom_ids[x], self.sizes[x])) for x in chroms],
+                           chrom_key_size, 8, self.block_size)
+        data_offset = outf.tell()
+        outf.write(struct.pack("<Q", self.count))
+        blocks = []
+        names = []
+        intervals = [([], []) for _ in chroms]
+        max_block_size = 0
+        block = []
+        records = [] if first is None else itertools.chain([first], records)
+        for rec in records:
+            if len(block) > 0 and (rec[0] != block[0][0] or len(block) == self.items_per_slot):
+                max_block_size = max(max_block_size, self._write_block(outf, block, chrom_ids, blocks, names,
+                                                                       extra_index))
+                block = []
+            if _field_count(rec) != field_count:
+                raise ValueError("BED records have differing numbers of fields: {}".format(rec))
+            block.append(rec)
+            intervals[chrom_ids[rec[0]]][0].append(rec[1])
+            intervals[chrom_ids[rec[0]]][1].append(rec[2])
+            if bed_outf is not None:
+                bed_outf.write("\t".join([rec[0], str(rec[1]), str(rec[2])] + ([rec[3]] if len(rec[3]) > 0 else [])))
+                bed_outf.write("\n")
+        if len(block) > 0:
+            max_block_size = max(max_block_size, self._write_block(outf, block, chrom_ids, blocks, names,
+                                                                   extra_index))
+        index_offset = outf.tell()
+        _write_r_tree(outf, blocks, index_offset, self.block_size)
+        coverage = [_coverage(np.array(s, dtype=np.int64), np.array(e, dtype=np.int64)) for s, e in intervals]
+        zoom_headers, zoom_block_size = self._write_zoom_levels(outf, coverage, index_offset - data_offset)
+        max_block_size = max(max_block_size, zoom_block_size)
+        name_index_offset = outf.tell()
+        if extra_index is True:
+            names.sort()
+            _write_b_plus_tree(outf, [(x[0], struct.pack("<QQ", x[1], x[2])) for x in names],
+                               max([1] + [len(x[0]) for x in names]), 16, self.block_size)
+        outf.write(struct.pack("<I", _big_bed_magic))
+        # go back and fill in the reserved sections
+        outf.seek(0)
+        outf.write(struct.pack("<IHHQQQHHQQIQ", _big_bed_magic, _big_bed_version, len(zoom_headers),
+                               chrom_tree_offset, data_offset, index_offset, field_count, field_count,
+                               auto_sql_offset, total_summary_offset, max_block_size, extension_offset))
+        for zoom_header in zoom_headers:
+            outf.write(struct.pack("<IIQQ", *zoom_header))
+        outf.seek(total_summary_offset)
+        outf.write(self._total_summary(coverage))
+        if extra_index is True:
+            outf.seek(extension_offset)
+            outf.write(struct.pack("<HHQ", _extension_header_size, 1, extra_index_list_offset) + "\0" * 52)
+            # a B+ tree (type 0) over one field, the name (field 3)
+            outf.write(struct.pack("<HHQIHH", 0, 1, name_index_offset, 0, 3, 0))
+
+    @staticmethod
+    def _write_block(outf, block, chrom_ids, blocks, names, extra_index):
+        """
+        Compresses and writes one block of records from the same chromosome. Returns the uncompressed size.
+        """
+        chrom_id = chrom_ids[block[0][0]]
+        data = "".join([struct.pack("<III", chrom_id, rec[1], rec[2]) + rec[3] + "\0" for rec in block])
+        compressed = zlib.compress(data)
+        offset = outf.tell()
+        outf.write(compressed)
+        blocks.append((chrom_id, block[0][1], chrom_id, max(rec[2] for rec in block), offset))
+        if extra_index is True:
+            names.extend((rec[3].split("\t", 1)[0], offset, len(compressed)) for rec in block)
+        return len(data)
+
+    def _write_zoom_levels(self, outf, coverage, data_size):
+        """
+        Writes zoom levels summarizing the coverage depth. As with bedToBigBed, the first level uses the smallest
+        reduction, starting at 10 times the average coverage interval size, that at least halves the data size, and
+        each further level reduces 4 times more until a level no longer halves the number of summaries. Returns the
+        zoom headers and the largest uncompressed block size.
+        """
+        num_intervals = sum(len(x[0]) for x in coverage)
+        if num_intervals == 0:
+            return [], 0
+        ave_size = sum(int((x[1] - x[0]).sum()) for x in coverage) // num_intervals
+        reduction = max(10, ave_size * 10)
+        summaries = None
+        for _ in xrange(_max_zoom_levels):
+            summaries = [_summarize(starts, ends, depths, reduction) for starts, ends, depths in coverage]
+            # summaries are 32 bytes each and compress to about half that
+            if sum(len(x[0]) for x in summaries) * 16 <= data_size // 2:
+                break
+            reduction *= _zoom_increment
+        else:
+            return [], 0
+        headers = []
+        max_block_size = 0
+        last_count = None
+        while len(headers) < _max_zoom_levels and reduction < 2 ** 31:
+            count = sum(len(x[0]) for x in summaries)
+            if last_count is not None and count * 2 > last_count:
+                break
+            zoom_data_offset = outf.tell()
+            outf.write(struct.pack("<I", count))
+            blocks = []
+            for chrom_id, summary in enumerate(summaries):
+                records = zip(*[x.tolist() for x in summary])
+                for block in _chunks(records, self.items_per_slot):
+                    data = "".join([struct.pack("<IIIIffff", chrom_id, *rec) for rec in block])
+                    max_block_size = max(max_block_size, len(data))
+                    blocks.append((chrom_id, block[0][0], chrom_id, max(rec[1] for rec in block), outf.tell()))
+                    outf.write(zlib.compress(data))
+            zoom_index_offset = outf.tell()
+            _write_r_tree(outf, blocks, zoom_index_offset, self.block_size)
+            headers.append((reduction, 0, zoom_data_offset, zoom_index_offset))
+            last_count = count
+            reduction *= _zoom_increment
+            summaries = [_summarize(starts, ends, depths, reduction) for starts, ends, depths in coverage]
+        return headers, max_block_size
+
+    @staticmethod
+    def _total_summary(coverage):
+        """
+        Packs the summary of the coverage depth over the whole genome.
+        """
+        sizes = np.concatenate([np.zeros(0, dtype=np.int64)] + [x[1] - x[0] for x in coverage])
+        depths = np.concatenate([np.zeros(0, dtype=np.int64)] + [x[2] for x in coverage])
+        if len(depths) == 0:
+            return struct.pack("<Qdddd", 0, 0, 0, 0, 0)
+        return struct.pack("<Qdddd", int(sizes.sum()), float(depths.min()), float(depths.max()),
+                           float((depths * sizes).sum()), float((depths * depths * sizes).sum()))
+
+
+def write_big_bed(bed_recs, sizes, big_bed_path, bed_path=None, tmp_dir=None):
+    """
+    Convenience function that writes an iterable of BED strings to a bigBed indexed on name, and optionally to a
+    sorted BED.
+    """
+    writer = BigBedWriter(sizes, tmp_dir=tmp_dir)
+    for rec in bed_recs:
+        writer.add(rec)
+    writer.write(big_bed_path, bed_path)
@@ -0,0 +1,361 @@
+"""
+Tests the in process bigBed writer by reading the files it writes back with a small bigBed reader. If the Kent
+bigBedToBed tool is installed the files are also read back with it. Run from the root of the repository with
+python -m lib.big_bed_lib_tests
+"""
+import os
+import random
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+import zlib
+from collections import Counter
+from distutils.spawn import find_executable
+import numpy as np
+
+from lib.big_bed_lib import BigBedWriter, write_big_bed
+
+__author__ = "Ian Fiddes"
+
+
+class BigBedReader(object):
+    """
+    Reads the parts of a bigBed that BigBedWriter writes: the header, chromosome tree, data R-tree, zoom levels and
+    the name index.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as inf:
+            self.data = inf.read()
+        (self.magic, self.version, self.zoom_count, chrom_tree_offset, data_offset, self.index_offset,
+         self.field_count, self.defined_field_count, auto_sql_offset, self.total_summary_offset,
+         self.uncompress_buf_size, self.extension_offset) = struct.unpack_from("<IHHQQQHHQQIQ", self.data, 0)
+        self.zoom_headers = [struct.unpack_from("<IIQQ", self.data, 64 + 24 * i) for i in xrange(self.zoom_count)]
+        self.auto_sql = self.data[auto_sql_offset:self.data.index("\0", auto_sql_offset)]
+        self.record_count = struct.unpack_from("<Q", self.data, data_offset)[0]
+        self.chroms = {}
+        for key, val in self.b_plus_tree_items(chrom_tree_offset):
+            chrom_id, size = struct.unpack("<II", val)
+            self.chroms[key] = (chrom_id, size)
+        self.chrom_names = {chrom_id: name for name, (chrom_id, size) in self.chroms.iteritems()}
+
+    def b_plus_tree_header(self, offset):
+        magic, block_size, key_size, val_size, item_count, _ = struct.unpack_from("<IIIIQQ", self.data, offset)
+        assert magic == 0x78CA8C91
+        return key_size, val_size, item_count
+
+    def b_plus_tree_items(self, offset):
+        """
+        Returns every (key, packed value) of a B+ tree in order, walking every node.
+        """
+        key_size, val_size, item_count = self.b_plus_tree_header(offset)
+        items = list(self._b_plus_node_items(offset + 32, key_size, val_size))
+        assert len(items) == item_count
+        return items
+
+    def _b_plus_node_items(self, node, key_size, val_size):
+        is_leaf, _, count = struct.unpack_from("<BBH", self.data, node)
+        pos = node + 4
+        for _ in xrange(count):
+            key = self.data[pos:pos + key_size].rstrip("\0")
+            if is_leaf == 1:
+                yield key, self.data[pos + key_size:pos + key_size + val_size]
+                pos += key_size + val_size
+            else:
+                for item in self._b_plus_node_items(struct.unpack_from("<Q", self.data, pos + key_size)[0], key_size,
+                                                    val_size):
+                    yield item
+                pos += key_size + 8
+
+    def b_plus_tree_find(self, offset, key):
+        """
+        Returns the values of every leaf item with this key, descending only into the nodes that can hold it.
+        """
+        key_size, val_size, _ = self.b_plus_tree_header(offset)
+        return list(self._b_plus_find(offset + 32, key.ljust(key_size, "\0"), key_size, val_size))
+
+    def _b_plus_find(self, node, key, key_size, val_size):
+        is_leaf, _, count = struct.unpack_from("<BBH", self.data, node)
+        pos = node + 4
+        if is_leaf == 1:
+            for _ in xrange(count):
+                if self.data[pos:pos + key_size] == key:
+                    yield self.data[pos + key_size:pos + key_size + val_size]
+                pos += key_size + val_size
+            return
+        entries = []
+        for _ in xrange(count):
+            entries.append((self.data[pos:pos + key_size], struct.unpack_from("<Q", self.data, pos + key_size)[0]))
+            pos += key_size + 8
+        for i, (first_key, child) in enumerate(entries):
+            if first_key <= key and (i + 1 == len(entries) or key <= entries[i + 1][0]):
+                for val in self._b_plus_find(child, key, key_size, val_size):
+                    yield val
+
+    def r_tree_blocks(self, offset, chrom_id=None, start=None, end=None):
+        """
+        Returns the (offset, size) of every block in an R-tree, or of the blocks overlapping a region.
+        """
+        magic, block_size, item_count = struct.unpack_from("<IIQ", self.data, offset)
+        assert magic == 0x2468ACE0
+        blocks = list(self._r_tree_node(offset + 48, chrom_id, start, end))
+        if chrom_id is None:
+            assert len(blocks) == item_count
+        return blocks
+
+    def _r_tree_node(self, node, chrom_id, start, end):
+        is_leaf, _, count = struct.unpack_from("<BBH", self.data, node)
+        pos = node + 4
+        for _ in xrange(count):
+            start_chrom, start_base, end_chrom, end_base = struct.unpack_from("<IIII", self.data, pos)
+            overlaps = chrom_id is None or (start_chrom, start_base) < (chrom_id, end) and \
+                (end_chrom, end_base) > (chrom_id, start)
+            if is_leaf == 1:
+                if overlaps:
+                    yield struct.unpack_from("<QQ", self.data, pos + 16)
+                pos += 32
+            else:
+                if overlaps:
+                    for block in self._r_tree_node(struct.unpack_from("<Q", self.data, pos + 16)[0], chrom_id,
+                                                   start, end):
+                        yield block
+                pos += 24
+
+    def block_records(self, offset, size):
+        """
+        Yields the (chrom, start, end, rest) records of one data block.
+        """
+        raw = zlib.decompress(self.data[offset:offset + size])
+        assert len(raw) <= self.uncompress_buf_size
+        pos = 0
+        while pos < len(raw):
+            chrom_id, start, end = struct.unpack_from("<III", raw, pos)
+            stop = raw.index("\0", pos + 12)
+            yield self.chrom_names[chrom_id], start, end, raw[pos + 12:stop]
+            pos = stop + 1
+
+    def records(self):
+        return [rec for offset, size in self.r_tree_blocks(self.index_offset)
+                for rec in self.block_records(offset, size)]
+
+    def query(self, chrom, start, end):
+        """
+        Returns the records overlapping a region, found through the R-tree.
+        """
+        chrom_id = self.chroms[chrom][0]
+        return [rec for offset, size in self.r_tree_blocks(self.index_offset, chrom_id, start, end)
+                for rec in self.block_records(offset, size) if rec[0] == chrom and rec[1] < end and rec[2] > start]
+
+    def name_index_offset(self):
+        """
+        Returns the offset of the name B+ tree listed in the extension header, or None if there is no extra index.
+        """
+        if self.extension_offset == 0:
+            return None
+        size, count, list_offset = struct.unpack_from("<HHQ", self.data, self.extension_offset)
+        assert size == 64 and count == 1
+        index_type, field_count, offset, _, field_id, _ = struct.unpack_from("<HHQIHH", self.data, list_offset)
+        assert (index_type, field_count, field_id) == (0, 1, 3)
+        return offset
+
+    def find_name(self, name):
+        """
+        Returns the records named name, found through the name index.
+        """
+        blocks = {struct.unpack("<QQ", x) for x in self.b_plus_tree_find(self.name_index_offset(), name)}
+        return [rec for offset, size in sorted(blocks) for rec in self.block_records(offset, size)
+                if rec[3].split("\t", 1)[0] == name]
+
+    def zoom_records(self, level):
+        """
+        Returns the (chrom, start, end, valid count, min, max, sum, sum of squares) summaries of a zoom level.
+        """
+        reduction, _, data_offset, index_offset = self.zoom_headers[level]
+        assert struct.unpack_from("<I", self.data, data_offset)[0] == \
+            sum(len(zlib.decompress(self.data[o:o + s])) // 32 for o, s in self.r_tree_blocks(index_offset))
+        r = []
+        for offset, size in self.r_tree_blocks(index_offset):
+            raw = zlib.decompress(self.data[offset:offset + size])
+            for pos in xrange(0, len(raw), 32):
+                rec = struct.unpack_from("<IIIIffff", raw, pos)
+                r.append((self.chrom_names[rec[0]],) + rec[1:])
+        return r
+
+
+def random_bed(rand, sizes, count):
+    """
+    Random BED6 records over the chromosomes in sizes. Records overlap, some are nested and names repeat, within and
+    across chromosomes.
+    """
+    chroms = sorted(sizes)
+    recs = []
+    for i in xrange(count):
+        chrom = rand.choice(chroms)
+        start = rand.randint(0, sizes[chrom] - 1)
+        end = min(sizes[chrom], start + rand.choice([1, rand.randint(1, 300), rand.randint(1, 5000)]))
+        name = "tx{}".format(rand.randint(0, count // 3))
+        recs.append("\t".join(map(str, [chrom, start, end, name, rand.randint(0, 1000), rand.choice("+-")])))
+    return recs
+
+
+def split_bed(rec):
+    chrom, start, end, rest = rec.split("\t", 3)
+    return chrom, int(start), int(end), rest
+
+
+def coverage_summaries(recs, sizes, reduction):
+    """
+    Brute force zoom summaries: the per base coverage depth of every chromosome binned by reduction.
+    """
+    r = []
+    for chrom in sorted({x[0] for x in recs}):
+        depth = np.zeros(sizes[chrom], dtype=np.int64)
+        for rec in recs:
+            if rec[0] == chrom:
+                depth[rec[1]:rec[2]] += 1
+        for start in xrange(0, sizes[chrom], reduction):
+            d = depth[start:start + reduction]
+            covered = np.flatnonzero(d)
+            if len(covered) > 0:
+                values = d[covered]
+                r.append((chrom, start + int(covered[0]), start + int(covered[-1]) + 1, len(values), values.min(),
+                          values.max(), values.sum(), (values * values).sum()))
+    return r
+
+
+class BigBedWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sizes = {"chr1": 200000, "chr2": 120000, "chr10": 50000, "chrUn": 1000}
+        self.sizes_path = os.path.join(self.tmp_dir, "chrom.sizes")
+        with open(self.sizes_path, "w") as outf:
+            for chrom, size in self.sizes.iteritems():
+                outf.write("{}\t{}\n".format(chrom, size))
+        rand = random.Random(1)
+        # chrUn is in the sizes but has no records
+        self.bed = random_bed(rand, {k: v for k, v in self.sizes.iteritems() if k != "chrUn"}, 2000)
+        self.expected = sorted(split_bed(x) for x in self.bed)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def write(self, recs=None, **kwargs):
+        """
+        Writes records with small tree nodes and blocks, and spilling to disk, so that every tree has several levels
+        and the sorted runs are merged.
+        """
+        options = {"block_size": 4, "items_per_slot": 16, "max_records": 300, "tmp_dir": self.tmp_dir}
+        options.update(kwargs)
+        writer = BigBedWriter(self.sizes_path, **options)
+        for rec in self.bed if recs is None else recs:
+            writer.add(rec)
+        writer.write(self.path("out.bb"), self.path("out.bed"))
+        return BigBedReader(self.path("out.bb"))
+
+    def test_records(self):
+        reader = self.write()
+        self.assertEqual(reader.magic, 0x8789F2EB)
+        self.assertEqual(reader.field_count, 6)
+        self.assertEqual(reader.record_count, len(self.bed))
+        self.assertEqual(reader.records(), self.expected)
+        with open(self.path("out.bed")) as inf:
+            self.assertEqual([split_bed(x.rstrip("\n")) for x in inf], self.expected)
+        # the spilled runs are removed
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ["chrom.sizes", "out.bb", "out.bed"])
+
+    def test_chromosomes(self):
+        reader = self.write()
+        self.assertEqual(sorted(reader.chroms), ["chr1", "chr10", "chr2"])
+        self.assertEqual({k: v[1] for k, v in reader.chroms.iteritems()},
+                         {k: v for k, v in self.sizes.iteritems() if k != "chrUn"})
+        self.assertEqual(sorted(x[0] for x in reader.chroms.itervalues()), [0, 1, 2])
+
+    def test_region_queries(self):
+        reader = self.write()
+        rand = random.Random(2)
+        for _ in xrange(100):
+            chrom = rand.choice(["chr1", "chr2", "chr10"])
+            start = rand.randint(0, self.sizes[chrom] - 1)
+            end = start + rand.randint(1, 20000)
+            self.assertEqual(reader.query(chrom, start, end),
+                             [x for x in self.expected if x[0] == chrom and x[1] < end and x[2] > start])
+
+    def test_name_index(self):
+        reader = self.write()
+        names = Counter(x[3].split("\t")[0] for x in self.expected)
+        self.assertTrue(max(names.itervalues()) > 1)
+        for name, count in names.iteritems():
+            found = reader.find_name(name)
+            self.assertEqual(len(found), count, name)
+            self.assertEqual(sorted(found), [x for x in self.expected if x[3].split("\t")[0] == name])
+        self.assertEqual(reader.find_name("not_a_name"), [])
+
+    def test_zoom_levels(self):
+        """
+        Each zoom level must hold the binned coverage depth, at reductions growing 4 fold, and stop once a level no
+        longer halves the number of summaries.
+        """
+        reader = self.write()
+        self.assertEqual(reader.zoom_count, 5)
+        reductions = [x[0] for x in reader.zoom_headers]
+        self.assertEqual(reductions, [reductions[0] * 4 ** i for i in xrange(len(reductions))])
+        counts = []
+        for level, reduction in enumerate(reductions):
+            expected = coverage_summaries(self.expected, self.sizes, reduction)
+            zoom = reader.zoom_records(level)
+            self.assertEqual([x[:6] for x in zoom], [x[:6] for x in expected])
+            for (got_sum, got_squares), (exp_sum, exp_squares) in zip([x[6:] for x in zoom], [x[6:] for x in expected]):
+                self.assertAlmostEqual(got_sum / exp_sum, 1, places=5)
+                self.assertAlmostEqual(got_squares / exp_squares, 1, places=5)
+            counts.append(len(zoom))
+        self.assertTrue(all(x * 2 <= y for x, y in zip(counts[1:], counts)))
+        next_count = len(coverage_summaries(self.expected, self.sizes, reductions[-1] * 4))
+        self.assertTrue(next_count * 2 > counts[-1])
+
+    def test_bed3(self):
+        """
+        Records without a name get no extra index.
+        """
+        reader = self.write(["\t".join(x.split("\t")[:3]) for x in self.bed])
+        self.assertEqual(reader.field_count, 3)
+        self.assertIsNone(reader.name_index_offset())
+        self.assertEqual(reader.records(), sorted((x[0], x[1], x[2], "") for x in self.expected))
+
+    def test_no_records(self):
+        reader = self.write([])
+        self.assertEqual(reader.record_count, 0)
+        self.assertEqual(reader.records(), [])
+        self.assertEqual(reader.zoom_count, 0)
+
+    def test_invalid_records(self):
+        for rec in ["chrNope\t0\t10\tx", "chr1\t10\t5\tx", "chr1\t0\t200001\tx", "chr1\t0"]:
+            writer = BigBedWriter(self.sizes)
+            self.assertRaises(ValueError, writer.add, rec)
+        writer = BigBedWriter(self.sizes)
+        writer.add("chr1\t0\t10\tx\n")
+        writer.add("chr1\t20\t30\n")
+        self.assertRaises(ValueError, writer.write, self.path("bad.bb"), self.path("bad.bed"))
+        self.assertFalse(os.path.exists(self.path("bad.bb")))
+        self.assertFalse(os.path.exists(self.path("bad.bed")))
+
+    def test_default_options(self):
+        """
+        write_big_bed, with the default tree and block sizes, writes the same records.
+        """
+        write_big_bed(["\n".join(self.bed[:1000]), "\n".join(self.bed[1000:])], self.sizes, self.path("out.bb"))
+        self.assertEqual(BigBedReader(self.path("out.bb")).records(), self.expected)
+
+    @unittest.skipIf(find_executable("bigBedToBed") is None, "bigBedToBed is not installed")
+    def test_kent_big_bed_to_bed(self):
+        self.write()
+        subprocess.check_call(["bigBedToBed", self.path("out.bb"), self.path("kent.bed")])
+        with open(self.path("kent.bed")) as inf:
+            self.assertEqual([split_bed(x.rstrip("\n")) for x in inf], self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
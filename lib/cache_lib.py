@@ -0,0 +1,171 @@
+"""
+Persistent cache of query results for the comparativeAnnotator databases.
+
+Many scripts build the same maps (transcript to gene, biotypes, alignment stats) from databases that do not change
+once they are built. cached_result stores the result of such a computation in a cache directory next to the main
+database of a connection. Entries are keyed by the normalized query and the generation of each table the query reads.
+Every writer of a table records a new random generation for it in the generation_table of its database, in the same
+transaction as the rows, so an entry is invalidated exactly when one of its tables is rewritten. Writing other tables
+of a shared database does not touch it. Values are pickled and zlib compressed. The cache is bounded in size and
+evicts the least recently used entries.
+
+Anything that goes wrong with the cache itself, or a table without a recorded generation, only means the result is
+computed again.
+"""
+import os
+import re
+import zlib
+import hashlib
+import uuid
+import tempfile
+import sqlite3 as sql
+import cPickle as pickle
+
+__author__ = "Ian Fiddes"
+
+# the cache can be turned off or resized by changing these
+enabled = True
+max_bytes = 2 * 1024 ** 3
+cache_dir_name = "query_cache"
+generation_table = "table_generations"
+
+quoted = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_query(query):
+    """
+    Collapses runs of whitespace and strips the query, leaving quoted strings and identifiers untouched.
+    """
+    parts = quoted.split(query)
+    for i in xrange(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i])
+    return "".join(parts).strip()
+
+
+def record_generation(con, table):
+    """
+    Records a new generation for table in the database of con. Call this in the transaction that writes the table.
+    """
+    con.execute('CREATE TABLE IF NOT EXISTS "{}" (name TEXT PRIMARY KEY, generation TEXT)'.format(generation_table))
+    con.execute('INSERT OR REPLACE INTO "{}" VALUES (?, ?)'.format(generation_table), [table, uuid.uuid4().hex])
+
+
+def table_generations(cur, tables):
+    """
+    Returns a tuple of (database, table, generation) for every (database, table) pair in tables, or None if any of
+    them has no recorded generation, such as a table written before generations were recorded.
+    """
+    generations = []
+    for db, table in sorted(tables):
+        query = 'SELECT generation FROM {}."{}" WHERE name = ?'.format(db, generation_table)
+        try:
+            row = cur.execute(query, [table]).fetchone()
+        except sql.OperationalError:  # no generation table
+            return None
+        if row is None:
+            return None
+        generations.append((db, table, row[0]))
+    return tuple(generations)
+
+
+def cache_dir(cur):
+    """
+    The cache directory for a cursor lives next to its main database. Returns None if the main database is not a
+    file, such as an in-memory database.
+    """
+    main_path = [path for _, name, path in cur.execute("PRAGMA database_list").fetchall() if name == "main"][0]
+    if not main_path:
+        return None
+    return os.path.join(os.path.dirname(os.path.realpath(main_path)), cache_dir_name)
+
+
+def _entry_path(cur, tables, key):
+    base_dir = cache_dir(cur)
+    generations = table_generations(cur, tables)
+    if base_dir is None or generations is None:
+        return None
+    digest = hashlib.sha1(repr((generations, key))).hexdigest()
+    return os.path.join(base_dir, digest)
+
+
+def _load(path):
+    with open(path, "rb") as inf:
+        value = pickle.loads(zlib.decompress(inf.read()))
+    os.utime(path, None)  # mark as recently used
+    return value
+
+
+def _store(path, value):
+    """
+    Writes an entry atomically so that concurrent jobs never see a partial entry, then evicts old entries.
+    """
+    base_dir = os.path.dirname(path)
+    if not os.path.exists(base_dir):
+        os.makedirs(base_dir)
+    data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), 1)
+    fd, tmp_path = tempfile.mkstemp(dir=base_dir, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as outf:
+            outf.write(data)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    evict(base_dir)
+
+
+def evict(base_dir, limit=None):
+    """
+    Removes the least recently used entries in base_dir until the cache is no larger than limit bytes.
+    """
+    limit = max_bytes if limit is None else limit
+    entries = []
+    for name in os.listdir(base_dir):
+        if name.startswith(".tmp"):
+            continue
+        try:
+            stat = os.stat(os.path.join(base_dir, name))
+        except OSError:  # removed by another job
+            continue
+        entries.append([stat.st_mtime, stat.st_size, name])
+    total = sum(x[1] for x in entries)
+    for _, size, name in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(os.path.join(base_dir, name))
+        except OSError:
+            pass
+        total -= size
+
+
+def cached_result(cur, tables, key, fn, *args, **kwargs):
+    """
+    Returns fn(*args, **kwargs), loading it from the cache if it was computed before for the same key against the
+    same generation of the tables it reads. tables is a list of (database, table) pairs naming every table fn reads.
+    key is a query string, which is normalized, or a tuple of query strings and other values. The name of fn is part
+    of the key, so the same query can be cached for different result types.
+    """
+    if not enabled:
+        return fn(*args, **kwargs)
+    if isinstance(key, basestring):
+        key = normalize_query(key)
+    else:
+        key = tuple(normalize_query(x) if isinstance(x, basestring) else x for x in key)
+    key = (fn.__name__, key)
+    try:
+        path = _entry_path(cur, tables, key)
+    except (OSError, IOError, sql.Error):
+        path = None
+    if path is None:
+        return fn(*args, **kwargs)
+    try:
+        return _load(path)
+    except (OSError, IOError, EOFError, zlib.error, pickle.UnpicklingError):
+        pass
+    value = fn(*args, **kwargs)
+    try:
+        _store(path, value)
+    except (OSError, IOError):
+        pass
+    return value
@@ -1,6 +1,8 @@
 """
 This file contains helper functions for comparativeAnnotator.
 """
+from itertools import izip
+import numpy as np
 import lib.seq_lib as seq_lib
 
 
@@ -17,6 +19,13 @@ def short_cds(t):
     return True if t.cds_size <= short_cds_size else False
 
 
+def short_cds_mask(table):
+    """
+    Vectorized short_cds over every row of a seq_lib.TranscriptTable.
+    """
+    return table.cds_sizes() <= short_cds_size
+
+
 def short_intron(intron):
     """
     Many classifiers rely on analyzing introns either above or below a cutoff size
@@ -33,9 +42,10 @@ def is_not_cds(intron, t):
 
 
 def analyze_intron_gap(t, intron, seq_dict, cds_fn, skip_n, mult3):
-    if skip_n is True and "N" in intron.get_sequence(seq_dict):
+    contains_n = seq_lib.get_n_gap_index(seq_dict).contains_n(intron.chromosome, intron.start, intron.stop)
+    if skip_n is True and contains_n:
         return False
-    elif skip_n is False and "N" not in intron.get_sequence(seq_dict):
+    elif skip_n is False and not contains_n:
         return False
     elif cds_fn(intron, t) is True:
         return False
@@ -49,11 +59,14 @@ def analyze_intron_gap(t, intron, seq_dict, cds_fn, skip_n, mult3):
         return False
 
 
-def analyze_splice(intron, t, seq_dict, cds_fn, splice_sites):
+def analyze_splice(intron, t, seq_dict, cds_fn, splice_sites, donor_acceptor=None):
+    """
+    donor_acceptor can be passed in if the splice sites of this intron have already been fetched with
+    Transcript.get_splice_sites.
+    """
     if short_intron(intron) is True:
         return False
-    seq = intron.get_sequence(seq_dict, strand=True)
-    donor, acceptor = seq[:2], seq[-2:]
+    donor, acceptor = donor_acceptor if donor_acceptor is not None else intron.get_splice_sites(seq_dict)
     if cds_fn(intron, t) is True:
         return False
     elif "N" in donor or "N" in acceptor:
@@ -62,6 +75,37 @@ def analyze_splice(intron, t, seq_dict, cds_fn, splice_sites):
         return True
 
 
+def query_block_boundaries(aln, size):
+    """
+    Returns, in order, the query transcript positions in [1, size) that are the first position of an alignment block,
+    walking 5'->3' on the query. Every other position is in the same block as the position before it. If the blocks
+    of this alignment are not ordered, every position is returned.
+    """
+    if aln.blocks_ordered()[1] is False:
+        return xrange(1, size)
+    elif aln.strand == "-":
+        positions = [aln.q_size - q - b for q, b in izip(aln.q_starts, aln.block_sizes)]
+    else:
+        positions = aln.q_starts
+    return sorted({x for x in positions if 1 <= x < size})
+
+
+def target_block_boundaries(t, aln):
+    """
+    Returns, in order, the target transcript positions in [1, len(t)) that start an exon or enter a new alignment block.
+    Every other position is in the same exon and block as the position before it. If the blocks of this alignment are
+    not ordered, every position is returned.
+    """
+    if aln.blocks_ordered()[0] is False:
+        return xrange(1, len(t))
+    elif t.strand is True:
+        chrom_positions = aln.t_starts
+    else:
+        chrom_positions = [x + b - 1 for x, b in izip(aln.t_starts, aln.block_sizes)]
+    positions = {t.chromosome_coordinate_to_transcript(x) for x in chrom_positions} | {x.start for x in t.exons}
+    return sorted({x for x in positions if x is not None and 1 <= x < len(t)})
+
+
 def insertion_iterator(a, aln, mult3=None):
     """
     Target insertion:
@@ -71,20 +115,21 @@ def insertion_iterator(a, aln, mult3=None):
     Analyze a given annotation transcript and alignment for target insertions.
 
     mult3 controls whether only multiple of 3 or only not multiple of 3 are reported. Set to None to report all.
+
+    An insertion can only be found between two query positions that are in different alignment blocks, so only the
+    first query position of each block is examined.
     """
-    prev_target_i = None
-    exon_starts = [x.start for x in a.exons]
-    for query_i in xrange(len(a)):
-        if query_i in exon_starts:
+    exon_starts = {x.start for x in a.exons}
+    for query_i in query_block_boundaries(aln, len(a)):
+        if query_i in exon_starts or query_i - 1 in exon_starts:
             # don't call a intron an insertion
-            prev_target_i = None
             continue
         target_i = aln.query_coordinate_to_target(query_i)
-        if target_i is None:
+        prev_target_i = aln.query_coordinate_to_target(query_i - 1)
+        if target_i is None or prev_target_i is None:
             # deletion; ignore
-            prev_target_i = target_i
             continue
-        if prev_target_i is not None and abs(target_i - prev_target_i) != 1:
+        if abs(target_i - prev_target_i) != 1:
             # jumped over a insertion
             insert_size = abs(target_i - prev_target_i) - 1
             start = min(prev_target_i, target_i) + 1
@@ -95,7 +140,6 @@ def insertion_iterator(a, aln, mult3=None):
                 yield start, stop, insert_size
             elif mult3 is None:
                 yield start, stop, insert_size
-        prev_target_i = target_i
 
 
 def deletion_iterator(t, aln, mult3=None):
@@ -107,16 +151,18 @@ def deletion_iterator(t, aln, mult3=None):
     Analyze a given transcript and alignment for target deletions.
 
     mult3 controls whether only multiple of 3 or only not multiple of 3 are reported. Set to None to report all.
+
+    A deletion can only be found between two target transcript positions that are in different exons or alignment
+    blocks, so only those positions are examined.
     """
-    prev_query_i = None
-    for target_i in xrange(len(t)):
+    for target_i in target_block_boundaries(t, aln):
         target_chrom_i = t.transcript_coordinate_to_chromosome(target_i)
         query_i = aln.target_coordinate_to_query(target_chrom_i)
-        if query_i is None:
+        prev_query_i = aln.target_coordinate_to_query(t.transcript_coordinate_to_chromosome(target_i - 1))
+        if query_i is None or prev_query_i is None:
             # insertion; ignore
-            prev_query_i = query_i
             continue
-        if prev_query_i is not None and abs(query_i - prev_query_i) != 1:
+        if abs(query_i - prev_query_i) != 1:
             # jumped over a deletion
             delete_size = abs(query_i - prev_query_i) - 1
             if t.strand is True:
@@ -129,7 +175,6 @@ def deletion_iterator(t, aln, mult3=None):
                 yield start, stop, -delete_size
             elif mult3 is None:
                 yield start, stop, -delete_size
-        prev_query_i = query_i
 
 
 def start_out_of_frame(t):
@@ -177,18 +222,21 @@ def codon_pair_iterator(a, t, aln, target_seq_dict, query_seq_dict):
     pyfaidx Fasta objects that contain the genomic sequence for these two transcripts
 
     Order is (target_cds_pos, target, query)
+
+    The query CDS positions are mapped to target CDS positions all at once with the batch coordinate conversions,
+    which give -1 for positions that do not map.
     """
     target_cds = t.get_cds(target_seq_dict).upper()
     query_cds = a.get_cds(query_seq_dict).upper()
     a_frames = [x for x in a.exon_frames if x != -1]
     a_offset = seq_lib.find_offset(a_frames, a.strand)
-    for i in xrange(a_offset, a.cds_size - a.cds_size % 3, 3):
-        target_cds_positions = [t.chromosome_coordinate_to_cds(
-                                aln.query_coordinate_to_target(
-                                a.cds_coordinate_to_transcript(j)))
-                                for j in xrange(i, i + 3)]
-        if None in target_cds_positions:
-            continue
+    codon_starts = np.arange(a_offset, a.cds_size - a.cds_size % 3, 3)
+    query_cds_positions = (codon_starts[:, np.newaxis] + np.arange(3)).ravel()
+    mapped = t.chromosome_coordinates_to_cds(aln.query_coordinates_to_target(
+             a.cds_coordinates_to_transcript(query_cds_positions)))
+    codons = mapped.reshape(-1, 3)
+    aligned = (codons != -1).all(axis=1)
+    for i, target_cds_positions in izip(codon_starts[aligned].tolist(), codons[aligned].tolist()):
         # sanity check - should probably remove. But should probably write tests too...
         assert all([target_cds_positions[2] - target_cds_positions[1] == 1, target_cds_positions[1] -
                     target_cds_positions[0] == 1, target_cds_positions[2] - target_cds_positions[0] == 2])
@@ -0,0 +1,477 @@
+"""
+Tests that the bisecting and batch coordinate conversions give the same results as the per-position linear scans they
+replaced. Run from the root of the repository with python -m lib.coordinate_tests
+"""
+import random
+import unittest
+
+import lib.comp_ann_lib as comp_ann_lib
+from lib.seq_lib import Transcript, GenePredTranscript, find_offset
+from lib.psl_lib import PslRow
+
+__author__ = "Ian Fiddes"
+
+
+# Transcript method -> the Exon method the original implementation asked every exon in turn
+SCALAR_METHODS = {"transcript_coordinate_to_cds": "transcript_pos_to_cds_pos",
+                  "transcript_coordinate_to_chromosome": "transcript_pos_to_chrom_pos",
+                  "chromosome_coordinate_to_transcript": "chrom_pos_to_transcript_pos",
+                  "chromosome_coordinate_to_cds": "chrom_pos_to_cds_pos",
+                  "cds_coordinate_to_transcript": "cds_pos_to_transcript_pos",
+                  "cds_coordinate_to_chromosome": "cds_pos_to_chrom_pos"}
+
+# batch method -> (scalar method, coordinate space of its input)
+BATCH_METHODS = {"transcript_coordinates_to_cds": ("transcript_coordinate_to_cds", "transcript"),
+                 "transcript_coordinates_to_chromosome": ("transcript_coordinate_to_chromosome", "transcript"),
+                 "chromosome_coordinates_to_transcript": ("chromosome_coordinate_to_transcript", "chromosome"),
+                 "chromosome_coordinates_to_cds": ("chromosome_coordinate_to_cds", "chromosome"),
+                 "cds_coordinates_to_transcript": ("cds_coordinate_to_transcript", "cds"),
+                 "cds_coordinates_to_chromosome": ("cds_coordinate_to_chromosome", "cds")}
+
+
+def linear_scan(t, method, p):
+    """
+    The original Transcript coordinate conversion: the first exon that accepts the position wins.
+    """
+    for exon in t.exons:
+        r = getattr(exon, SCALAR_METHODS[method])(p)
+        if r is not None:
+            return r
+    return None
+
+
+def positions_in(t, space):
+    """
+    Every position of a coordinate space, plus a few on either side that can not be converted.
+    """
+    if space == "chromosome":
+        return range(t.start - 3, t.stop + 3)
+    elif space == "transcript":
+        return range(-3, len(t) + 3)
+    return range(-3, t.cds_size + 3)
+
+
+def example_transcripts():
+    """
+    Transcripts on both strands, with UTRs, a 0bp intron, a single exon, CDS in only one exon and no CDS at all.
+    """
+    return {"positive": GenePredTranscript(['A', 'chr1', '+', '2', '15', '4', '13', '3', '2,7,12', '6,10,15', '1',
+                                            'q2', 'cmpl', 'cmpl', '2,0,0']),
+            "negative": GenePredTranscript(['A', 'chr1', '-', '2', '15', '4', '13', '3', '2,7,12', '6,10,15', '1',
+                                            'q2', 'cmpl', 'cmpl', '0,2,1']),
+            "zero_intron": Transcript(['chr1', '1', '14', 'A', '0', '+', '7', '14', '0,128,0', '3', '5,4,1',
+                                       '0,5,12']),
+            "zero_intron_negative": Transcript(['chr1', '1', '14', 'A', '0', '-', '1', '8', '0,128,0', '3', '5,4,1',
+                                                '0,5,12']),
+            "single_exon": Transcript(['chr1', '10', '40', 'A', '0', '-', '13', '31', '0,128,0', '1', '30', '0']),
+            "cds_in_one_exon": Transcript(['chr1', '0', '60', 'A', '0', '+', '22', '28', '0,128,0', '3',
+                                           '10,10,10', '0,20,50']),
+            "cds_in_one_exon_negative": Transcript(['chr1', '0', '60', 'A', '0', '-', '22', '28', '0,128,0', '3',
+                                                    '10,10,10', '0,20,50']),
+            "non_coding": Transcript(['chr1', '5', '50', 'A', '0', '+', '50', '50', '0,128,0', '2', '10,10',
+                                      '0,35']),
+            "non_coding_negative": Transcript(['chr1', '5', '50', 'A', '0', '-', '5', '5', '0,128,0', '2', '10,10',
+                                               '0,35'])}
+
+
+class TranscriptCoordinateTests(unittest.TestCase):
+    def setUp(self):
+        self.transcripts = example_transcripts()
+
+    def test_scalar_conversions(self):
+        """
+        The bisecting scalar conversions must match the linear scan everywhere, including exon boundaries and
+        positions that are intronic, non-coding or off the ends of the transcript.
+        """
+        for name, t in self.transcripts.iteritems():
+            for method, space in BATCH_METHODS.itervalues():
+                for p in positions_in(t, space):
+                    self.assertEqual(getattr(t, method)(p), linear_scan(t, method, p),
+                                     "{} {} {}".format(name, method, p))
+
+    def test_batch_conversions(self):
+        """
+        The batch conversions must match the linear scan, with -1 wherever it returns None.
+        """
+        for name, t in self.transcripts.iteritems():
+            for batch_method, (method, space) in BATCH_METHODS.iteritems():
+                positions = positions_in(t, space)
+                expected = [-1 if x is None else x for x in (linear_scan(t, method, p) for p in positions)]
+                self.assertEqual(getattr(t, batch_method)(positions).tolist(), expected,
+                                 "{} {}".format(name, batch_method))
+
+    def test_unmapped_positions(self):
+        """
+        Intronic and UTR positions can not be converted to CDS coordinates.
+        """
+        t = self.transcripts["negative"]
+        self.assertEqual(t.chromosome_coordinates_to_cds([0, 2, 3, 4, 6, 12, 13]).tolist(), [-1, -1, -1, 5, -1, 0, -1])
+        self.assertEqual(t.transcript_coordinates_to_cds([0, 1, 2, 7, 8, 10]).tolist(), [-1, -1, 0, 5, -1, -1])
+        self.assertEqual(t.cds_coordinates_to_transcript([-1, 0, 5, 6]).tolist(), [-1, 2, 7, -1])
+        self.assertTrue((self.transcripts["non_coding"].transcript_coordinates_to_cds(range(20)) == -1).all())
+
+    def test_empty_batch(self):
+        t = self.transcripts["positive"]
+        self.assertEqual(t.chromosome_coordinates_to_transcript([]).tolist(), [])
+
+    def test_exon_index_candidates(self):
+        """
+        The candidate exons found by bisection must include the exon a linear scan would pick.
+        """
+        for name, t in self.transcripts.iteritems():
+            index = t.get_exon_index()
+            spaces = [["transcript", index.transcript_candidates, "transcript_pos_to_chrom_pos"],
+                      ["chromosome", index.chromosome_candidates, "chrom_pos_to_transcript_pos"],
+                      ["cds", index.cds_candidates, "cds_pos_to_transcript_pos"]]
+            for space, candidates, method in spaces:
+                for p in positions_in(t, space):
+                    accepted = [i for i, e in enumerate(t.exons) if getattr(e, method)(p) is not None]
+                    found = list(candidates(p))
+                    self.assertEqual(found[:1], accepted[:1], "{} {} {}".format(name, space, p))
+                    self.assertTrue(len(found) <= 1)
+            self.assertEqual(list(index.transcript_candidates(None)), [])
+
+
+def psl_row(strand, q_size, blocks, t_size=1000):
+    """
+    Builds a PslRow from a list of (query start, target start, size) blocks. Query starts are on the strand of the
+    alignment, as they are in a PSL.
+    """
+    q_start, q_end = blocks[0][0], blocks[-1][0] + blocks[-1][2]
+    if strand == "-":
+        q_start, q_end = q_size - q_end, q_size - q_start
+    return PslRow(map(str, [sum(x[2] for x in blocks), 0, 0, 0, 0, 0, 0, 0, strand, "A", q_size, q_start, q_end,
+                            "chr1", t_size, min(x[1] for x in blocks), max(x[1] + x[2] for x in blocks), len(blocks),
+                            ",".join(str(x[2]) for x in blocks) + ",", ",".join(str(x[0]) for x in blocks) + ",",
+                            ",".join(str(x[1]) for x in blocks) + ","]))
+
+
+def psl_target_scan(aln, p):
+    """
+    The original PslRow.target_coordinate_to_query, which asks every block in turn.
+    """
+    if p < aln.t_start or p >= aln.t_end:
+        return None
+    for i, t in enumerate(aln.t_starts):
+        if t <= p < t + aln.block_sizes[i]:
+            offset = p - t
+            if aln.strand == '+':
+                return aln.q_starts[i] + offset
+            return aln.q_size - (aln.q_starts[i] + offset) - 1
+    return None
+
+
+def psl_query_scan(aln, p):
+    """
+    The original PslRow.query_coordinate_to_target, which asks every block in turn.
+    """
+    if p < aln.q_start or p >= aln.q_end:
+        return None
+    if aln.strand == '-':
+        p = aln.q_size - p - 1
+    for i, q in enumerate(aln.q_starts):
+        if q <= p < q + aln.block_sizes[i]:
+            return aln.t_starts[i] + p - q
+    return None
+
+
+def example_alignments():
+    """
+    Alignments on both strands with insertions and deletions in the target, a single block alignment, a partial
+    alignment that does not cover the ends of the query and one whose blocks are out of order in the target.
+    """
+    return {"positive": psl_row("+", 30, [(0, 100, 10), (10, 115, 5), (18, 120, 12)]),
+            "negative": psl_row("-", 30, [(0, 100, 10), (10, 115, 5), (18, 120, 12)]),
+            "single_block": psl_row("-", 20, [(0, 50, 20)]),
+            "partial": psl_row("+", 40, [(5, 200, 10), (20, 210, 10)]),
+            "partial_negative": psl_row("-", 40, [(5, 200, 10), (20, 210, 10)]),
+            "unordered": psl_row("+", 20, [(0, 300, 10), (10, 100, 10)])}
+
+
+class PslCoordinateTests(unittest.TestCase):
+    def setUp(self):
+        self.alignments = example_alignments()
+
+    def test_scalar_conversions(self):
+        """
+        Bisecting the blocks must give the same result as the linear scan, including at block boundaries, in gaps
+        and off the ends of the alignment.
+        """
+        for name, aln in self.alignments.iteritems():
+            for p in xrange(aln.t_start - 3, aln.t_end + 3):
+                self.assertEqual(aln.target_coordinate_to_query(p), psl_target_scan(aln, p), "{} {}".format(name, p))
+            for p in xrange(-3, aln.q_size + 3):
+                self.assertEqual(aln.query_coordinate_to_target(p), psl_query_scan(aln, p), "{} {}".format(name, p))
+
+    def test_batch_conversions(self):
+        for name, aln in self.alignments.iteritems():
+            positions = range(aln.t_start - 3, aln.t_end + 3)
+            expected = [-1 if x is None else x for x in (psl_target_scan(aln, p) for p in positions)]
+            self.assertEqual(aln.target_coordinates_to_query(positions).tolist(), expected, name)
+            positions = range(-3, aln.q_size + 3)
+            expected = [-1 if x is None else x for x in (psl_query_scan(aln, p) for p in positions)]
+            self.assertEqual(aln.query_coordinates_to_target(positions).tolist(), expected, name)
+
+    def test_blocks_ordered(self):
+        self.assertEqual(self.alignments["positive"].blocks_ordered(), (True, True))
+        self.assertEqual(self.alignments["unordered"].blocks_ordered(), (False, True))
+
+    def test_unmapped_positions(self):
+        """
+        Positions in a gap between blocks are -1, as are positions outside of the aligned range.
+        """
+        aln = self.alignments["negative"]
+        self.assertEqual(aln.target_coordinates_to_query([99, 100, 109, 110, 115, 120, 131, 132]).tolist(),
+                         [-1, 29, 20, -1, 19, 11, 0, -1])
+        self.assertEqual(aln.query_coordinates_to_target([-1, 0, 11, 12, 13, 17, 29, 30]).tolist(),
+                         [-1, 131, 120, -1, -1, 117, 100, -1])
+
+
+def insertions_by_base(a, aln, mult3=None):
+    """
+    The original comp_ann_lib.insertion_iterator, which maps every query position.
+    """
+    prev_target_i = None
+    exon_starts = [x.start for x in a.exons]
+    for query_i in xrange(len(a)):
+        if query_i in exon_starts:
+            prev_target_i = None
+            continue
+        target_i = aln.query_coordinate_to_target(query_i)
+        if target_i is None:
+            prev_target_i = target_i
+            continue
+        if prev_target_i is not None and abs(target_i - prev_target_i) != 1:
+            insert_size = abs(target_i - prev_target_i) - 1
+            if mult3 is None or (insert_size % 3 == 0) is mult3:
+                yield min(prev_target_i, target_i) + 1, max(prev_target_i, target_i), insert_size
+        prev_target_i = target_i
+
+
+def deletions_by_base(t, aln, mult3=None):
+    """
+    The original comp_ann_lib.deletion_iterator, which maps every target transcript position.
+    """
+    prev_query_i = None
+    for target_i in xrange(len(t)):
+        target_chrom_i = t.transcript_coordinate_to_chromosome(target_i)
+        query_i = aln.target_coordinate_to_query(target_chrom_i)
+        if query_i is None:
+            prev_query_i = query_i
+            continue
+        if prev_query_i is not None and abs(query_i - prev_query_i) != 1:
+            delete_size = abs(query_i - prev_query_i) - 1
+            pos = target_chrom_i - 1 if t.strand is True else target_chrom_i + 1
+            if mult3 is None or (delete_size % 3 == 0) is mult3:
+                yield pos, pos, -delete_size
+        prev_query_i = query_i
+
+
+def random_bed_transcript(rand, start, size, strand):
+    """
+    A transcript of size bases starting at start, split into randomly sized exons with introns of 0 to 10 bases.
+    """
+    cuts = sorted(rand.sample(xrange(1, size), min(size - 1, rand.randint(0, 4))))
+    sizes = [y - x for x, y in zip([0] + cuts, cuts + [size])]
+    starts = []
+    pos = 0
+    for exon_size in sizes:
+        starts.append(pos)
+        pos += exon_size + rand.randint(0, 10)
+    stop = start + starts[-1] + sizes[-1]
+    return Transcript(map(str, ['chr1', start, stop, 'A', '0', strand, start, start, '0,128,0', len(sizes),
+                                ",".join(map(str, sizes)), ",".join(map(str, starts))]))
+
+
+def random_alignment(rand):
+    """
+    A random alignment of a query transcript to a target transcript, with indels of 0 to 7 bases between blocks.
+    Returns the query transcript, the alignment and the target transcript, which overhangs the aligned region.
+    """
+    blocks = []
+    q, t = rand.randint(0, 5), 100 + rand.randint(0, 5)
+    for _ in xrange(rand.randint(1, 6)):
+        size = rand.randint(1, 15)
+        blocks.append((q, t, size))
+        q += size + rand.randint(0, 7)
+        t += size + rand.randint(0, 7)
+    q_size = blocks[-1][0] + blocks[-1][2] + rand.randint(0, 5)
+    aln = psl_row(rand.choice("+-"), q_size, blocks)
+    a = random_bed_transcript(rand, 0, q_size, "+")
+    t = random_bed_transcript(rand, aln.t_start - 5, aln.t_end - aln.t_start + 10, rand.choice("+-"))
+    return a, aln, t
+
+
+class BlockBoundaryTests(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        self.cases = [random_alignment(rand) for _ in xrange(300)]
+        unordered = psl_row("+", 20, [(0, 120, 10), (12, 100, 8)])
+        self.cases.append((random_bed_transcript(rand, 0, 20, "+"), unordered,
+                           random_bed_transcript(rand, 95, 40, "-")))
+
+    def test_insertion_iterator(self):
+        for a, aln, t in self.cases:
+            for mult3 in [None, True, False]:
+                self.assertEqual(list(comp_ann_lib.insertion_iterator(a, aln, mult3)),
+                                 list(insertions_by_base(a, aln, mult3)), aln.psl_string())
+
+    def test_deletion_iterator(self):
+        for a, aln, t in self.cases:
+            for mult3 in [None, True, False]:
+                self.assertEqual(list(comp_ann_lib.deletion_iterator(t, aln, mult3)),
+                                 list(deletions_by_base(t, aln, mult3)), aln.psl_string())
+
+    def test_query_block_boundaries(self):
+        """
+        Every query position that is not a boundary must be in the same block as the position before it, if both
+        are aligned.
+        """
+        for a, aln, t in self.cases:
+            boundaries = set(comp_ann_lib.query_block_boundaries(aln, len(a)))
+            for i in xrange(1, len(a)):
+                if i not in boundaries:
+                    prev_target_i, target_i = aln.query_coordinate_to_target(i - 1), aln.query_coordinate_to_target(i)
+                    self.assertTrue(None in (prev_target_i, target_i) or abs(target_i - prev_target_i) == 1,
+                                    "{} {}".format(aln.psl_string(), i))
+
+    def test_target_block_boundaries(self):
+        """
+        Every target transcript position that is not a boundary must be in the same exon and block as the position
+        before it, if both are aligned.
+        """
+        for a, aln, t in self.cases:
+            boundaries = set(comp_ann_lib.target_block_boundaries(t, aln))
+            exon_starts = {x.start for x in t.exons}
+            to_query = lambda x: aln.target_coordinate_to_query(t.transcript_coordinate_to_chromosome(x))
+            for i in xrange(1, len(t)):
+                if i not in boundaries:
+                    self.assertNotIn(i, exon_starts)
+                    prev_query_i, query_i = to_query(i - 1), to_query(i)
+                    self.assertTrue(None in (prev_query_i, query_i) or abs(query_i - prev_query_i) == 1,
+                                    "{} {}".format(aln.psl_string(), i))
+
+    def test_indels_found(self):
+        """
+        The random alignments must actually contain indels of both kinds for the tests above to mean anything.
+        """
+        self.assertTrue(any(list(comp_ann_lib.insertion_iterator(a, aln)) for a, aln, t in self.cases))
+        self.assertTrue(any(list(comp_ann_lib.deletion_iterator(t, aln)) for a, aln, t in self.cases))
+
+
+def codon_pairs_by_codon(a, t, aln, target_seq_dict, query_seq_dict):
+    """
+    The original comp_ann_lib.codon_pair_iterator, which maps each codon with the scalar conversions.
+    """
+    target_cds = t.get_cds(target_seq_dict).upper()
+    query_cds = a.get_cds(query_seq_dict).upper()
+    a_offset = find_offset([x for x in a.exon_frames if x != -1], a.strand)
+    for i in xrange(a_offset, a.cds_size - a.cds_size % 3, 3):
+        target_cds_positions = [t.chromosome_coordinate_to_cds(aln.query_coordinate_to_target(
+                                a.cds_coordinate_to_transcript(j))) for j in xrange(i, i + 3)]
+        if None in target_cds_positions:
+            continue
+        yield target_cds_positions[0], target_cds[target_cds_positions[0]:target_cds_positions[0] + 3], \
+            query_cds[i:i + 3]
+
+
+def random_gene_pred(rand, chrom, strand, exons, frame_shift=0, coding=False):
+    """
+    A GenePredTranscript with the given exons and a random CDS, or one covering every exon if coding is True. Exon
+    frames start at frame_shift.
+    """
+    positions = [p for start, stop in exons for p in xrange(start, stop)]
+    i = 0 if coding is True else rand.randint(0, len(positions) - 1)
+    j = len(positions) - 1 if coding is True else rand.randint(i, len(positions) - 1)
+    thick_start, thick_stop = positions[i], positions[j] + 1
+    frames = [-1] * len(exons)
+    cds_pos = frame_shift
+    for i in xrange(len(exons)) if strand == "+" else reversed(xrange(len(exons))):
+        start, stop = max(exons[i][0], thick_start), min(exons[i][1], thick_stop)
+        if start < stop:
+            frames[i] = cds_pos % 3
+            cds_pos += stop - start
+    return GenePredTranscript(map(str, [
+        "A", chrom, strand, exons[0][0], exons[-1][1], thick_start, thick_stop, len(exons),
+        ",".join(str(x[0]) for x in exons), ",".join(str(x[1]) for x in exons), 0, "A", "cmpl", "cmpl",
+        ",".join(map(str, frames))]))
+
+
+def random_transmap(rand):
+    """
+    A random reference transcript, an alignment of its mRNA to the target genome and the target transcript built
+    from that alignment. Blocks are separated by deletions in the target, by introns in the target or both, but
+    never by insertions, which codon_pair_iterator does not expect to find inside a codon. The target transcript is
+    entirely CDS, so that every aligned codon lands inside it.
+    """
+    while True:
+        exons = []
+        pos = rand.randint(0, 50)
+        for _ in xrange(rand.randint(1, 5)):
+            size = rand.randint(10, 60)
+            exons.append((pos, pos + size))
+            pos += size + rand.randint(20, 60)
+        a = random_gene_pred(rand, "ref", rand.choice("+-"), exons, rand.randint(0, 2))
+        # both iterators run off the end of the query CDS if the frame offset leaves a partial codon at its end
+        if (a.cds_size - find_offset([x for x in a.exon_frames if x != -1], a.strand)) % 3 == 0:
+            break
+    blocks, tgt_exons = [], []
+    q, t = rand.randint(0, 3), 100
+    q_end = len(a) - rand.randint(0, 3)
+    while q < q_end:
+        size = min(rand.randint(5, 40), q_end - q)
+        blocks.append((q, t, size))
+        if len(tgt_exons) > 0 and tgt_exons[-1][1] == t:
+            tgt_exons[-1] = (tgt_exons[-1][0], t + size)
+        else:
+            tgt_exons.append((t, t + size))
+        q += size
+        t += size
+        kind = rand.choice(["deletion", "intron", "both"])
+        if kind != "intron":
+            q += rand.randint(1, 5)
+        if kind != "deletion":
+            t += rand.randint(30, 60)
+    strand = rand.choice("+-")
+    aln = psl_row(strand, len(a), blocks, t_size=1000)
+    return a, aln, random_gene_pred(rand, "tgt", strand, tgt_exons, coding=True)
+
+
+class CodonPairTests(unittest.TestCase):
+    def setUp(self):
+        rand = random.Random(1)
+        sequence = lambda size: "".join(rand.choice("ACGT") for _ in xrange(size))
+        self.query_seq_dict = {"ref": sequence(1000)}
+        self.target_seq_dict = {"tgt": sequence(1000)}
+        self.cases = [random_transmap(rand) for _ in xrange(300)]
+
+    def test_codon_pair_iterator(self):
+        """
+        Mapping every codon in one batch must give the same codon pairs as mapping them one at a time.
+        """
+        num_pairs = 0
+        for a, aln, t in self.cases:
+            pairs = list(comp_ann_lib.codon_pair_iterator(a, t, aln, self.target_seq_dict, self.query_seq_dict))
+            self.assertEqual(pairs, list(codon_pairs_by_codon(a, t, aln, self.target_seq_dict, self.query_seq_dict)),
+                             aln.psl_string())
+            num_pairs += len(pairs)
+        self.assertTrue(num_pairs > 1000)
+
+    def test_codon_pairs_partly_aligned(self):
+        """
+        Codons that touch a deletion or an unaligned end of the query are skipped.
+        """
+        skipped = 0
+        for a, aln, t in self.cases:
+            pairs = list(comp_ann_lib.codon_pair_iterator(a, t, aln, self.target_seq_dict, self.query_seq_dict))
+            a_offset = find_offset([x for x in a.exon_frames if x != -1], a.strand)
+            skipped += len(xrange(a_offset, a.cds_size - a.cds_size % 3, 3)) - len(pairs)
+            for target_cds_pos, target_codon, query_codon in pairs:
+                self.assertEqual(len(target_codon), 3)
+                self.assertEqual(len(query_codon), 3)
+                self.assertTrue(0 <= target_cds_pos <= t.cds_size - 3)
+        self.assertTrue(skipped > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
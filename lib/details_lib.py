@@ -0,0 +1,160 @@
+"""
+Compact binary encoding for the cells of the details database.
+
+A details cell holds the BED12 records a classifier reported for one alignment, collapsed into tab/newline separated
+text by sql_lib.collapse_details_dict. Most of that text is repeated: every name is the classifier column plus the
+alignment ID of the row, and the chromosome and color are the same for every record of a cell. The compact encoding
+stores a cell as a BLOB made of a small header, a table of the strings that can not be derived from the row and the
+column, and one packed integer array holding every record:
+
+    chrom, start - base, stop - start, name, score, strand, thick_start - start, thick_stop - start, rgb,
+    block_count, block_sizes..., block_starts...
+
+chrom and rgb index the string table. name is -1 for "<column>/<row ID>", k >= 0 for "<strings[k]>/<row ID>" and
+k <= -2 for strings[-k - 2] on its own. Integers use the smallest signed width that holds every value of the cell.
+
+A cell is only encoded if decoding it gives back exactly the original text, otherwise it is stored as text. Readers
+therefore never need to know how a database was built: decode_details passes text cells through unchanged.
+"""
+import struct
+import numpy as np
+
+__author__ = "Ian Fiddes"
+
+DETAILS_VERSION = 1
+# version, integer width in bytes, base start of the cell, length of the string table
+header = struct.Struct("<BBIH")
+strand_codes = {"+": 0, "-": 1, ".": 2}
+strands = "+-."
+int_types = [np.int8, np.int16, np.int32, np.int64]
+
+
+def _block_ints(field):
+    """
+    Parses a blockSizes/blockStarts field. Raises ValueError if it can't be written back in the same form.
+    """
+    values = map(int, field.split(","))
+    if ",".join(map(str, values)) != field:
+        raise ValueError("unsupported block field {}".format(field))
+    return values
+
+
+def _encode_records(bed_text, column, row_id):
+    """
+    Builds the string table and integer list for a cell. Raises ValueError for anything that is not BED12.
+    """
+    strings = []
+    string_index = {}
+
+    def index(s):
+        if s not in string_index:
+            string_index[s] = len(strings)
+            strings.append(s)
+        return string_index[s]
+
+    records = [x.split("\t") for x in bed_text.rstrip("\n").split("\n")]
+    base = min(int(x[1]) for x in records)
+    ints = []
+    for chrom, start, stop, name, score, strand, thick_start, thick_stop, rgb, block_count, sizes, starts in records:
+        start = int(start)
+        prefix, sep, suffix = name.rpartition("/")
+        if sep != "" and suffix == row_id:
+            name_code = -1 if prefix == column else index(prefix)
+        else:
+            name_code = -index(name) - 2
+        sizes = _block_ints(sizes)
+        starts = _block_ints(starts)
+        if len(sizes) != int(block_count) or len(starts) != int(block_count):
+            raise ValueError("block count does not match blocks")
+        ints.extend([index(chrom), start - base, int(stop) - start, name_code, int(score), strand_codes[strand],
+                     int(thick_start) - start, int(thick_stop) - start, index(rgb), int(block_count)])
+        ints.extend(sizes)
+        ints.extend(starts)
+    return base, strings, ints
+
+
+def _pack(base, strings, ints):
+    string_table = "\t".join(strings)
+    if len(string_table) > 0xFFFF or not 0 <= base <= 0xFFFFFFFF:
+        raise ValueError("cell can not be packed")
+    lo, hi = min(ints), max(ints)
+    int_type = next(t for t in int_types if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max)
+    ints = np.array(ints, dtype=np.dtype(int_type).newbyteorder("<"))
+    return header.pack(DETAILS_VERSION, ints.itemsize, base, len(string_table)) + string_table + ints.tostring()
+
+
+def encode_details(bed_text, column, row_id):
+    """
+    Encodes one collapsed details cell of the given column and row. Returns a buffer, or bed_text itself if the cell
+    can't be encoded without loss.
+    """
+    if bed_text is None or len(bed_text) == 0:
+        return bed_text
+    try:
+        blob = _pack(*_encode_records(bed_text, column, row_id))
+    except (ValueError, KeyError, TypeError):
+        return bed_text
+    if decode_details(buffer(blob), column, row_id) != bed_text:
+        return bed_text
+    return buffer(blob)
+
+
+def decode_details(value, column, row_id):
+    """
+    Decodes a details cell back to collapsed BED text. Text cells are returned unchanged.
+    """
+    if not isinstance(value, buffer):
+        return value
+    value = str(value)
+    version, itemsize, base, string_len = header.unpack_from(value)
+    assert version == DETAILS_VERSION, "unknown details encoding version {}".format(version)
+    offset = header.size + string_len
+    strings = value[header.size:offset].split("\t")
+    int_type = np.dtype(next(t for t in int_types if np.dtype(t).itemsize == itemsize)).newbyteorder("<")
+    ints = np.frombuffer(value, dtype=int_type, offset=offset).tolist()
+    lines = []
+    i = 0
+    while i < len(ints):
+        chrom, start, size, name_code, score, strand, thick_start, thick_stop, rgb, block_count = ints[i:i + 10]
+        i += 10
+        start += base
+        if name_code == -1:
+            name = column + "/" + row_id
+        elif name_code >= 0:
+            name = strings[name_code] + "/" + row_id
+        else:
+            name = strings[-name_code - 2]
+        sizes = ",".join(map(str, ints[i:i + block_count]))
+        starts = ",".join(map(str, ints[i + block_count:i + 2 * block_count]))
+        i += 2 * block_count
+        lines.append("\t".join([strings[chrom], str(start), str(start + size), name, str(score), strands[strand],
+                                str(start + thick_start), str(start + thick_stop), strings[rgb], str(block_count),
+                                sizes, starts]))
+    return "\n".join(lines) + "\n"
+
+
+class EncodedDetailsColumn(object):
+    """
+    Wraps a column of collapsed details cells whose iteritems() yields (row ID, cell) pairs sorted by row ID, such as
+    a spill_lib.SpilledColumn, and encodes each cell as it is read. See sql_lib.write_dict.
+    """
+    def __init__(self, col, column):
+        self.col = col
+        self.column = column
+
+    def iteritems(self):
+        for row_id, value in self.col.iteritems():
+            yield row_id, encode_details(value, self.column, row_id)
+
+
+def decode_rows(cur):
+    """
+    Iterates over the BED text of every non-empty details cell returned by an executed cursor whose first column is
+    the row ID, as in the details queries in etc.config.
+    """
+    columns = [x[0] for x in cur.description]
+    for row in cur:
+        row_id = row[0]
+        for column, value in zip(columns[1:], row[1:]):
+            if value is not None:
+                yield decode_details(value, column, row_id)
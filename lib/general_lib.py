@@ -9,6 +9,7 @@ import itertools
 import random
 import types
 import errno
+import numpy as np
 import pandas as pd
 from collections import OrderedDict, Callable, namedtuple
 
@@ -127,6 +128,103 @@ def tokenize_stream(stream):
             yield tokens
 
 
+def _buffered_lines(stream, buffer_size):
+    """
+    Reads stream buffer_size bytes at a time, yielding blocks of complete newline terminated lines.
+    """
+    partial = ""
+    while True:
+        buf = stream.read(buffer_size)
+        if not buf:
+            break
+        buf = partial + buf
+        end = buf.rfind("\n") + 1
+        partial = buf[end:]
+        if end > 0:
+            yield buf[:end]
+    if partial:
+        yield partial + "\n"
+
+
+def _split_columns(block, num_columns):
+    """
+    Splits a block of lines into its first num_columns columns, skipping the lines tokenize_stream skips. If every
+    line is a plain record with exactly num_columns fields, the whole block is split in one call. Otherwise each line
+    is tokenized on its own.
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord("\n"))
+    line_starts = np.r_[0, newlines[:-1] + 1]
+    tabs = np.diff(np.r_[0, np.searchsorted(np.flatnonzero(data == ord("\t")), newlines)])
+    if (num_columns > 1 and np.all(tabs == num_columns - 1) and
+            not np.any(data[line_starts] == ord("#")) and
+            not np.any(np.in1d(data[newlines - 1], np.frombuffer(" \r\x0b\x0c", dtype=np.uint8)))):
+        tokens = block[:-1].replace("\n", "\t").split("\t")
+        return [tokens[i::num_columns] for i in xrange(num_columns)]
+    rows = [x.split("\t") for x in (y.rstrip() for y in block.split("\n") if not y.startswith("#")) if x]
+    if len(rows) == 0:
+        return [[] for _ in xrange(num_columns)]
+    assert min(len(x) for x in rows) >= num_columns, "Found lines with fewer than {} columns".format(num_columns)
+    return [list(x) for x in zip(*rows)[:num_columns]]
+
+
+def _parse_ints(values):
+    """
+    Parses a sequence of integer strings into an int64 array in one call.
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64)
+    r = np.fromstring(" ".join(values), dtype=np.int64, sep=" ")
+    assert len(r) == len(values), "Malformed integer column"
+    return r
+
+
+def _parse_int_lists(values):
+    """
+    Parses a sequence of comma separated integer lists ("1,2,3,") into one flat int64 array and an offset array,
+    so that list i is flat[offsets[i]:offsets[i + 1]].
+    """
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), offsets
+    joined = "|".join(values) + "|"
+    data = np.frombuffer(joined, dtype=np.uint8)
+    ends = np.flatnonzero(data == ord("|"))
+    if np.all(data[ends - 1] == ord(",")):
+        # every list ends in a comma, as genePred and PSL lists do, so the lists can be parsed as one
+        np.cumsum(np.diff(np.r_[0, np.searchsorted(np.flatnonzero(data == ord(",")), ends)]), out=offsets[1:])
+        flat = np.fromstring("".join(values), dtype=np.int64, sep=",")
+    else:
+        values = [x.rstrip(",") for x in values]
+        np.cumsum([x.count(",") + 1 if x else 0 for x in values], out=offsets[1:])
+        flat = np.fromstring(",".join(x for x in values if x), dtype=np.int64, sep=",")
+    if offsets[-1] == 0:
+        flat = np.zeros(0, dtype=np.int64)
+    assert len(flat) == offsets[-1], "Malformed integer list"
+    return flat, offsets
+
+
+def read_tsv_columns(path, num_columns, int_columns=(), list_columns=(), buffer_size=2 ** 24):
+    """
+    Bulk parser for tab separated files such as genePred and PSL. The file (gzipped or not, see opener) is read in
+    large buffers and split into the first num_columns columns, skipping the same lines tokenize_stream skips. Integer
+    columns are converted to int64 arrays and comma separated integer list columns to (flat, offsets) pairs (see
+    _parse_int_lists) in bulk. All other columns are returned as lists of strings.
+    """
+    with opener(path) as inf:
+        chunks = [_split_columns(block, num_columns) for block in _buffered_lines(inf, buffer_size)]
+    columns = []
+    for i in xrange(num_columns):
+        values = list(itertools.chain.from_iterable(chunk[i] for chunk in chunks))
+        if i in int_columns:
+            columns.append(_parse_ints(values))
+        elif i in list_columns:
+            columns.append(_parse_int_lists(values))
+        else:
+            columns.append(values)
+    return columns
+
+
 def format_ratio(numerator, denominator):
     """
     Convenience function that converts two numbers, integer or no, to a ratio
@@ -7,7 +7,9 @@ Modified by Ian Fiddes
 
 from collections import Counter
 import re
-from lib.general_lib import format_ratio, tokenize_stream
+import bisect
+import numpy as np
+from lib.general_lib import format_ratio, tokenize_stream, read_tsv_columns
 
 __author__ = "Ian Fiddes"
 
@@ -18,7 +20,7 @@ class PslRow(object):
     """
     __slots__ = ('matches', 'mismatches', 'repmatches', 'n_count', 'q_num_insert', 'q_base_insert', 't_num_insert',
                  't_base_insert', 'strand', 'q_name', 'q_size', 'q_start', 'q_end', 't_name', 't_size', 't_start',
-                 't_end', 'block_count', 'block_sizes', 'q_starts', 't_starts')
+                 't_end', 'block_count', 'block_sizes', 'q_starts', 't_starts', '_blocks_ordered')
 
     def __init__(self, data_tokens):
         assert(len(data_tokens) == 21)
@@ -44,6 +46,7 @@ class PslRow(object):
         self.block_sizes = [int(x) for x in data_tokens[18].split(',') if x]
         self.q_starts = [int(x) for x in data_tokens[19].split(',') if x]
         self.t_starts = [int(x) for x in data_tokens[20].split(',') if x]
+        self._blocks_ordered = None
 
     def hash_key(self):
         """ return a string to use as dict key.
@@ -60,7 +63,8 @@ class PslRow(object):
             return None
         if self.strand not in ['+', '-']:
             raise RuntimeError('Unanticipated strand: %s' % self.strand)
-        for i, t in enumerate(self.t_starts):
+        for i in self._block_candidates(self.t_starts, p, 0):
+            t = self.t_starts[i]
             if p < t:
                 continue
             if p >= t + self.block_sizes[i]:
@@ -86,7 +90,8 @@ class PslRow(object):
         # this is the easier one to write
         if self.strand == '-':
             p = self.q_size - p - 1
-        for i, q in enumerate(self.q_starts):
+        for i in self._block_candidates(self.q_starts, p, 1):
+            q = self.q_starts[i]
             if p < q:
                 continue
             if p >= q + self.block_sizes[i]:
@@ -96,6 +101,74 @@ class PslRow(object):
             return self.t_starts[i] + offset
         return None
 
+    def blocks_ordered(self):
+        """
+        Returns a pair of bools telling if the blocks are sorted and non-overlapping in target and in query
+        coordinates, as they are in any valid PSL. If so, the block containing a position can be found by bisection.
+        """
+        if self._blocks_ordered is None:
+            self._blocks_ordered = tuple(all(starts[i] + self.block_sizes[i] <= starts[i + 1]
+                                             for i in xrange(len(starts) - 1))
+                                         for starts in [self.t_starts, self.q_starts])
+        return self._blocks_ordered
+
+    def _block_candidates(self, starts, p, query):
+        """
+        Returns the indices of the blocks that may contain position p, which is in the coordinates of starts. This is
+        the one block found by bisection, or every block if the blocks are not ordered.
+        """
+        if self.blocks_ordered()[query] is False:
+            return xrange(len(starts))
+        i = bisect.bisect_right(starts, p) - 1
+        return [i] if i >= 0 else []
+
+    def target_coordinates_to_query(self, positions):
+        """
+        Vectorized target_coordinate_to_query. Takes an array of target positions and returns a numpy array of query
+        positions, with -1 wherever target_coordinate_to_query would have returned None.
+        """
+        p = np.asarray(positions, dtype=np.int64)
+        if self.blocks_ordered()[0] is False:
+            return np.array([-1 if x is None else x for x in map(self.target_coordinate_to_query, p.tolist())],
+                            dtype=np.int64)
+        in_range = (p >= self.t_start) & (p < self.t_end)
+        if self.strand not in ['+', '-'] and in_range.any():
+            raise RuntimeError('Unanticipated strand: %s' % self.strand)
+        r, found = self._map_blocks(p, self.t_starts, self.q_starts)
+        if self.strand == '-':
+            r = self.q_size - r - 1
+        return np.where(in_range & found, r, -1)
+
+    def query_coordinates_to_target(self, positions):
+        """
+        Vectorized query_coordinate_to_target. Takes an array of query positions and returns a numpy array of target
+        positions, with -1 wherever query_coordinate_to_target would have returned None.
+        """
+        p = np.asarray(positions, dtype=np.int64)
+        if self.blocks_ordered()[1] is False:
+            return np.array([-1 if x is None else x for x in map(self.query_coordinate_to_target, p.tolist())],
+                            dtype=np.int64)
+        in_range = (p >= self.q_start) & (p < self.q_end)
+        if self.strand not in ['+', '-'] and in_range.any():
+            raise RuntimeError('Unanticipated strand: %s' % self.strand)
+        if self.strand == '-':
+            p = self.q_size - p - 1
+        r, found = self._map_blocks(p, self.q_starts, self.t_starts)
+        return np.where(in_range & found, r, -1)
+
+    def _map_blocks(self, p, from_starts, to_starts):
+        """
+        Maps an array of positions through the blocks. Returns the mapped positions and a mask of the positions that
+        fall inside a block.
+        """
+        if len(from_starts) == 0:
+            return p, np.zeros(len(p), dtype=bool)
+        from_starts = np.array(from_starts, dtype=np.int64)
+        i = np.maximum(np.searchsorted(from_starts, p, side="right") - 1, 0)
+        offset = p - from_starts[i]
+        found = (offset >= 0) & (offset < np.array(self.block_sizes, dtype=np.int64)[i])
+        return np.array(to_starts, dtype=np.int64)[i] + offset, found
+
     @property
     def coverage(self):
         return 100 * format_ratio(self.matches + self.mismatches + self.repmatches, self.q_size)
@@ -139,6 +212,7 @@ class PslRow(object):
         # not implementing explicit target strand yet
         self.strand = "-" if self.strand == "+" else "+"
         self.block_sizes = self.block_sizes[::-1]
+        self._blocks_ordered = None
 
 
 def psl_iterator(psl_file):
@@ -158,6 +232,106 @@ def get_alignment_dict(psl_file):
     return {aln_id: aln for aln_id, aln in psl_iterator(psl_file)}
 
 
+_psl_int_columns = ["matches", "mismatches", "repmatches", "n_count", "q_num_insert", "q_base_insert", "t_num_insert",
+                    "t_base_insert", "q_size", "q_start", "q_end", "t_size", "t_start", "t_end", "block_count"]
+_psl_int_tokens = [0, 1, 2, 3, 4, 5, 6, 7, 10, 11, 12, 14, 15, 16, 17]
+_psl_block_columns = ["block_sizes", "q_starts", "t_starts"]
+
+
+def parse_psl_columns(psl_file):
+    """
+    Parses a PSL file into a dict of numpy arrays, one per field. Block fields are stored flattened with
+    block_offsets marking where each alignment's blocks begin, so the blocks of row i are
+    block_sizes[block_offsets[i]:block_offsets[i + 1]].
+    """
+    columns = read_tsv_columns(psl_file, 21, int_columns=_psl_int_tokens, list_columns=[18, 19, 20])
+    r = {c: np.array(columns[i], dtype=str) for c, i in zip(["q_names", "t_names", "strands"], [9, 13, 8])}
+    r.update({c: columns[i] for c, i in zip(_psl_int_columns, _psl_int_tokens)})
+    r.update({c: columns[i][0] for c, i in zip(_psl_block_columns, [18, 19, 20])})
+    r["block_offsets"] = columns[18][1]
+    return r
+
+
+def get_alignment_table(psl_file):
+    """
+    Convenience function for creating a PslTable.
+    """
+    return PslTable(parse_psl_columns(psl_file))
+
+
+def _ratios(numerator, denominator):
+    """
+    Vectorized 100 * format_ratio.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = 100 * (numerator.astype(np.float64) / denominator)
+    r[denominator == 0] = np.nan
+    return r
+
+
+class PslTable(object):
+    """
+    A whole PSL file held as numpy columns (see parse_psl_columns). The alignment metrics are computed for every row
+    at once. Indexing the table by query name returns a PslRow for that alignment; as with get_alignment_dict, the
+    last alignment wins if a name appears more than once.
+    """
+    def __init__(self, cols):
+        self.cols = cols
+        self.names = cols["q_names"]
+        self.rows = {n: i for i, n in enumerate(self.names.tolist())}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names.tolist())
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        return self.get_row(self.rows[name])
+
+    def get_row(self, i):
+        """
+        Returns row i as a PslRow.
+        """
+        c = self.cols
+        blocks = slice(c["block_offsets"][i], c["block_offsets"][i + 1])
+        join = lambda x: ",".join(map(str, x[blocks].tolist())) + ","
+        tokens = [c[x][i] for x in _psl_int_columns]
+        tokens[8:8] = [c["strands"][i], c["q_names"][i]]
+        tokens[13:13] = [c["t_names"][i]]
+        tokens.extend(join(c[x]) for x in _psl_block_columns)
+        return PslRow(map(str, tokens))
+
+    def iteritems(self):
+        for i, name in enumerate(self.names.tolist()):
+            yield name, self.get_row(i)
+
+    def metric_dict(self, values):
+        """
+        Returns a dict of query name to the matching value of an array with one value per row.
+        """
+        return dict(zip(self.names.tolist(), values.tolist()))
+
+    def coverage(self):
+        c = self.cols
+        return _ratios(c["matches"] + c["mismatches"] + c["repmatches"], c["q_size"])
+
+    def identity(self):
+        c = self.cols
+        return _ratios(c["matches"] + c["repmatches"], c["matches"] + c["repmatches"] + c["mismatches"] +
+                       c["q_num_insert"])
+
+    def target_coverage(self):
+        c = self.cols
+        return _ratios(c["matches"] + c["mismatches"] + c["repmatches"], c["t_size"])
+
+    def percent_n(self):
+        return _ratios(self.cols["n_count"], self.cols["q_size"])
+
+
 def remove_alignment_number(s, aln_re=re.compile("-[0-9]+$")):
     """
     If the name of the transcript ends with -d as in
@@ -194,3 +368,71 @@ def aln_id_is_transmap(aln_id):
     Uses remove_augustus_alignment_number to determine if this transcript is an Augustus transcript
     """
     return True if remove_alignment_number(aln_id) != aln_id else False
+
+
+class AlignmentIdIndex(object):
+    """
+    Joins alignment IDs to the transcripts they were derived from. Both the transMap (ENST00000000001.1-1) and the
+    Augustus (augI1-ENST00000000001.1-1) naming schemes are stripped once when the index is built, so every join
+    afterwards is a lookup instead of a regular expression.
+
+    rows maps each alignment ID to its position in aln_ids, which is its row in the table the IDs were taken from.
+    If source_names is given, source_rows holds the row of the source transcript of each alignment in that table,
+    or -1 if it is not present.
+    """
+    def __init__(self, aln_ids, transmap_ids, transcript_ids, source_names=None):
+        self.aln_ids = aln_ids
+        self.rows = {x: i for i, x in enumerate(aln_ids)}
+        self.transmap_ids = dict(zip(aln_ids, transmap_ids))
+        self.transcript_ids = dict(zip(aln_ids, transcript_ids))
+        self.source_rows = None
+        if source_names is not None:
+            source_rows = {x: i for i, x in enumerate(source_names)}
+            self.source_rows = np.array([source_rows.get(x, -1) for x in transcript_ids], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.aln_ids)
+
+    def __iter__(self):
+        return iter(self.aln_ids)
+
+    def __contains__(self, aln_id):
+        return aln_id in self.rows
+
+    def __getitem__(self, aln_id):
+        return self.transcript_ids[aln_id]
+
+    def transcript_id(self, aln_id):
+        """
+        Returns the source transcript ID of aln_id. IDs that are not in the index are stripped as usual.
+        """
+        tx_id = self.transcript_ids.get(aln_id)
+        return strip_alignment_numbers(aln_id) if tx_id is None else tx_id
+
+    def transmap_id(self, aln_id):
+        """
+        Returns the transMap alignment ID of aln_id, which is aln_id itself unless it is an Augustus ID.
+        """
+        tm_id = self.transmap_ids.get(aln_id)
+        return remove_augustus_alignment_number(aln_id) if tm_id is None else tm_id
+
+    def source_values(self, values):
+        """
+        Returns a dict of alignment ID -> the value of its source transcript, given an array holding one value per row
+        of the source table.
+        """
+        missing = np.flatnonzero(self.source_rows < 0)
+        if len(missing) > 0:
+            raise KeyError(self.transcript_ids[self.aln_ids[missing[0]]])
+        return dict(zip(self.aln_ids, values[self.source_rows].tolist()))
+
+
+def build_alignment_id_index(aln_ids, source_names=None):
+    """
+    Builds an AlignmentIdIndex over any iterable of alignment IDs. Each distinct transMap ID is only stripped once,
+    however many Augustus IDs were derived from it.
+    """
+    aln_ids = list(aln_ids)
+    transmap_ids = [remove_augustus_alignment_number(x) if x.startswith("augI") else x for x in aln_ids]
+    stripped = {x: remove_alignment_number(x) for x in set(transmap_ids)}
+    return AlignmentIdIndex(aln_ids, transmap_ids, [stripped[x] for x in transmap_ids], source_names)
@@ -1,6 +1,6 @@
 """
 Convenience library for sequence information, including BED/genePred files and fasta files
-Needs the python library pyfasta installed.
+Needs the python library pyfasta installed for fasta input. UCSC .2bit files are read directly.
 
 Original Author: Dent Earl
 Modified by Ian Fiddes
@@ -8,24 +8,302 @@ Modified by Ian Fiddes
 
 import string
 import copy
+import bisect
+import collections
+import cPickle
+import hashlib
 import os
 import math
 import re
 from itertools import izip
-from lib.general_lib import tokenize_stream
-from pyfasta import Fasta, NpyFastaRecord
+import numpy as np
+from lib.general_lib import tokenize_stream, read_tsv_columns, mkdir_p
+from pyfasta import Fasta
 
 __author__ = "Ian Fiddes"
 
 
-class UpperNpyFastaRecord(NpyFastaRecord):
+class GenomeRecord(object):
     """
-    Used when we want only upper case records.
-    If as_string is False, will no longer return a memmap object but instead a list.
+    One chromosome of a GenomeStore. Slicing returns the (uppercase) sequence as a string, following the same rules
+    as slicing a string. Indexing a single position past the end returns an empty string.
+    get_array returns a zero-copy uint8 view of a region for code that works on numpy arrays.
     """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
     def __getitem__(self, islice):
-        d = self.getdata(islice)
-        return d.tostring().decode().upper() if self.as_string else map(string.upper, d)
+        if isinstance(islice, (int, long)):
+            if islice >= len(self.data):
+                return ""
+            return chr(self.data[islice])
+        return self.data[islice].tostring()
+
+    def get_array(self, start=None, stop=None):
+        return self.data[start:stop]
+
+
+class GenomeStore(collections.Mapping):
+    """
+    Dictionary of chromosome name to GenomeRecord, backed by an uppercased copy of a fasta file held as one flat uint8
+    array. See build_genome_store. The copy and the N gap index are cached in cache_dir, if given, and the copy is
+    then memory mapped. Otherwise it is held in memory.
+    """
+    def __init__(self, fasta_path, cache_dir=None):
+        self.fasta_path = fasta_path
+        self.cache_dir = cache_dir
+        self.data, self.index = build_genome_store(fasta_path, cache_dir)
+        self.n_gap_index = None
+
+    def __getitem__(self, chrom):
+        start, stop = self.index[chrom]
+        return GenomeRecord(self.data[start:stop])
+
+    def get_n_gap_index(self):
+        """
+        Returns the NGapIndex of this genome, loaded on first use. See build_n_gap_index.
+        """
+        if self.n_gap_index is None:
+            self.n_gap_index = build_n_gap_index(self.fasta_path, self.cache_dir)
+        return self.n_gap_index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+_two_bit_signature = 0x1A412743
+# each byte of packed 2bit sequence holds four bases, first base in the most significant bits
+_two_bit_table = np.array([[ord("TCAG"[(b >> shift) & 3]) for shift in (6, 4, 2, 0)] for b in xrange(256)],
+                          dtype=np.uint8)
+
+
+def is_two_bit(file_path):
+    """
+    Returns True if file_path looks like a UCSC .2bit file.
+    """
+    return file_path.endswith(".2bit")
+
+
+class TwoBitRecord(object):
+    """
+    One sequence of a TwoBitFile. Supports the same slicing as GenomeRecord, but only the packed bytes covering
+    the requested range are decoded. N-blocks are applied as N and, unless the file was opened with upper=True,
+    soft-masked blocks are lowercased.
+    """
+    __slots__ = ('data', 'size', 'n_blocks', 'mask_blocks', 'upper')
+
+    def __init__(self, data, size, n_blocks, mask_blocks, upper):
+        self.data = data
+        self.size = size
+        self.n_blocks = n_blocks
+        self.mask_blocks = mask_blocks
+        self.upper = upper
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, islice):
+        if isinstance(islice, (int, long)):
+            if islice >= self.size:
+                return ""
+            if islice < 0:
+                islice += self.size
+            if islice < 0:
+                raise IndexError("index out of range")
+            return self.get_array(islice, islice + 1).tostring()
+        start, stop, step = islice.indices(self.size)
+        if step == 1:
+            return self.get_array(start, stop).tostring()
+        return self.get_array()[islice].tostring()
+
+    def get_array(self, start=None, stop=None):
+        start, stop, _ = slice(start, stop).indices(self.size)
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint8)
+        first = start // 4
+        seq = _two_bit_table[self.data[first:(stop + 3) // 4]].ravel()[start - first * 4:stop - first * 4]
+        self._apply_blocks(seq, start, stop, self.n_blocks, lambda x: x.fill(ord("N")))
+        if self.upper is False:
+            self._apply_blocks(seq, start, stop, self.mask_blocks, lambda x: np.bitwise_or(x, 0x20, out=x))
+        return seq
+
+    @staticmethod
+    def _apply_blocks(seq, start, stop, blocks, fn):
+        """
+        Calls fn on the part of seq covered by each sorted, non-overlapping (starts, ends) block within start:stop.
+        """
+        starts, ends = blocks
+        for i in xrange(np.searchsorted(ends, start, side="right"), np.searchsorted(starts, stop, side="left")):
+            fn(seq[max(starts[i], start) - start:min(ends[i], stop) - start])
+
+
+class TwoBitFile(collections.Mapping):
+    """
+    Dictionary of sequence name to TwoBitRecord for a UCSC .2bit file, which is memory mapped. The header of each
+    sequence is parsed the first time it is accessed. If upper is True, soft-masking is ignored.
+    """
+    def __init__(self, file_path, upper=True):
+        self.file_path = file_path
+        self.upper = upper
+        self.mm = np.memmap(file_path, dtype=np.uint8, mode="r")
+        signature = self.mm[:4].view("<u4")[0]
+        if signature == _two_bit_signature:
+            self.endian = "<"
+        else:
+            assert self.mm[:4].view(">u4")[0] == _two_bit_signature, "{} is not a 2bit file".format(file_path)
+            self.endian = ">"
+        version, seq_count = self.mm[4:12].view(self.endian + "u4")
+        offset_size = 8 if version == 1 else 4
+        self.offsets = collections.OrderedDict()
+        pos = 16
+        for _ in xrange(seq_count):
+            name_size = int(self.mm[pos])
+            name = self.mm[pos + 1:pos + 1 + name_size].tostring()
+            pos += 1 + name_size
+            self.offsets[name] = int(self.mm[pos:pos + offset_size].view(self.endian + "u{}".format(offset_size))[0])
+            pos += offset_size
+        self.records = {}
+        self.n_gap_index = None
+
+    def _read_uints(self, pos, count):
+        return self.mm[pos:pos + 4 * count].view(self.endian + "u4").astype(np.int64), pos + 4 * count
+
+    def _read_blocks(self, pos):
+        (count,), pos = self._read_uints(pos, 1)
+        starts, pos = self._read_uints(pos, count)
+        sizes, pos = self._read_uints(pos, count)
+        return (starts, starts + sizes), pos
+
+    def __getitem__(self, chrom):
+        if chrom not in self.records:
+            (size,), pos = self._read_uints(self.offsets[chrom], 1)
+            n_blocks, pos = self._read_blocks(pos)
+            mask_blocks, pos = self._read_blocks(pos)
+            pos += 4  # reserved
+            data = self.mm[pos:pos + (size + 3) // 4]
+            self.records[chrom] = TwoBitRecord(data, int(size), n_blocks, mask_blocks, self.upper)
+        return self.records[chrom]
+
+    def get_n_gap_index(self):
+        """
+        Returns a NGapIndex of this genome, built from the N-blocks stored in the 2bit file.
+        """
+        if self.n_gap_index is None:
+            sizes = {name: len(self[name]) for name in self}
+            runs = {name: _merge_runs(*self[name].n_blocks) for name in self}
+            self.n_gap_index = NGapIndex(sizes, runs)
+        return self.n_gap_index
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class NGapIndex(object):
+    """
+    Sorted intervals of the runs of N in every chromosome of a genome. Answers whether a region contains unknown
+    bases, and how many, with a binary search instead of fetching the sequence. Regions follow slicing rules.
+    """
+    def __init__(self, sizes, runs):
+        self.sizes = sizes
+        self.runs = runs
+
+    def _overlapping(self, chrom, start, stop):
+        """
+        Returns the clipped region along with the starts, ends and index range of the runs overlapping it.
+        """
+        start, stop, _ = slice(start, stop).indices(self.sizes[chrom])
+        starts, ends = self.runs[chrom]
+        if stop <= start:
+            return start, stop, starts, ends, 0, 0
+        return start, stop, starts, ends, np.searchsorted(ends, start, side="right"), np.searchsorted(starts, stop)
+
+    def contains_n(self, chrom, start, stop):
+        _, _, _, _, lo, hi = self._overlapping(chrom, start, stop)
+        return hi > lo
+
+    def count_n(self, chrom, start, stop):
+        start, stop, starts, ends, lo, hi = self._overlapping(chrom, start, stop)
+        return int(np.sum(np.minimum(ends[lo:hi], stop) - np.maximum(starts[lo:hi], start)))
+
+    def overlapping_runs(self, chrom, start, stop):
+        """
+        Returns a list of (start, stop) for each full run of N overlapping the region.
+        """
+        _, _, starts, ends, lo, hi = self._overlapping(chrom, start, stop)
+        return zip(starts[lo:hi].tolist(), ends[lo:hi].tolist())
+
+    def is_n(self, chrom, p):
+        """
+        Equivalent to seq_dict[chrom][p] == "N".
+        """
+        if p >= self.sizes[chrom]:
+            return False
+        if p < 0:
+            p += self.sizes[chrom]
+        return self.contains_n(chrom, p, p + 1)
+
+
+class SequenceNGaps(object):
+    """
+    Answers the contains_n, count_n and is_n queries of a NGapIndex by fetching the sequence, for sequence
+    dictionaries that have no N gap index, such as a pyfasta Fasta. See get_n_gap_index.
+    """
+    def __init__(self, seq_dict):
+        self.seq_dict = seq_dict
+
+    def contains_n(self, chrom, start, stop):
+        return "N" in self.seq_dict[chrom][start:stop]
+
+    def count_n(self, chrom, start, stop):
+        return self.seq_dict[chrom][start:stop].count("N")
+
+    def is_n(self, chrom, p):
+        return self.seq_dict[chrom][p] == "N"
+
+
+def get_n_gap_index(seq_dict):
+    """
+    Returns the N gap index of a sequence dictionary. Dictionaries that do not build one, such as a pyfasta Fasta, get
+    a SequenceNGaps that scans the sequence instead.
+    """
+    if hasattr(seq_dict, "get_n_gap_index"):
+        return seq_dict.get_n_gap_index()
+    return SequenceNGaps(seq_dict)
+
+
+def _merge_runs(starts, ends):
+    """
+    Merges sorted runs that abut each other.
+    """
+    if len(starts) == 0:
+        return starts, ends
+    separate = starts[1:] != ends[:-1]
+    return starts[np.r_[True, separate]], ends[np.r_[separate, True]]
+
+
+def _find_runs(data, value, chunk_size=2 ** 24):
+    """
+    Finds the [start, stop) runs of value in a uint8 array, working through it in chunks to bound memory.
+    """
+    starts, ends = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for offset in xrange(0, len(data), chunk_size):
+        is_value = np.zeros(min(chunk_size, len(data) - offset) + 2, dtype=np.int8)
+        is_value[1:-1] = data[offset:offset + chunk_size] == value
+        edges = np.diff(is_value)
+        starts.append(np.flatnonzero(edges == 1) + offset)
+        ends.append(np.flatnonzero(edges == -1) + offset)
+    return _merge_runs(np.concatenate(starts), np.concatenate(ends))
 
 
 class Transcript(object):
@@ -48,7 +326,7 @@ class Transcript(object):
 
     __slots__ = ('name', 'strand', 'score', 'thick_start', 'rgb', 'thick_stop', 'start', 'stop', 'intron_intervals',
                  'exon_intervals', 'exons', 'cds', 'mrna', 'block_sizes', 'block_starts', 'block_count', 'chromosome',
-                 'cds_size', 'transcript_size')
+                 'cds_size', 'transcript_size', '_exon_index')
 
     def __init__(self, bed_tokens):
         self.chromosome = bed_tokens[0]
@@ -354,6 +632,13 @@ class Transcript(object):
         sequence = seq_dict[self.chromosome]
         return sequence[self.start:self.stop]
 
+    def get_splice_sites(self, seq_dict, flank=2):
+        """
+        Returns a list of (donor, acceptor) sequences, one per intron in intron_intervals. See
+        ChromosomeInterval.get_splice_sites.
+        """
+        return [intron.get_splice_sites(seq_dict, flank) for intron in self.intron_intervals]
+
     def get_cds(self, seq_dict):
         """
         Return the CDS sequence (as a string) for the transcript
@@ -456,8 +741,8 @@ class Transcript(object):
         Will return None if this transcript coordinate is non-coding.
         Transcript/CDS coordinates are 0-based half open on 5'->3' transcript orientation.
         """
-        for exon in self.exons:
-            t = exon.transcript_pos_to_cds_pos(p)
+        for i in self.get_exon_index().transcript_candidates(p):
+            t = self.exons[i].transcript_pos_to_cds_pos(p)
             if t is not None:
                 return t
         return None
@@ -468,8 +753,8 @@ class Transcript(object):
         Take a look at the docstring in the Exon class method chromPosToTranscriptPos
         for details on how this works.
         """
-        for exon in self.exons:
-            t = exon.transcript_pos_to_chrom_pos(p)
+        for i in self.get_exon_index().transcript_candidates(p):
+            t = self.exons[i].transcript_pos_to_chrom_pos(p)
             if t is not None:
                 return t
         return None
@@ -480,8 +765,8 @@ class Transcript(object):
         coordinates. Transcript coordinates are 0-based half open on
         5'->3' transcript orientation.
         """
-        for exon in self.exons:
-            t = exon.chrom_pos_to_transcript_pos(p)
+        for i in self.get_exon_index().chromosome_candidates(p):
+            t = self.exons[i].chrom_pos_to_transcript_pos(p)
             if t is not None:
                 return t
         return None
@@ -491,8 +776,8 @@ class Transcript(object):
         Takes a chromosome-relative position and converts it to CDS coordinates.
         Will return None if this chromosome coordinate is not in the CDS.
         """
-        for exon in self.exons:
-            t = exon.chrom_pos_to_cds_pos(p)
+        for i in self.get_exon_index().chromosome_candidates(p):
+            t = self.exons[i].chrom_pos_to_cds_pos(p)
             if t is not None:
                 return t
         return None
@@ -501,8 +786,8 @@ class Transcript(object):
         """
         Takes a CDS-relative position and converts it to Transcript coordinates.
         """
-        for exon in self.exons:
-            t = exon.cds_pos_to_transcript_pos(p)
+        for i in self.get_exon_index().cds_candidates(p):
+            t = self.exons[i].cds_pos_to_transcript_pos(p)
             if t is not None:
                 return t
         return None
@@ -511,12 +796,61 @@ class Transcript(object):
         """
         Takes a CDS-relative position and converts it to Chromosome coordinates.
         """
-        for exon in self.exons:
-            t = exon.cds_pos_to_chrom_pos(p)
+        for i in self.get_exon_index().cds_candidates(p):
+            t = self.exons[i].cds_pos_to_chrom_pos(p)
             if t is not None:
                 return t
         return None
 
+    def get_exon_index(self):
+        """
+        Returns the ExonIndex used to find the exon a coordinate falls in. It is built the first time it is needed.
+        """
+        try:
+            return self._exon_index
+        except AttributeError:
+            self._exon_index = ExonIndex(self.exons)
+            return self._exon_index
+
+    def transcript_coordinates_to_chromosome(self, positions):
+        """
+        Vectorized transcript_coordinate_to_chromosome. Takes an array of positions and returns a numpy array of
+        the converted positions, with -1 wherever the scalar method would have returned None.
+        """
+        return self.get_exon_index().convert(positions, "transcript", "chromosome",
+                                             self.transcript_coordinate_to_chromosome)
+
+    def transcript_coordinates_to_cds(self, positions):
+        """
+        Vectorized transcript_coordinate_to_cds. See transcript_coordinates_to_chromosome.
+        """
+        return self.get_exon_index().convert(positions, "transcript", "cds", self.transcript_coordinate_to_cds)
+
+    def chromosome_coordinates_to_transcript(self, positions):
+        """
+        Vectorized chromosome_coordinate_to_transcript. See transcript_coordinates_to_chromosome.
+        """
+        return self.get_exon_index().convert(positions, "chromosome", "transcript",
+                                             self.chromosome_coordinate_to_transcript)
+
+    def chromosome_coordinates_to_cds(self, positions):
+        """
+        Vectorized chromosome_coordinate_to_cds. See transcript_coordinates_to_chromosome.
+        """
+        return self.get_exon_index().convert(positions, "chromosome", "cds", self.chromosome_coordinate_to_cds)
+
+    def cds_coordinates_to_transcript(self, positions):
+        """
+        Vectorized cds_coordinate_to_transcript. See transcript_coordinates_to_chromosome.
+        """
+        return self.get_exon_index().convert(positions, "cds", "transcript", self.cds_coordinate_to_transcript)
+
+    def cds_coordinates_to_chromosome(self, positions):
+        """
+        Vectorized cds_coordinate_to_chromosome. See transcript_coordinates_to_chromosome.
+        """
+        return self.get_exon_index().convert(positions, "cds", "chromosome", self.cds_coordinate_to_chromosome)
+
     def cds_coordinate_to_amino_acid(self, p, seq_dict):
         """
         Takes a CDS-relative position and a Fasta object that contains this
@@ -647,6 +981,42 @@ class GenePredTranscript(Transcript):
                 uid, name2, self.cds_start_stat, self.cds_end_stat, exon_frames]
 
 
+class LazyGenePredTranscript(GenePredTranscript):
+    """
+    A GenePredTranscript that only parses the scalar genePred fields when it is created. The exon and intron
+    intervals, Exon objects, sizes and block fields are built from the stored tokens the first time any of them is
+    accessed, so code that only needs names and coordinates does not pay for the full object.
+    """
+    __slots__ = ('_tokens',)
+    _lazy_slots = frozenset(['exon_intervals', 'intron_intervals', 'exons', 'cds_size', 'transcript_size',
+                             'exon_frames', 'block_sizes', 'block_starts'])
+
+    def __init__(self, gene_pred_tokens):
+        self.name = gene_pred_tokens[0]
+        self.chromosome = gene_pred_tokens[1]
+        self.strand = convert_strand(gene_pred_tokens[2])
+        self.score = 0
+        self.thick_start = int(gene_pred_tokens[5])
+        self.thick_stop = int(gene_pred_tokens[6])
+        self.start = int(gene_pred_tokens[3])
+        self.stop = int(gene_pred_tokens[4])
+        self.rgb = "128,0,0"
+        self.id = gene_pred_tokens[10]
+        self.name2 = gene_pred_tokens[11]
+        self.cds_start_stat = gene_pred_tokens[12]
+        self.cds_end_stat = gene_pred_tokens[13]
+        self.block_count = gene_pred_tokens[7]
+        self._tokens = gene_pred_tokens
+
+    def __getattr__(self, name):
+        # only called when a slot has not been set yet
+        if name in LazyGenePredTranscript._lazy_slots:
+            GenePredTranscript.__init__(self, self._tokens)
+            del self._tokens
+            return getattr(self, name)
+        raise AttributeError(name)
+
+
 class Exon(object):
     """
     An Exon object stores information about one exon in both
@@ -823,6 +1193,141 @@ class Exon(object):
             return t_pos
 
 
+class ExonIndex(object):
+    """
+    Sorted views of the exons of a transcript in transcript, chromosome and CDS coordinates. Used to find the exon
+    a position falls in by bisection instead of asking every exon in turn.
+
+    The candidate methods return the indices of the exons that can contain a position, in transcript order. This is
+    at most one exon unless the exons overlap in that coordinate space (malformed records), in which case every exon
+    is returned so that the first exon that accepts the position wins, just like a linear scan.
+
+    The CDS range of an exon is the set of CDS positions that Exon.cds_pos_to_transcript_pos accepts. Within it the
+    transcript position is the CDS position plus cds_offset, which is also the inverse of
+    Exon.transcript_pos_to_cds_pos.
+    """
+    __slots__ = ('strand', 'starts', 'stops', 'chrom_starts', 'chrom_stops', 'chrom_order', 'sorted_chrom_starts',
+                 'cds_order', 'sorted_cds_starts', 'cds_starts', 'cds_stops', 'cds_offsets', 'chrom_valid',
+                 'cds_valid', 'arrays')
+
+    def __init__(self, exons):
+        self.strand = exons[0].strand if len(exons) > 0 else True
+        self.starts = [e.start for e in exons]
+        self.stops = [e.stop for e in exons]
+        self.chrom_starts = [e.chrom_start for e in exons]
+        self.chrom_stops = [e.chrom_stop for e in exons]
+        self.chrom_order = sorted(xrange(len(exons)), key=lambda i: self.chrom_starts[i])
+        self.sorted_chrom_starts = [self.chrom_starts[i] for i in self.chrom_order]
+        self.chrom_valid = all(self.chrom_stops[i] <= self.chrom_starts[j] for i, j in
+                               izip(self.chrom_order, self.chrom_order[1:]))
+        # CDS range of each exon, empty for non-coding exons
+        self.cds_starts, self.cds_stops, self.cds_offsets = [], [], []
+        self.cds_valid = True
+        for e in exons:
+            if e.contains_cds() is False:
+                cds_start, cds_stop, offset = 0, 0, 0
+            elif e.cds_start is None and e.cds_pos is None:
+                cds_start, cds_stop, offset = 0, 0, 0
+                self.cds_valid = False
+            else:
+                offset = e.cds_start if e.cds_start is not None else e.start - e.cds_pos
+                t_start = e.start if e.cds_start is None else max(e.start, e.cds_start)
+                t_stop = e.stop if e.cds_stop is None else min(e.stop, e.cds_stop)
+                cds_start, cds_stop = t_start - offset, max(t_start, t_stop) - offset
+            self.cds_starts.append(cds_start)
+            self.cds_stops.append(cds_stop)
+            self.cds_offsets.append(offset)
+        self.cds_order = sorted((i for i in xrange(len(exons)) if self.cds_starts[i] < self.cds_stops[i]),
+                                key=lambda i: self.cds_starts[i])
+        self.sorted_cds_starts = [self.cds_starts[i] for i in self.cds_order]
+        self.cds_valid = self.cds_valid and all(self.cds_stops[i] <= self.cds_starts[j] for i, j in
+                                                izip(self.cds_order, self.cds_order[1:]))
+        self.arrays = None
+
+    def transcript_candidates(self, p):
+        """exons that can contain transcript position p. Transcript coordinates of exons never overlap."""
+        if p is None:
+            return []
+        i = bisect.bisect_right(self.starts, p) - 1
+        return [i] if i >= 0 and p < self.stops[i] else []
+
+    def chromosome_candidates(self, p):
+        """exons that can contain chromosome position p"""
+        if p is None:
+            return []
+        elif self.chrom_valid is False:
+            return xrange(len(self.starts))
+        j = bisect.bisect_right(self.sorted_chrom_starts, p) - 1
+        if j >= 0 and p < self.chrom_stops[self.chrom_order[j]]:
+            return [self.chrom_order[j]]
+        return []
+
+    def cds_candidates(self, p):
+        """exons that can contain CDS position p"""
+        if p is None:
+            return []
+        elif self.cds_valid is False:
+            return xrange(len(self.starts))
+        j = bisect.bisect_right(self.sorted_cds_starts, p) - 1
+        if j >= 0 and p < self.cds_stops[self.cds_order[j]]:
+            return [self.cds_order[j]]
+        return []
+
+    def _get_arrays(self):
+        if self.arrays is None:
+            self.arrays = {k: np.array(getattr(self, k), dtype=np.int64) for k in
+                           ['starts', 'stops', 'chrom_starts', 'chrom_stops', 'chrom_order', 'sorted_chrom_starts',
+                            'cds_order', 'sorted_cds_starts', 'cds_starts', 'cds_stops', 'cds_offsets']}
+        return self.arrays
+
+    def _lookup(self, p, sorted_starts, order, stops):
+        """
+        Vectorized bisection. Returns the exon index for each position and a mask of the positions found in an exon.
+        """
+        if len(sorted_starts) == 0:
+            return np.zeros(len(p), dtype=np.int64), np.zeros(len(p), dtype=bool)
+        j = np.searchsorted(sorted_starts, p, side="right") - 1
+        found = j >= 0
+        i = order[np.maximum(j, 0)] if order is not None else np.maximum(j, 0)
+        return i, found & (p < stops[i])
+
+    def convert(self, positions, source, dest, scalar_fn):
+        """
+        Converts an array of positions from source to dest coordinates, each being one of transcript, chromosome or
+        cds. Positions that can not be converted are -1. scalar_fn is the matching Transcript method, used if the
+        exons overlap.
+        """
+        p = np.asarray(positions, dtype=np.int64)
+        if (source == "chromosome" and self.chrom_valid is False) or self.cds_valid is False:
+            return np.array([-1 if x is None else x for x in map(scalar_fn, p.tolist())], dtype=np.int64)
+        a = self._get_arrays()
+        # first find the exon and transcript position
+        if source == "transcript":
+            i, found = self._lookup(p, a["starts"], None, a["stops"])
+            t = p
+        elif source == "chromosome":
+            i, found = self._lookup(p, a["sorted_chrom_starts"], a["chrom_order"], a["chrom_stops"])
+            if self.strand is True:
+                t = a["starts"][i] + p - a["chrom_starts"][i]
+            else:
+                t = a["starts"][i] + a["chrom_stops"][i] - 1 - p
+        else:
+            i, found = self._lookup(p, a["sorted_cds_starts"], a["cds_order"], a["cds_stops"])
+            t = p + a["cds_offsets"][i]
+        # then convert to the destination
+        if dest == "transcript":
+            r = t
+        elif dest == "chromosome":
+            if self.strand is True:
+                r = t + a["chrom_starts"][i] - a["starts"][i]
+            else:
+                r = a["chrom_stops"][i] + a["starts"][i] - 1 - t
+        else:
+            r = t - a["cds_offsets"][i]
+            found &= (r >= a["cds_starts"][i]) & (r < a["cds_stops"][i])
+        return np.where(found, r, -1)
+
+
 class ChromosomeInterval(object):
     """
     Represents an interval of a chromosome. BED coordinates, strand is True,
@@ -1015,6 +1520,21 @@ class ChromosomeInterval(object):
             return reverse_complement(seq_dict[self.chromosome][self.start:self.stop])
         assert False
 
+    def get_splice_sites(self, seq_dict, flank=2):
+        """
+        Returns the (donor, acceptor) sequences for this intron: the first and last flank bases of get_sequence,
+        in transcript orientation. Only those bases are read from seq_dict.
+        """
+        sequence = seq_dict[self.chromosome]
+        stop = min(self.stop, len(sequence))
+        left = sequence[self.start:min(self.start + flank, stop)]
+        right = sequence[max(stop - flank, self.start):stop]
+        if self.strand is True:
+            return left, right
+        if self.strand is False:
+            return reverse_complement(right), reverse_complement(left)
+        assert False
+
     def __repr__(self):
         return "ChromosomeInterval('{}', {}, {}, '{}')".format(self.chromosome, self.start, self.stop,
                                                                convert_strand(self.strand))
@@ -1162,20 +1682,75 @@ def find_offset(exon_frames, strand):
     return offset
 
 
+# vectorized form of _codon_table: every base is given a 4 bit code and a codon is looked up by its 12 bit index.
+# Bases that do not appear in _codon_table share a code that never matches, so their codons translate to ?
+_codon_alphabet = "ACGTNRYMH"
+_unknown_base_code = 15
+_base_codes = np.full(256, _unknown_base_code, dtype=np.int64)
+_base_codes[np.frombuffer(_codon_alphabet, dtype=np.uint8)] = np.arange(len(_codon_alphabet))
+
+
+def _build_codon_lookup():
+    lookup = np.full(16 ** 3, ord("?"), dtype=np.uint8)
+    for codon, amino_acid in _codon_table.iteritems():
+        if len(codon) == 3:
+            lookup[_codon_indices(_base_codes[np.frombuffer(codon, dtype=np.uint8)])] = ord(amino_acid)
+    return lookup
+
+
+def _codon_indices(codes, starts=0):
+    """
+    Returns the codon lookup index of each codon beginning at starts in an array of base codes.
+    """
+    return (codes[starts] << 8) | (codes[starts + 1] << 4) | codes[starts + 2]
+
+
+_codon_lookup = _build_codon_lookup()
+
+
 def translate_sequence(sequence):
     """
     Translates a given DNA sequence to single-letter amino acid
     space. If the sequence is not a multiple of 3 and is not a unique degenerate codon it will be truncated silently.
     """
+    return translate_sequences([sequence])[0]
+
+
+def translate_sequences(sequences):
+    """
+    Translates a batch of DNA sequences, following the same rules as translate_sequence. All sequences are encoded
+    into one array and translated with a single table lookup. Returns a list of protein sequences.
+    """
+    sequences = [str(x).upper() for x in sequences]
+    # pad each sequence to a whole number of codons. A trailing partial codon of 2 bases is kept if the N still
+    # gives an unambiguous amino acid, as codon_to_amino_acid would
+    padded = "".join(x + "N" * (-len(x) % 3) for x in sequences)
+    codes = _base_codes[np.frombuffer(padded, dtype=np.uint8)]
+    amino_acids = _codon_lookup[_codon_indices(codes, np.arange(0, len(codes), 3))].tostring()
     result = []
-    sequence = sequence.upper()
-    for i in xrange(0, len(sequence) - len(sequence) % 3, 3):
-        result.append(codon_to_amino_acid(sequence[i: i + 3]))
-    if len(sequence) % 3 == 2:
-        c = codon_to_amino_acid(sequence[i + 3:] + "N")
-        if c != "?":
-            result.append(c)
-    return "".join(result)
+    pos = 0
+    for sequence in sequences:
+        num_codons = len(sequence) // 3
+        protein = amino_acids[pos:pos + num_codons]
+        if len(sequence) % 3 == 2 and amino_acids[pos + num_codons] != "?":
+            protein += amino_acids[pos + num_codons]
+        result.append(protein)
+        pos += (len(sequence) + 2) // 3
+    return result
+
+
+def find_in_frame_stops(seq, offset=0, skip_last=True):
+    """
+    Returns the start positions of the stop codons among the codons that read_codons_with_position would yield.
+    """
+    seq = str(seq)
+    l = len(seq)
+    if skip_last:
+        l -= 3
+    starts = np.arange(offset, l - l % 3, 3)
+    starts = starts[starts + 3 <= len(seq)]
+    codes = _base_codes[np.frombuffer(seq, dtype=np.uint8)]
+    return starts[_codon_lookup[_codon_indices(codes, starts)] == ord("*")].tolist()
 
 
 def read_codons(seq, offset=0, skip_last=True):
@@ -1201,23 +1776,446 @@ def read_codons_with_position(seq, offset=0, skip_last=True):
             yield i, seq[i:i + 3]
 
 
-def get_sequence_dict(file_path, upper=True):
+def get_sequence_dict(file_path, upper=True, cache_dir=None):
     """
-    Returns a dictionary of fasta records. If upper is true, all bases will be uppercased.
+    Returns a dictionary of fasta records. If upper is true, all bases will be uppercased and the records come from
+    a GenomeStore, which caches the files it derives from the fasta in cache_dir. Otherwise a pyfasta Fasta object is
+    returned, which needs the fasta to have been flattened. A .2bit file is read directly with a TwoBitFile in either
+    case.
     """
+    if is_two_bit(file_path):
+        return TwoBitFile(file_path, upper=upper)
+    if upper is True:
+        return GenomeStore(file_path, cache_dir)
     gdx_path = file_path + ".gdx"
     assert os.path.exists(gdx_path), ("Error: gdx does not exist for this fasta. We need the fasta files to be "
                                      "flattened in place prior to running the pipeline because of concurrency issues.")
-    if upper is True:
-        return Fasta(file_path, record_class=UpperNpyFastaRecord)
-    else:
-        return Fasta(file_path)
+    return Fasta(file_path)
+
+
+def get_genome_sequence(file_path):
+    """
+    Returns the case-preserving sequence dictionary used by the augustus and CGP scripts: a TwoBitFile for .2bit
+    files and a pyfasta Fasta object otherwise.
+    """
+    if is_two_bit(file_path):
+        return TwoBitFile(file_path, upper=False)
+    return Fasta(file_path)
+
+
+def fasta_iterator(fasta_path):
+    """
+    Yields (name, list of sequence lines) for each record of a fasta file. Names are the full header line, as
+    pyfasta names them.
+    """
+    name, lines = None, None
+    with open(fasta_path) as inf:
+        for line in inf:
+            line = line.rstrip()
+            if not line:
+                continue
+            elif line[0] == ">":
+                if name is not None:
+                    yield name, lines
+                name, lines = line[1:].strip(), []
+            else:
+                lines.append(line)
+    if name is not None:
+        yield name, lines
+
+
+def build_genome_store(fasta_path, cache_dir=None):
+    """
+    Returns the uppercased sequence of every record of a fasta file as one flat uint8 array, along with an index
+    mapping each name to its (start, stop) in the array.
+
+    If cache_dir is given, the array is written there as a flat file named by cache_file_path, with an index sidecar,
+    and memory mapped. Nothing is written if both files exist, and a changed fasta gets new files. Both files are
+    written to temporary files and moved into place, so concurrent jobs can call this safely. If cache_dir is None,
+    or the files can not be written, the array is built in memory instead.
+    """
+    if cache_dir is None:
+        return _read_genome_store(fasta_path)
+    store_path = cache_file_path(fasta_path, cache_dir, ".upper")
+    idx_path = store_path + ".idx"
+    if not (os.path.exists(idx_path) and os.path.exists(store_path)):
+        suffix = ".{}.{}.tmp".format(os.getpid(), os.urandom(4).encode("hex"))
+        try:
+            mkdir_p(cache_dir)
+            with open(store_path + suffix, "wb") as outf:
+                index = _write_upper_sequence(fasta_path, outf.write)
+            with open(idx_path + suffix, "wb") as outf:
+                cPickle.dump(index, outf, cPickle.HIGHEST_PROTOCOL)
+            os.rename(store_path + suffix, store_path)
+            os.rename(idx_path + suffix, idx_path)
+        except (IOError, OSError):
+            for path in [store_path + suffix, idx_path + suffix]:
+                if os.path.exists(path):
+                    os.remove(path)
+            return _read_genome_store(fasta_path)
+    with open(idx_path, "rb") as inf:
+        index = cPickle.load(inf)
+    if os.path.getsize(store_path) == 0:
+        return np.zeros(0, dtype=np.uint8), index
+    return np.memmap(store_path, dtype=np.uint8, mode="r"), index
+
+
+def _read_genome_store(fasta_path):
+    """
+    Builds the array and index of build_genome_store in memory.
+    """
+    data = bytearray()
+    index = _write_upper_sequence(fasta_path, data.extend)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint8), index
+    return np.frombuffer(data, dtype=np.uint8), index
+
+
+def _write_upper_sequence(fasta_path, write):
+    """
+    Passes the uppercased sequence of every record of a fasta file to write, in order. Returns a dict mapping each
+    name to the (start, stop) of its sequence in the output.
+    """
+    index = {}
+    pos = 0
+    for name, lines in fasta_iterator(fasta_path):
+        assert name not in index, "Duplicate fasta header {} in {}".format(name, fasta_path)
+        start = pos
+        for line in lines:
+            write(line.upper())
+            pos += len(line)
+        index[name] = (start, pos)
+    return index
+
+
+def build_n_gap_index(fasta_path, cache_dir=None):
+    """
+    Returns a NGapIndex of the runs of N in a fasta file, found from its GenomeStore. If cache_dir is given, the index
+    is cached there in the same way as the genePred cache, and only rebuilt when the fasta changes.
+    """
+    cache_path = None if cache_dir is None else cache_file_path(fasta_path, cache_dir, ".ngaps.npz")
+    key = np.array(_file_cache_key(fasta_path))
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if np.array_equal(cache["key"], key):
+                    return _unpack_n_gap_index({k: cache[k] for k in cache.files})
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+    store = GenomeStore(fasta_path, cache_dir)
+    names = sorted(store)
+    runs = [_find_runs(store[name].get_array(), ord("N")) for name in names]
+    empty = [np.zeros(0, dtype=np.int64)]
+    arrays = {"names": np.array(names, dtype=str), "sizes": np.array([len(store[x]) for x in names], dtype=np.int64),
+              "offsets": np.cumsum([0] + [len(x[0]) for x in runs]),
+              "starts": np.concatenate(empty + [x[0] for x in runs]),
+              "ends": np.concatenate(empty + [x[1] for x in runs])}
+    if cache_path is not None:
+        _write_npz_cache(cache_path, key=key, **arrays)
+    return _unpack_n_gap_index(arrays)
+
+
+def _unpack_n_gap_index(arrays):
+    names, sizes, offsets = arrays["names"].tolist(), arrays["sizes"].tolist(), arrays["offsets"].tolist()
+    runs = {name: (arrays["starts"][offsets[i]:offsets[i + 1]], arrays["ends"][offsets[i]:offsets[i + 1]])
+            for i, name in enumerate(names)}
+    return NGapIndex(dict(zip(names, sizes)), runs)
+
+
+def get_transcript_dict(gp_file, cache_dir=None):
+    """
+    Convenience function for creating transcript dictionaries. The genePred is parsed into columns, which are cached
+    in cache_dir if given, and transcripts are only built from the columns when they are first accessed.
+    """
+    return TranscriptDict(load_gene_pred_columns(gp_file, cache_dir))
+
+
+_gp_cache_version = "1"
+_gp_text_columns = ["names", "chroms", "strands", "ids", "name2s", "cds_start_stats", "cds_end_stats"]
+_gp_int_columns = ["starts", "stops", "thick_starts", "thick_stops"]
+_gp_exon_columns = ["exon_starts", "exon_ends", "exon_frames"]
+
+
+def _file_cache_key(path):
+    """
+    Identifies a specific version of a file by absolute path, modification time and size.
+    """
+    st = os.stat(path)
+    return [os.path.abspath(path), repr(st.st_mtime), str(st.st_size)]
+
+
+def cache_file_path(path, cache_dir, suffix):
+    """
+    Returns the path in cache_dir of a file derived from the input file path. The name holds a hash of the path, size
+    and modification time of the input, so the input directory is never written to and a changed input gets a new
+    cache file.
+    """
+    digest = hashlib.sha1(repr(_file_cache_key(path))).hexdigest()[:16]
+    return os.path.join(cache_dir, "{}.{}{}".format(os.path.basename(path), digest, suffix))
+
+
+def _write_npz_cache(cache_path, **arrays):
+    """
+    Writes a numpy archive to a temporary file and moves it into place, so that concurrent jobs never see a partial
+    cache. If the cache can not be written nothing is done.
+    """
+    tmp_path = "{}.{}.{}.tmp".format(cache_path, os.getpid(), os.urandom(4).encode("hex"))
+    try:
+        mkdir_p(os.path.dirname(cache_path))
+        with open(tmp_path, "wb") as outf:
+            np.savez(outf, **arrays)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def parse_gene_pred_columns(gp_file):
+    """
+    Parses a genePred file into a dict of numpy arrays, one per field. Exon fields are stored flattened with
+    exon_offsets marking where each transcript's exons begin, so the exons of row i are
+    exon_starts[exon_offsets[i]:exon_offsets[i + 1]].
+    """
+    columns = read_tsv_columns(gp_file, 15, int_columns=[3, 4, 5, 6], list_columns=[8, 9, 14])
+    r = {c: np.array(columns[i], dtype=str) for c, i in izip(_gp_text_columns, [0, 1, 2, 10, 11, 12, 13])}
+    r.update({c: columns[i] for c, i in izip(_gp_int_columns, [3, 4, 5, 6])})
+    r.update({c: columns[i][0] for c, i in izip(_gp_exon_columns, [8, 9, 14])})
+    r["exon_offsets"] = columns[8][1]
+    return r
+
+
+def load_gene_pred_columns(gp_file, cache_dir=None):
+    """
+    Returns the parsed columns of a genePred file (see parse_gene_pred_columns). If cache_dir is given, the columns
+    are read from a binary cache in cache_dir if it is current. Otherwise the file is parsed and the cache is
+    (re)written. If cache_dir is not writable the parsed columns are returned without caching.
+    """
+    if cache_dir is None:
+        return parse_gene_pred_columns(gp_file)
+    cache_path = cache_file_path(gp_file, cache_dir, ".cache.npz")
+    key = np.array([_gp_cache_version] + _file_cache_key(gp_file))
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if np.array_equal(cache["key"], key):
+                    return {k: cache[k] for k in cache.files if k != "key"}
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+    cols = parse_gene_pred_columns(gp_file)
+    _write_npz_cache(cache_path, key=key, **cols)
+    return cols
+
+
+class TranscriptDict(collections.MutableMapping):
+    """
+    Dictionary of transcript name to GenePredTranscript backed by the columns produced by parse_gene_pred_columns.
+    Each transcript is built as a LazyGenePredTranscript the first time it is accessed and kept afterwards.
+    Supports the normal dict operations, including assignment and deletion.
+    """
+    def __init__(self, cols):
+        self.cols = cols
+        self.rows = {n: i for i, n in enumerate(cols["names"].tolist())}
+        self.transcripts = {}
+
+    def _build(self, i):
+        return LazyGenePredTranscript(_gene_pred_tokens(self.cols, i))
+
+    def __getitem__(self, name):
+        if name not in self.transcripts:
+            self.transcripts[name] = self._build(self.rows[name])
+        return self.transcripts[name]
+
+    def __setitem__(self, name, t):
+        self.transcripts[name] = t
+        self.rows.setdefault(name, None)
 
-def get_transcript_dict(gp_file):
+    def __delitem__(self, name):
+        del self.rows[name]
+        self.transcripts.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def viewkeys(self):
+        return self.rows.viewkeys()
+
+
+def _gene_pred_tokens(cols, i):
+    """
+    Rebuilds the genePred tokens of row i of the columns produced by parse_gene_pred_columns.
+    """
+    exons = slice(cols["exon_offsets"][i], cols["exon_offsets"][i + 1])
+    join = lambda x: ",".join(map(str, x[exons].tolist())) + ","
+    tokens = [cols["names"][i], cols["chroms"][i], cols["strands"][i], cols["starts"][i], cols["stops"][i],
+              cols["thick_starts"][i], cols["thick_stops"][i], exons.stop - exons.start, join(cols["exon_starts"]),
+              join(cols["exon_ends"]), cols["ids"][i], cols["name2s"][i], cols["cds_start_stats"][i],
+              cols["cds_end_stats"][i], join(cols["exon_frames"])]
+    return map(str, tokens)
+
+
+def get_transcript_table(gp_file, cache_dir=None):
+    """
+    Convenience function for creating a TranscriptTable. Uses the same binary cache as get_transcript_dict.
+    """
+    return TranscriptTable(load_gene_pred_columns(gp_file, cache_dir))
+
+
+class TranscriptTable(object):
+    """
+    A whole genePred held as flat numpy arrays instead of a dict of transcript objects. Chromosomes are stored as
+    codes into the sorted array chromosomes and exons are stored CSR style, so the exons of row i are
+    exon_starts[exon_offsets[i]:exon_offsets[i + 1]]. Indexing the table by name returns a TranscriptView.
+    The methods returning one value per row allow filtering the whole set at once.
+    """
+    def __init__(self, cols):
+        self.cols = cols
+        self.names = cols["names"]
+        self.chromosomes, self.chrom_codes = np.unique(cols["chroms"], return_inverse=True)
+        self.strands = cols["strands"] == "+"
+        self.starts = cols["starts"]
+        self.stops = cols["stops"]
+        self.thick_starts = cols["thick_starts"]
+        self.thick_stops = cols["thick_stops"]
+        self.exon_offsets = cols["exon_offsets"]
+        self.exon_starts = cols["exon_starts"]
+        self.exon_ends = cols["exon_ends"]
+        self.exon_frames = cols["exon_frames"]
+        self.rows = {n: i for i, n in enumerate(self.names.tolist())}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names.tolist())
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        return TranscriptView(self, self.rows[name])
+
+    def iteritems(self):
+        for i, name in enumerate(self.names.tolist()):
+            yield name, TranscriptView(self, i)
+
+    def row_chromosomes(self):
+        return self.chromosomes[self.chrom_codes]
+
+    def exon_counts(self):
+        return np.diff(self.exon_offsets)
+
+    def exon_rows(self):
+        """
+        Returns the row of each exon.
+        """
+        return np.repeat(np.arange(len(self)), self.exon_counts())
+
+    def transcript_sizes(self):
+        return np.bincount(self.exon_rows(), weights=self.exon_ends - self.exon_starts,
+                           minlength=len(self)).astype(np.int64)
+
+    def cds_sizes(self):
+        """
+        Vectorized Transcript.cds_size: the number of exonic bases between thick_start and thick_stop.
+        """
+        rows = self.exon_rows()
+        thick_starts, thick_stops = self.thick_starts[rows], self.thick_stops[rows]
+        overlap = np.minimum(self.exon_ends, thick_stops) - np.maximum(self.exon_starts, thick_starts)
+        # an exon containing a reversed thick region is counted as is, matching Transcript._get_cds_size
+        reversed_thick = (self.exon_starts <= thick_starts) & (thick_stops <= self.exon_ends)
+        overlap = np.where(reversed_thick, overlap, np.maximum(overlap, 0))
+        return np.bincount(rows, weights=overlap, minlength=len(self)).astype(np.int64)
+
+    def is_coding(self):
+        return self.cds_sizes() > 0
+
+
+class TranscriptView(object):
     """
-    Convenience function for creating transcript dictionaries
+    One row of a TranscriptTable. Exposes the fields of a GenePredTranscript, read from the table. Anything else,
+    such as the Exon objects and coordinate conversions, is looked up on a LazyGenePredTranscript built on first use.
     """
-    return {n: t for n, t in transcript_iterator(gp_file)}
+    __slots__ = ('table', 'row', '_transcript')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+        self._transcript = None
+
+    @property
+    def name(self):
+        return str(self.table.names[self.row])
+
+    @property
+    def chromosome(self):
+        return str(self.table.chromosomes[self.table.chrom_codes[self.row]])
+
+    @property
+    def strand(self):
+        return bool(self.table.strands[self.row])
+
+    @property
+    def start(self):
+        return int(self.table.starts[self.row])
+
+    @property
+    def stop(self):
+        return int(self.table.stops[self.row])
+
+    @property
+    def thick_start(self):
+        return int(self.table.thick_starts[self.row])
+
+    @property
+    def thick_stop(self):
+        return int(self.table.thick_stops[self.row])
+
+    @property
+    def id(self):
+        return str(self.table.cols["ids"][self.row])
+
+    @property
+    def name2(self):
+        return str(self.table.cols["name2s"][self.row])
+
+    @property
+    def _exons(self):
+        return slice(self.table.exon_offsets[self.row], self.table.exon_offsets[self.row + 1])
+
+    @property
+    def exon_frames(self):
+        return self.table.exon_frames[self._exons].tolist()
+
+    @property
+    def exon_intervals(self):
+        exons = self._exons
+        return [ChromosomeInterval(self.chromosome, start, stop, self.strand) for start, stop in
+                izip(self.table.exon_starts[exons].tolist(), self.table.exon_ends[exons].tolist())]
+
+    @property
+    def transcript_size(self):
+        exons = self._exons
+        return int(np.sum(self.table.exon_ends[exons] - self.table.exon_starts[exons]))
+
+    def __len__(self):
+        return self.transcript_size
+
+    def get_transcript(self):
+        """
+        Returns this row as a LazyGenePredTranscript.
+        """
+        if self._transcript is None:
+            self._transcript = LazyGenePredTranscript(_gene_pred_tokens(self.table.cols, self.row))
+        return self._transcript
+
+    def __getattr__(self, name):
+        return getattr(self.get_transcript(), name)
 
 
 def transcript_iterator(gp_file):
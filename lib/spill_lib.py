@@ -0,0 +1,217 @@
+"""
+Columnar on-disk format for classifier and attribute results.
+
+Each classifier dumps a dict of ID -> value per database. Instead of pickling these dicts, every column is written as
+a directory of numpy arrays holding the sorted IDs and a typed value array. Strings (the IDs, and the BED records in
+the details database) are stored as one concatenated buffer plus offsets. A SpilledColumn memory maps these arrays,
+so that the columns of a database can be merged on their IDs and written out a batch of rows at a time without
+loading any of them.
+"""
+import os
+import heapq
+import shutil
+import cPickle as pickle
+from itertools import izip
+import numpy as np
+
+__author__ = "Ian Fiddes"
+
+
+def _value_kind(values):
+    """
+    Determines how a list of values will be stored. Anything that is not uniformly bool, int, float or str is pickled.
+    """
+    types = {type(x) for x in values}
+    if len(types) == 0:
+        return "int"
+    elif len(types) > 1:
+        return "pickle"
+    t = types.pop()
+    return {bool: "bool", int: "int", float: "float", str: "str"}.get(t, "pickle")
+
+
+def _pack_strings(values):
+    """
+    Packs a list of strings into a single uint8 buffer and an offset array.
+    """
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in values], out=offsets[1:])
+    return np.frombuffer("".join(values), dtype=np.uint8), offsets
+
+
+def _unpack_strings(data, offsets, start=0, stop=None):
+    """
+    Unpacks the strings start to stop of a packed string array.
+    """
+    offsets = offsets[start:None if stop is None else stop + 1].tolist()
+    if len(offsets) < 2:
+        return []
+    base = offsets[0]
+    data = data[base:offsets[-1]].tostring()
+    return [data[offsets[i] - base:offsets[i + 1] - base] for i in xrange(len(offsets) - 1)]
+
+
+def _save_arrays(arrays, path):
+    """
+    Writes a column as one .npy file per array in the directory path, replacing any column already there.
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(path, name + ".npy"), array)
+
+
+def _load_arrays(path, mmap=False):
+    """
+    Loads the arrays of a column written by _save_arrays, memory mapping them if mmap is True.
+    """
+    arrays = {}
+    for f in os.listdir(path):
+        name = os.path.splitext(f)[0]
+        arrays[name] = np.load(os.path.join(path, f), mmap_mode="r" if mmap is True and name != "kind" else None)
+    return arrays
+
+
+def write_column(results_dict, path):
+    """
+    Writes a results dict to path in the columnar spill format.
+    """
+    ids = sorted(results_dict.iterkeys())
+    values = [results_dict[x] for x in ids]
+    kind = _value_kind(values)
+    arrays = {"kind": np.array(kind)}
+    arrays["ids_data"], arrays["ids_offsets"] = _pack_strings(ids)
+    if kind == "str":
+        arrays["values_data"], arrays["values_offsets"] = _pack_strings(values)
+    elif kind == "pickle":
+        arrays["values_data"] = np.frombuffer(pickle.dumps(values, pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+    else:
+        arrays["values"] = np.array(values, dtype={"bool": np.bool_, "int": np.int64, "float": np.float64}[kind])
+    _save_arrays(arrays, path)
+
+
+class SpilledColumn(object):
+    """
+    A column written by write_column. The arrays are memory mapped and only the rows asked for are unpacked, except
+    for pickled columns, which are loaded on first use.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.arrays = _load_arrays(path, mmap=True)
+        self.kind = str(self.arrays["kind"])
+        self.pickled_values = None
+
+    def __len__(self):
+        return len(self.arrays["ids_offsets"]) - 1
+
+    def ids(self, start=0, stop=None):
+        return _unpack_strings(self.arrays["ids_data"], self.arrays["ids_offsets"], start, stop)
+
+    def values(self, start=0, stop=None):
+        """
+        Returns the values start to stop as a list of python objects.
+        """
+        if self.kind == "str":
+            return _unpack_strings(self.arrays["values_data"], self.arrays["values_offsets"], start, stop)
+        elif self.kind == "pickle":
+            if self.pickled_values is None:
+                self.pickled_values = pickle.loads(self.arrays["values_data"].tostring())
+            return self.pickled_values[start:stop]
+        return self.arrays["values"][start:stop].tolist()
+
+    def iteritems(self, batch_size=10000):
+        """
+        Yields (ID, value) pairs sorted by ID, unpacking batch_size rows at a time.
+        """
+        for i in xrange(0, len(self), batch_size):
+            for item in izip(self.ids(i, i + batch_size), self.values(i, i + batch_size)):
+                yield item
+
+
+def read_column(path):
+    """
+    Reads a column written by write_column. Returns a sorted list of IDs and a matching list of values.
+    """
+    column = SpilledColumn(path)
+    return column.ids(), column.values()
+
+
+def read_column_dict(path):
+    """
+    Reads a column written by write_column back into a dict.
+    """
+    ids, values = read_column(path)
+    return dict(izip(ids, values))
+
+
+def spilled_columns(data_path):
+    """
+    Returns a dict of column name -> SpilledColumn for every column found in data_path.
+    """
+    return {col: SpilledColumn(os.path.join(data_path, col)) for col in os.listdir(data_path)}
+
+
+def _concat_strings(packed):
+    """
+    Concatenates several (data, offsets) packed string arrays into one.
+    """
+    data = np.concatenate([x[0] for x in packed])
+    shifts = np.cumsum([0] + [len(x[0]) for x in packed[:-1]])
+    offsets = np.concatenate([[0]] + [x[1][1:] + shift for x, shift in zip(packed, shifts)]).astype(np.int64)
+    return data, offsets
+
+
+def _take_strings(data, offsets, order):
+    """
+    Reorders a packed string array without unpacking it.
+    """
+    starts = offsets[:-1][order]
+    sizes = offsets[1:][order] - starts
+    new_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=new_offsets[1:])
+    positions = np.arange(new_offsets[-1], dtype=np.int64) + np.repeat(starts - new_offsets[:-1], sizes)
+    return data[positions], new_offsets
+
+
+def _tagged_ids(ids, start):
+    for i, x in enumerate(ids):
+        yield x, start + i
+
+
+def merge_column_files(paths, out_path):
+    """
+    Merges several column files for the same column with disjoint IDs into one column file at out_path.
+
+    Every file is already sorted by ID, so the merged order is found by a streaming merge of the IDs. The packed
+    arrays are then concatenated and reordered directly, without building a dict of the column.
+    """
+    columns = [_load_arrays(p) for p in paths]
+    # an empty column has no values to type, so it is always written as int and must not decide the merged kind
+    columns = [x for x in columns if len(x["ids_offsets"]) > 1] or columns[:1]
+    kinds = {str(x["kind"]) for x in columns}
+    if len(kinds) > 1:
+        # shards that inferred different kinds fall back to the general writer
+        merged = {}
+        for p in paths:
+            merged.update(read_column_dict(p))
+        write_column(merged, out_path)
+        return
+    kind = kinds.pop()
+    file_ids = [_unpack_strings(x["ids_data"], x["ids_offsets"]) for x in columns]
+    starts = np.cumsum([0] + [len(x) for x in file_ids[:-1]])
+    merged = heapq.merge(*[_tagged_ids(ids, start) for ids, start in zip(file_ids, starts)])
+    order = np.fromiter((i for _, i in merged), dtype=np.int64, count=sum(len(x) for x in file_ids))
+    arrays = {"kind": np.array(kind)}
+    data, offsets = _concat_strings([(x["ids_data"], x["ids_offsets"]) for x in columns])
+    arrays["ids_data"], arrays["ids_offsets"] = _take_strings(data, offsets, order)
+    if kind == "str":
+        data, offsets = _concat_strings([(x["values_data"], x["values_offsets"]) for x in columns])
+        arrays["values_data"], arrays["values_offsets"] = _take_strings(data, offsets, order)
+    elif kind == "pickle":
+        values = [v for x in columns for v in pickle.loads(x["values_data"].tostring())]
+        arrays["values_data"] = np.frombuffer(pickle.dumps([values[i] for i in order], pickle.HIGHEST_PROTOCOL),
+                                              dtype=np.uint8)
+    else:
+        arrays["values"] = np.concatenate([x["values"] for x in columns])[order]
+    _save_arrays(arrays, out_path)
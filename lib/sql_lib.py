@@ -3,10 +3,14 @@ Convenience library for interfacing with a sqlite database.
 """
 import os
 import sys
+import heapq
+import itertools
 import lib.psl_lib as psl_lib
 import lib.general_lib as general_lib
+import lib.cache_lib as cache_lib
 from collections import defaultdict
 import sqlite3 as sql
+import numpy as np
 import pandas as pd
 import etc.config
 
@@ -14,13 +18,19 @@ __author__ = "Ian Fiddes"
 
 
 class ExclusiveSqlConnection(object):
-    """meant to be used with a with statement to ensure proper closure"""
-    def __init__(self, path, timeout=1200):
+    """
+    meant to be used with a with statement to ensure proper closure. pragmas is an optional list of PRAGMA statements
+    that are executed before the exclusive transaction begins.
+    """
+    def __init__(self, path, timeout=1200, pragmas=None):
         self.path = path
         self.timeout = timeout
+        self.pragmas = pragmas if pragmas is not None else []
 
     def __enter__(self):
         self.con = sql.connect(self.path, timeout=self.timeout, isolation_level="EXCLUSIVE")
+        for pragma in self.pragmas:
+            self.con.execute(pragma)
         try:
             self.con.execute("BEGIN EXCLUSIVE")
         except sql.OperationalError:
@@ -63,6 +73,9 @@ def attach_databases(comp_ann_path, mode):
         attach_database(con, aug_classify_path, "augustus")
         attach_database(con, aug_details_path, "augustus_details")
         attach_database(con, aug_attributes_path, "augustus_attributes")
+    eval_path = os.path.join(comp_ann_path, "evaluation.db")
+    if mode in ["augustus", "transMap"] and os.path.exists(eval_path):
+        attach_database(con, eval_path, "evaluation")
     return con, cur
 
 
@@ -205,7 +218,7 @@ def get_transcript_gene_map(cur, ref_genome, biotype=None, filter_chroms=None):
             query += " AND "
         query += add
     query = query.format(ref_genome, biotype)
-    return get_query_dict(cur, query)
+    return cache_lib.cached_result(cur, [["attributes", ref_genome]], query, get_query_dict, cur, query)
 
 
 def get_gene_transcript_map(cur, ref_genome, biotype=None, filter_chroms=None):
@@ -224,7 +237,7 @@ def get_gene_transcript_map(cur, ref_genome, biotype=None, filter_chroms=None):
             query += " AND "
         query += add
     query = query.format(ref_genome, biotype)
-    return get_non_unique_query_dict(cur, query)
+    return cache_lib.cached_result(cur, [["attributes", ref_genome]], query, get_non_unique_query_dict, cur, query)
 
 
 def get_gene_biotype_map(cur, ref_genome):
@@ -240,7 +253,7 @@ def get_transcript_biotype_map(cur, ref_genome):
     Returns a dictionary mapping all transcript IDs to their respective biotypes
     """
     query = "SELECT transcriptId,transcriptType FROM attributes.'{}'".format(ref_genome)
-    return get_query_dict(cur, query)
+    return cache_lib.cached_result(cur, [["attributes", ref_genome]], query, get_query_dict, cur, query)
 
 
 def get_fail_passing_excel_ids(cur, ref_genome, genome, biotype, best_cov_only=True, filter_chroms=None,
@@ -249,8 +262,6 @@ def get_fail_passing_excel_ids(cur, ref_genome, genome, biotype, best_cov_only=T
     Returns the IDs categorized as fail, passing_specific, excellent. You can set the best_cov_only flag to only report
     those transcripts with highest coverage. You can also excellent a premade highest_cov_dict to save computation time.
     """
-    passing_query = etc.config.transMapEval(ref_genome, genome, biotype, passing=True)
-    excellent_query = etc.config.transMapEval(ref_genome, genome, biotype, passing=False)
     if best_cov_only is True:
         if highest_cov_dict is None:
             best_covs = highest_cov_aln(cur, genome)
@@ -262,22 +273,249 @@ def get_fail_passing_excel_ids(cur, ref_genome, genome, biotype, best_cov_only=T
             def __contains__(_, __):
                 return True
         best_ids = Universe()
-    passing_ids = {x for x in get_query_ids(cur, passing_query) if x in best_ids}
-    excellent_ids = {x for x in get_query_ids(cur, excellent_query) if x in best_ids}
-    all_ids = {x for x in get_biotype_aln_ids(cur, genome, biotype) if x in best_ids}
-    fail_ids = all_ids - (passing_ids | excellent_ids)
-    passing_specific_ids = passing_ids - excellent_ids
-    return fail_ids, passing_specific_ids, excellent_ids
+    ids = {"Fail": set(), "Pass": set(), "Excellent": set()}
+    for aln_id, tm_eval in get_transmap_eval(cur, ref_genome, genome, biotype).iteritems():
+        if aln_id in best_ids:
+            ids[tm_eval].add(aln_id)
+    return ids["Fail"], ids["Pass"], ids["Excellent"]
+
+
+def get_transmap_eval(cur, ref_genome, genome, biotype=None):
+    """
+    Returns a dict mapping each alignment ID of this biotype to Excellent, Pass or Fail, read from the evaluation table
+    built by write_transmap_eval. If biotype is None, every alignment whose transcript and gene biotypes agree is
+    returned. The evaluation table is built first if it is missing.
+    """
+    databases = {name: path for _, name, path in cur.execute("PRAGMA database_list").fetchall()}
+    if "evaluation" not in databases or genome not in get_table_names(cur, "evaluation"):
+        comp_ann_path = os.path.dirname(databases["main"])
+        write_transmap_eval(comp_ann_path, ref_genome, genome)
+        if "evaluation" not in databases:
+            attach_database(cur.connection, os.path.join(comp_ann_path, "evaluation.db"), "evaluation")
+    query = "SELECT AlignmentId,TransMapEval FROM evaluation.'{0}' WHERE "
+    if biotype is None:
+        query += "TranscriptType = GeneType"
+    else:
+        query += "TranscriptType = '{1}' AND GeneType = '{1}'"
+    return get_query_dict(cur, query.format(genome, biotype))
 
 
-def write_dict(data_dict, database_path, table, index_label="AlignmentId"):
+def write_transmap_eval(comp_ann_path, ref_genome, genome):
     """
-    Writes a dict of dicts to a sqlite database.
+    Evaluates every transMap alignment of genome against the reference once and writes the results to evaluation.db,
+    with the transcript ID and biotypes of each alignment. The classify and attributes databases of both genomes
+    must already be built.
     """
-    df = pd.DataFrame.from_dict(data_dict)
-    df = df.sort_index()
-    with ExclusiveSqlConnection(database_path) as con:
-        df.to_sql(table, con, if_exists="replace", index_label=index_label)
+    con, cur = attach_databases(comp_ann_path, mode="transMap")
+    rows = execute_query(cur, etc.config.transMapEvalTable(ref_genome, genome)).fetchall()
+    con.close()
+    columns = ["TranscriptId", "TranscriptType", "GeneType", "TransMapEval"]
+    data_dict = {col: {r[0]: r[i] for r in rows} for i, col in enumerate(columns, 1)}
+    write_dict(data_dict, os.path.join(comp_ann_path, "evaluation.db"), genome)
+
+
+def get_table_names(cur, db="main"):
+    """
+    Returns the set of tables in the database attached as db, leaving out the internal sqlite tables and the table
+    generations recorded by cache_lib.
+    """
+    query = "SELECT name FROM {}.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'".format(db)
+    return {x[0] for x in cur.execute(query)} - {cache_lib.generation_table}
+
+
+def find_transmap_genomes(comp_ann_path):
+    """
+    Finds the reference genome and the transMap genomes that have classify and attributes tables in comp_ann_path.
+    The reference attributes table is the one without an AlignmentId column. The reference genome is None if it can't
+    be determined.
+    """
+    con, cur = attach_databases(comp_ann_path, mode="reference")
+    classify_tables = get_table_names(cur)
+    ref_genomes = []
+    genomes = []
+    for table in get_table_names(cur, "attributes") & classify_tables:
+        columns = {x[1] for x in cur.execute("PRAGMA attributes.table_info('{}')".format(table))}
+        if "AlignmentId" in columns:
+            genomes.append(table)
+        elif "TranscriptId" in columns:
+            ref_genomes.append(table)
+    con.close()
+    return ref_genomes[0] if len(ref_genomes) == 1 else None, sorted(genomes)
+
+
+def build_transmap_evals(comp_ann_path, ref_genome=None, rebuild=False):
+    """
+    Builds the missing evaluation tables of the transMap genomes in comp_ann_path. If rebuild is True, existing tables
+    are recomputed as well, which is needed whenever the reference databases are rewritten.
+    """
+    found_ref_genome, genomes = find_transmap_genomes(comp_ann_path)
+    ref_genome = found_ref_genome if ref_genome is None else ref_genome
+    if ref_genome is None or len(genomes) == 0:
+        return
+    eval_path = os.path.join(comp_ann_path, "evaluation.db")
+    existing = set()
+    if os.path.exists(eval_path):
+        con, cur = open_database(eval_path)
+        existing = get_table_names(cur)
+        con.close()
+    for genome in genomes:
+        if rebuild is True or genome not in existing:
+            write_transmap_eval(comp_ann_path, ref_genome, genome)
+
+
+# Used for bulk loads. The databases hold one table per genome and are shared by concurrent jobs, so the rollback
+# journal stays on disk and an interrupted load is rolled back instead of corrupting the other tables. page_size only
+# takes effect when the database file is created.
+bulk_load_pragmas = ["PRAGMA page_size=65536", "PRAGMA synchronous=NORMAL", "PRAGMA cache_size=-65536"]
+
+
+def _sorted_column(col):
+    """
+    Returns the IDs of a column, which is either a dict or a pandas Series keyed by ID, in sorted order along with
+    a matching sequence of values.
+    """
+    if isinstance(col, pd.Series):
+        if not col.index.is_monotonic_increasing:
+            col = col.sort_index()
+        return col.index.tolist(), col.values
+    ids = sorted(col.iterkeys())
+    return ids, [col[x] for x in ids]
+
+
+def _batched_values(values, batch_size):
+    """
+    Iterates over a sequence of values, converting numpy arrays to python objects batch_size values at a time.
+    """
+    for i in xrange(0, len(values), batch_size):
+        chunk = values[i:i + batch_size]
+        for v in (chunk.tolist() if isinstance(chunk, np.ndarray) else chunk):
+            yield v
+
+
+def _column_items(col, batch_size):
+    """
+    Returns an iterator over the (ID, value) pairs of a column, sorted by ID. A dict or pandas Series is sorted here.
+    Any other column must have an iteritems() method that yields its pairs sorted by ID, as a SpilledColumn does.
+    """
+    if isinstance(col, (dict, pd.Series)):
+        ids, values = _sorted_column(col)
+        return itertools.izip(ids, _batched_values(values, batch_size))
+    return col.iteritems()
+
+
+def _sql_type(value):
+    """
+    Determines the sqlite column type for a value. Returns None for None.
+    """
+    if isinstance(value, (int, long, bool)):
+        return "INTEGER"
+    elif isinstance(value, float):
+        return "REAL"
+    elif isinstance(value, buffer):
+        return "BLOB"
+    elif value is not None:
+        return "TEXT"
+    return None
+
+
+def _typed_items(items):
+    """
+    Determines the sqlite column type of a stream of (ID, value) pairs from its first value that is not None, reading
+    no further than that value. Columns without any values are REAL, as pandas would have made them. Returns the type
+    and the whole stream.
+    """
+    peeked = []
+    sql_type = None
+    for item in items:
+        peeked.append(item)
+        sql_type = _sql_type(item[1])
+        if sql_type is not None:
+            break
+    return "REAL" if sql_type is None else sql_type, itertools.chain(peeked, items)
+
+
+def _tagged_items(items, i):
+    for row_id, value in items:
+        yield row_id, i, value
+
+
+def _merge_rows(column_items):
+    """
+    Merges streams of (ID, value) pairs sorted by ID into rows of [ID, value of each column] sorted by ID. Columns
+    without a value for an ID, or with a NaN value, get None.
+    """
+    merged = heapq.merge(*[_tagged_items(items, i) for i, items in enumerate(column_items)])
+    for row_id, group in itertools.groupby(merged, key=lambda x: x[0]):
+        row = [row_id] + [None] * len(column_items)
+        for _, i, value in group:
+            row[i + 1] = None if value != value else value  # NaN becomes NULL
+        yield row
+
+
+def write_dict(data_dict, database_path, table, index_label="AlignmentId", batch_size=10000):
+    """
+    Writes a dict of columns to a sqlite database table, replacing it if it exists. Each column is a dict or a pandas
+    Series keyed by ID, or an object whose iteritems() yields (ID, value) pairs sorted by ID, such as a
+    spill_lib.SpilledColumn. The table has one row per ID sorted by ID, with an index on the ID column. The columns
+    are merged on their IDs as they are read and the rows are streamed into the table, so columns read from disk are
+    never held in memory.
+    """
+    columns = sorted(data_dict.iterkeys())
+    typed_columns = [_typed_items(_column_items(data_dict[c], batch_size)) for c in columns]
+    col_defs = ['"{}" TEXT'.format(index_label)]
+    for c, (sql_type, _) in itertools.izip(columns, typed_columns):
+        col_defs.append('"{}" {}'.format(c, sql_type))
+    rows = _merge_rows([items for _, items in typed_columns])
+    with ExclusiveSqlConnection(database_path, pragmas=bulk_load_pragmas) as con:
+        con.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+        con.execute('CREATE TABLE "{}" ({})'.format(table, ", ".join(col_defs)))
+        insert = 'INSERT INTO "{}" VALUES ({})'.format(table, ",".join(["?"] * len(col_defs)))
+        for batch in general_lib.grouper(rows, batch_size):
+            con.executemany(insert, batch)
+        con.execute('CREATE INDEX "ix_{0}_{1}" ON "{0}" ("{1}")'.format(table, index_label))
+        create_indices(con, table)
+        cache_lib.record_generation(con, table)
+
+
+# Column groups that the evaluation queries in etc.config join on or filter by. Each group is indexed with the
+# columns of it that a table has, as long as the table has the first column. Trailing columns make the indices
+# covering for the ID lookups done after a join or a biotype filter.
+index_column_groups = [["AlignmentId", "TranscriptId"], ["TranscriptId", "AlignmentId"],
+                       ["AugustusAlignmentId", "AlignmentId"],
+                       ["TranscriptType", "GeneType", "AlignmentId", "TranscriptId"]]
+
+
+def create_indices(con, table):
+    """
+    Creates the indices in index_column_groups that apply to this table, if they do not already exist, and updates
+    the table statistics used by the query planner.
+    """
+    table_columns = {x[1] for x in con.execute('PRAGMA table_info("{}")'.format(table))}
+    for group in index_column_groups:
+        if group[0] not in table_columns:
+            continue
+        cols = [x for x in group if x in table_columns]
+        col_str = ",".join('"{}"'.format(x) for x in cols)
+        con.execute('CREATE INDEX IF NOT EXISTS "ix_{}_{}" ON "{}" ({})'.format(table, "_".join(cols), table, col_str))
+    con.execute('ANALYZE "{}"'.format(table))
+
+
+def reindex_databases(comp_ann_path):
+    """
+    Adds any missing indices to every table of the comparativeAnnotator databases found in comp_ann_path, after
+    building any missing transMap evaluation tables.
+    """
+    build_transmap_evals(comp_ann_path)
+    for db in ["classify", "details", "attributes", "evaluation", "augustus_classify", "augustus_details",
+               "augustus_attributes"]:
+        db_path = os.path.join(comp_ann_path, "{}.db".format(db))
+        if not os.path.exists(db_path):
+            continue
+        with ExclusiveSqlConnection(db_path) as con:
+            tables = [x[0] for x in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            for table in tables:
+                if not table.startswith("sqlite_") and table != cache_lib.generation_table:
+                    create_indices(con, table)
 
 
 def write_csv(csv_path, database_path, table, sep=",", index_col=0, header=0, index_label="AlignmentId"):
@@ -288,6 +526,7 @@ def write_csv(csv_path, database_path, table, sep=",", index_col=0, header=0, in
     df = df.sort_index()
     with ExclusiveSqlConnection(database_path) as con:
         df.to_sql(table, con, if_exists="replace", index_label=index_label)
+        cache_lib.record_generation(con, table)
 
 
 def collapse_details_dict(details_dict):
@@ -333,7 +572,23 @@ def get_stats(cur, genome, mode="transMap", filter_chroms=None):
     else:
         query = ("SELECT AugustusAlignmentId,IFNULL(AlignmentCoverage, 0),IFNULL(AlignmentIdentity, 0) "
                  "FROM augustus_attributes.'{}'")
-    return get_query_dict(cur, query.format(genome))
+    query = query.format(genome)
+    db = "attributes" if mode == "transMap" else "augustus_attributes"
+    return cache_lib.cached_result(cur, [[db, genome]], query, get_query_dict, cur, query)
+
+
+def get_alignment_id_index(cur, genome):
+    """
+    Returns an AlignmentIdIndex of the transMap alignments for this genome. The index is read from the TranscriptId
+    column of the attributes database, which holds the stripped ID of every alignment, instead of being rebuilt.
+    """
+    query = "SELECT AlignmentId,TranscriptId FROM attributes.'{}'".format(genome)
+    try:
+        rows = cur.execute(query).fetchall()
+    except sql.OperationalError, exc:
+        raise RuntimeError("query failed: {}\nOriginal error message: {}".format(query, exc))
+    aln_ids = [x[0] for x in rows]
+    return psl_lib.AlignmentIdIndex(aln_ids, aln_ids, [x[1] for x in rows])
 
 
 def highest_cov_aln(cur, genome, filter_chroms=None):
@@ -341,10 +596,16 @@ def highest_cov_aln(cur, genome, filter_chroms=None):
     Returns the set of alignment IDs that represent the best alignment for each source transcript (that mapped over)
     Best is defined as highest %COV. Also reports the associated coverage and identity values.
     """
+    tables = [["attributes", genome]]
+    return cache_lib.cached_result(cur, tables, (genome, filter_chroms), _highest_cov_aln, cur, genome, filter_chroms)
+
+
+def _highest_cov_aln(cur, genome, filter_chroms):
     tm_stats = get_stats(cur, genome, mode="transMap", filter_chroms=filter_chroms)
+    id_index = get_alignment_id_index(cur, genome)
     combined_covs = defaultdict(list)
     for aln_id, (cov, ident) in tm_stats.iteritems():
-        tx_id = psl_lib.strip_alignment_numbers(aln_id)
+        tx_id = id_index.transcript_id(aln_id)
         combined_covs[tx_id].append([aln_id, cov, ident])
     best_cov = {}
     for tx_id, vals in combined_covs.iteritems():
@@ -13,7 +13,8 @@ from jobTree.scriptTree.target import Target
 from jobTree.scriptTree.stack import Stack
 from lib.psl_lib import PslRow, remove_augustus_alignment_number, remove_alignment_number
 from lib.sql_lib import ExclusiveSqlConnection, get_gene_transcript_map, attach_databases
-from lib.seq_lib import GenePredTranscript
+from lib.cache_lib import record_generation
+from lib.seq_lib import GenePredTranscript, get_genome_sequence
 from lib.general_lib import tokenize_stream, grouper
 from sonLib.bioio import fastaWrite, popenCatch, system, TempFileTree, catFiles
 from pyfasta import Fasta
@@ -94,7 +95,7 @@ def align_cgp(tmp_dir, gp, target_genome_fasta, tx_dict, ref_tx_fasta):
     """
     results = []
     ref_tx_fasta = Fasta(ref_tx_fasta)
-    target_genome_fasta = Fasta(target_genome_fasta)
+    target_genome_fasta = get_genome_sequence(target_genome_fasta)
     tmp_tgt, tmp_ref, tmp_psl = prepare_tmp_files(tmp_dir, gp, target_genome_fasta)
     for gene_name, tx_names in tx_dict.iteritems():
         for tx_name in tx_names:
@@ -113,7 +114,7 @@ def align_consensus(tmp_dir, gp, target_genome_fasta, ref_tx_fasta):
     Main consensus alignment function.
     """
     ref_tx_fasta = Fasta(ref_tx_fasta)
-    target_genome_fasta = Fasta(target_genome_fasta)
+    target_genome_fasta = get_genome_sequence(target_genome_fasta)
     tmp_tgt, tmp_ref, tmp_psl = prepare_tmp_files(tmp_dir, gp, target_genome_fasta)
     tx_seq = str(ref_tx_fasta[gp.name])
     fastaWrite(tmp_ref, gp.name, tx_seq)
@@ -148,6 +149,7 @@ def load_db(target, genome, tmp_file, out_db, mode):
     table = "_".join([genome, mode])
     with ExclusiveSqlConnection(out_db) as con:
         df.to_sql(table, con, if_exists="replace", index=True)
+        record_generation(con, table)
 
 
 def main():
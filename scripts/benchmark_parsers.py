@@ -0,0 +1,57 @@
+"""
+Benchmarks the bulk column parsers against the per-line iterators on a PSL and/or genePred file, reporting rows per
+second for each. Input files may be gzipped.
+"""
+import argparse
+import time
+import lib.psl_lib as psl_lib
+import lib.seq_lib as seq_lib
+from lib.general_lib import opener, tokenize_stream
+
+__author__ = "Ian Fiddes"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--psl", help="PSL to benchmark, ideally around 1M lines")
+    parser.add_argument("--gp", help="genePred to benchmark")
+    return parser.parse_args()
+
+
+def psl_rows(psl):
+    with opener(psl) as inf:
+        return sum(1 for _ in (psl_lib.PslRow(x) for x in tokenize_stream(inf)))
+
+
+def psl_bulk_rows(psl):
+    return len(psl_lib.parse_psl_columns(psl)["q_names"])
+
+
+def gp_rows(gp):
+    with opener(gp) as inf:
+        return sum(1 for _ in (seq_lib.GenePredTranscript(x) for x in tokenize_stream(inf)))
+
+
+def gp_bulk_rows(gp):
+    return len(seq_lib.parse_gene_pred_columns(gp)["names"])
+
+
+def report(name, fn, path):
+    start = time.time()
+    num_rows = fn(path)
+    elapsed = time.time() - start
+    print "{}\t{} rows\t{:.2f} s\t{:,.0f} rows/s".format(name, num_rows, elapsed, num_rows / elapsed)
+
+
+def main():
+    args = parse_args()
+    if args.psl is not None:
+        report("PslRow", psl_rows, args.psl)
+        report("parse_psl_columns", psl_bulk_rows, args.psl)
+    if args.gp is not None:
+        report("GenePredTranscript", gp_rows, args.gp)
+        report("parse_gene_pred_columns", gp_bulk_rows, args.gp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+"""
+Adds any missing indices, and any missing transMap evaluation tables, to the databases of an existing
+comparativeAnnotator output directory.
+"""
+import argparse
+import lib.sql_lib as sql_lib
+
+__author__ = "Ian Fiddes"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outDir", required=True, help="comparativeAnnotator output directory holding the databases")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sql_lib.reindex_databases(args.outDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@
 Base classifier classes used by all of the classifiers.
 """
 import os
-import cPickle as pickle
 import itertools
 import copy_reg
 import types
@@ -13,12 +12,19 @@ from jobTree.scriptTree.target import Target
 import lib.seq_lib as seq_lib
 import lib.psl_lib as psl_lib
 import lib.sql_lib as sql_lib
+import lib.spill_lib as spill_lib
 from lib.general_lib import mkdir_p
 
 __author__ = "Ian Fiddes"
 
 
 class AbstractClassifier(Target):
+    """
+    Base class for all classifiers. Single genome classifiers implement classify(), which is called once per
+    transcript. If uses_sequence is True, the reference genome is loaded before the first transcript is classified.
+    """
+    uses_sequence = False
+
     colors = {'input': '219,220,222',     # grey
               'mutation': '132,35,27',    # red-ish
               'assembly': '167,206,226',  # light blue
@@ -28,13 +34,15 @@ class AbstractClassifier(Target):
               'generic': '152,156,45'     # grey-yellow
               }
 
-    def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir):
+    def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, cache_dir=None):
         # initialize the Target
         Target.__init__(self)
         self.ref_genome = ref_genome
         self.ref_fasta = ref_fasta
         self.annotation_gp = annotation_gp
         self.tmp_dir = tmp_dir
+        # files derived from the genomes and genePreds are cached here, if given
+        self.cache_dir = cache_dir
         # these variables will be initialized once the jobs have begun to not pickle all of this stuff needlessly
         self.annotation_dict = None
         self.ref_seq_dict = None
@@ -43,10 +51,10 @@ class AbstractClassifier(Target):
         self.details_dict = defaultdict(list)
 
     def get_fasta(self):
-        self.ref_seq_dict = seq_lib.get_sequence_dict(self.ref_fasta)
+        self.ref_seq_dict = seq_lib.get_sequence_dict(self.ref_fasta, cache_dir=self.cache_dir)
 
     def get_annotation_dict(self):
-        self.annotation_dict = seq_lib.get_transcript_dict(self.annotation_gp)
+        self.annotation_dict = seq_lib.get_transcript_dict(self.annotation_gp, self.cache_dir)
 
     def annotation_iterator(self):
         """
@@ -61,6 +69,16 @@ class AbstractClassifier(Target):
     def column(self):
         return self.__class__.__name__
 
+    def run(self):
+        """
+        Runs this classifier over every transcript in the annotation set.
+        """
+        if self.uses_sequence is True:
+            self.get_fasta()
+        for ens_id, a in self.annotation_iterator():
+            self.classify(ens_id, a)
+        self.dump_results_to_disk()
+
     def dump_results_to_disk(self):
         """
         Dumps a pair of classify/details dicts to disk in the globalTempDir for later merging.
@@ -69,15 +87,44 @@ class AbstractClassifier(Target):
         for db, this_dict in itertools.izip(*[["details", "classify"], [details_dict, self.classify_dict]]):
             base_p = os.path.join(self.tmp_dir, db)
             mkdir_p(base_p)
-            p = os.path.join(base_p, self.column)
-            with open(p, "wb") as outf:
-                pickle.dump(this_dict, outf)
+            spill_lib.write_column(this_dict, os.path.join(base_p, self.column))
+
+
+class FusedClassifier(AbstractClassifier):
+    """
+    Runs a set of single-genome classifiers as one job. The annotation set, and the fasta if any classifier uses it,
+    are loaded once and each transcript is dispatched to every classifier in a single pass. Each classifier still
+    dumps its own results.
+    """
+    def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, classifiers, cache_dir=None):
+        AbstractClassifier.__init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, cache_dir)
+        self.classifiers = classifiers
+
+    def run(self):
+        if any(c.uses_sequence is True for c in self.classifiers):
+            self.get_fasta()
+        self.get_annotation_dict()
+        classifiers = [c(self.ref_fasta, self.annotation_gp, self.ref_genome, self.tmp_dir, self.cache_dir)
+                       for c in self.classifiers]
+        for classifier in classifiers:
+            classifier.ref_seq_dict = self.ref_seq_dict
+            classifier.annotation_dict = self.annotation_dict
+        for ens_id, a in self.annotation_iterator():
+            for classifier in classifiers:
+                classifier.classify(ens_id, a)
+        for classifier in classifiers:
+            classifier.dump_results_to_disk()
 
 
 class AbstractAlignmentClassifier(AbstractClassifier):
     """
-    Subclasses AbstractClassifier for alignment classifications
+    Subclasses AbstractClassifier for alignment classifications.
+
+    If shardable is True, this classifier only looks at one alignment at a time and can be run on a subset of the
+    alignments.
     """
+    shardable = True
+
     colors = {'input': '219,220,222',     # grey
               'mutation': '132,35,27',    # red-ish
               'assembly': '167,206,226',  # light blue
@@ -87,8 +134,9 @@ class AbstractAlignmentClassifier(AbstractClassifier):
               'generic': '152,156,45'     # grey-yellow
               }
 
-    def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl, ref_psl, tgt_fasta, tgt_gp):
-        AbstractClassifier.__init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir)
+    def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl, ref_psl, tgt_fasta, tgt_gp,
+                 cache_dir=None):
+        AbstractClassifier.__init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, cache_dir)
         self.genome = tgt_genome
         self.aln_psl = aln_psl
         self.ref_psl = ref_psl
@@ -96,22 +144,35 @@ class AbstractAlignmentClassifier(AbstractClassifier):
         self.tgt_fasta = tgt_fasta
         self.transcript_dict = None
         self.alignment_dict = None
+        self.alignment_table = None
         self.ref_alignment_dict = None
+        self.alignment_id_index = None
         self.seq_dict = None
 
     def get_fasta(self):
-        self.seq_dict = seq_lib.get_sequence_dict(self.tgt_fasta)
-        self.ref_seq_dict = seq_lib.get_sequence_dict(self.ref_fasta)
+        self.seq_dict = seq_lib.get_sequence_dict(self.tgt_fasta, cache_dir=self.cache_dir)
+        self.ref_seq_dict = seq_lib.get_sequence_dict(self.ref_fasta, cache_dir=self.cache_dir)
 
     def get_alignment_dict(self):
         self.alignment_dict = psl_lib.get_alignment_dict(self.aln_psl)
 
+    def get_alignment_table(self):
+        self.alignment_table = psl_lib.get_alignment_table(self.aln_psl)
+
     def get_transcript_dict(self):
-        self.transcript_dict = seq_lib.get_transcript_dict(self.tgt_gp)
+        self.transcript_dict = seq_lib.get_transcript_dict(self.tgt_gp, self.cache_dir)
 
     def get_ref_alignment_dict(self):
         self.ref_alignment_dict = psl_lib.get_alignment_dict(self.ref_psl)
 
+    def get_alignment_id_index(self):
+        """
+        Indexes the target transcript names, which are also the alignment names, against the annotation set.
+        """
+        self.alignment_id_index = psl_lib.build_alignment_id_index(
+            seq_lib.load_gene_pred_columns(self.tgt_gp, self.cache_dir)["names"].tolist(),
+            seq_lib.load_gene_pred_columns(self.annotation_gp, self.cache_dir)["names"].tolist())
+
     def transcript_iterator(self):
         """
         Convenience function for iterating over a dictionary of Transcript objects
@@ -146,8 +207,10 @@ class AbstractAlignmentClassifier(AbstractClassifier):
         """
         if self.ref_alignment_dict is None:
             self.get_ref_alignment_dict()
+        if self.alignment_id_index is None:
+            self.get_alignment_id_index()
         for aln_id, aln, t in self.alignment_transcript_iterator():
-            ref_aln = self.ref_alignment_dict[psl_lib.remove_alignment_number(aln_id)]
+            ref_aln = self.ref_alignment_dict[self.alignment_id_index[aln_id]]
             yield aln_id, aln, ref_aln, t
 
     def alignment_transcript_annotation_iterator(self):
@@ -156,15 +219,17 @@ class AbstractAlignmentClassifier(AbstractClassifier):
         """
         if self.annotation_dict is None:
             self.get_annotation_dict()
+        if self.alignment_id_index is None:
+            self.get_alignment_id_index()
         for aln_id, aln, t in self.alignment_transcript_iterator():
-            a = self.annotation_dict[psl_lib.remove_alignment_number(aln_id)]
+            a = self.annotation_dict[self.alignment_id_index[aln_id]]
             yield aln_id, aln, t, a
 
     def alignment_refalignment_transcript_annotation_iterator(self):
         if self.annotation_dict is None:
             self.get_annotation_dict()
         for aln_id, aln, ref_aln, t in self.alignment_refalignment_transcript_iterator():
-            a = self.annotation_dict[psl_lib.remove_alignment_number(aln_id)]
+            a = self.annotation_dict[self.alignment_id_index[aln_id]]
             yield aln_id, aln, ref_aln, t, a
 
 
@@ -173,14 +238,14 @@ class AbstractAugustusClassifier(AbstractAlignmentClassifier):
     Subclasses AbstractClassifier for Augustus classifications
     """
     def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl, ref_psl, tgt_fasta, tgt_gp,
-                 augustus_gp):
+                 augustus_gp, cache_dir=None):
         AbstractAlignmentClassifier.__init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl,
-                                             ref_psl, tgt_fasta, tgt_gp)
+                                             ref_psl, tgt_fasta, tgt_gp, cache_dir)
         self.augustus_gp = augustus_gp
         self.augustus_transcript_dict = None
 
     def get_augustus_transcript_dict(self):
-        self.augustus_transcript_dict = seq_lib.get_transcript_dict(self.augustus_gp)
+        self.augustus_transcript_dict = seq_lib.get_transcript_dict(self.augustus_gp, self.cache_dir)
 
     def augustus_transcript_iterator(self):
         if self.augustus_transcript_dict is None:
@@ -198,18 +263,40 @@ class AbstractAugustusClassifier(AbstractAlignmentClassifier):
 
 class Attribute(AbstractAlignmentClassifier):
     """
-    Subclasses AbstractClassifier to build the Attributes database
+    Subclasses AbstractClassifier to build the Attributes database.
+
+    Each attribute declares the inputs it reads in inputs and implements build(), which returns the dict of alignment
+    ID -> value for the attribute. The inputs are loaded before build() is called, which lets a FusedAttribute load
+    the union of the inputs once and share them across every attribute.
     """
+    inputs = ["transcript_dict"]
+
     def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl, ref_psl, tgt_fasta, tgt_gp,
-                 gencode_attributes):
+                 gencode_attributes, cache_dir=None):
         AbstractAlignmentClassifier.__init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl,
-                                             ref_psl, tgt_fasta, tgt_gp)
+                                             ref_psl, tgt_fasta, tgt_gp, cache_dir)
         self.gencode_attributes = gencode_attributes
         self.attribute_dict = None
+        self.annotation_table = None
 
     def get_attribute_dict(self):
         self.attribute_dict = seq_lib.get_transcript_attribute_dict(self.gencode_attributes)
 
+    def get_annotation_table(self):
+        self.annotation_table = seq_lib.get_transcript_table(self.annotation_gp, self.cache_dir)
+
+    def load_inputs(self, inputs):
+        """
+        Loads any of the named inputs that have not been loaded yet.
+        """
+        loaders = {"transcript_dict": self.get_transcript_dict, "annotation_dict": self.get_annotation_dict,
+                   "annotation_table": self.get_annotation_table, "attribute_dict": self.get_attribute_dict,
+                   "alignment_table": self.get_alignment_table, "alignment_id_index": self.get_alignment_id_index,
+                   "seq_dict": self.get_fasta}
+        for name in inputs:
+            if getattr(self, name) is None:
+                loaders[name]()
+
     def attribute_iterator(self):
         if self.attribute_dict is None:
             self.get_attribute_dict()
@@ -223,6 +310,32 @@ class Attribute(AbstractAlignmentClassifier):
         db = "attributes"
         base_p = os.path.join(self.tmp_dir, db)
         mkdir_p(base_p)
-        p = os.path.join(base_p, self.column)
-        with open(p, "wb") as outf:
-            pickle.dump(results_dict, outf)
\ No newline at end of file
+        spill_lib.write_column(results_dict, os.path.join(base_p, self.column))
+
+    def run(self):
+        self.load_inputs(self.inputs)
+        self.dump_attribute_results_to_disk(self.build())
+
+
+class FusedAttribute(Attribute):
+    """
+    Builds a set of attributes as one job. The inputs declared by the attributes are loaded once and shared, then each
+    attribute builds and dumps its own column.
+    """
+    shared = ["transcript_dict", "annotation_dict", "annotation_table", "attribute_dict", "alignment_table",
+              "alignment_id_index", "seq_dict", "ref_seq_dict"]
+
+    def __init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl, ref_psl, tgt_fasta, tgt_gp,
+                 gencode_attributes, attributes, cache_dir=None):
+        Attribute.__init__(self, ref_fasta, annotation_gp, ref_genome, tmp_dir, tgt_genome, aln_psl, ref_psl,
+                           tgt_fasta, tgt_gp, gencode_attributes, cache_dir)
+        self.attributes = attributes
+
+    def run(self):
+        self.load_inputs({name for attribute in self.attributes for name in attribute.inputs})
+        for attribute in self.attributes:
+            a = attribute(self.ref_fasta, self.annotation_gp, self.ref_genome, self.tmp_dir, self.genome, self.aln_psl,
+                          self.ref_psl, self.tgt_fasta, self.tgt_gp, self.gencode_attributes, self.cache_dir)
+            for name in self.shared:
+                setattr(a, name, getattr(self, name))
+            a.dump_attribute_results_to_disk(a.build())
@@ -2,7 +2,6 @@ import itertools
 from collections import Counter
 
 import lib.seq_lib as seq_lib
-import lib.psl_lib as psl_lib
 import lib.comp_ann_lib as comp_ann_lib
 
 from src.abstract_classifier import AbstractAlignmentClassifier
@@ -45,12 +44,13 @@ class AlnAbutsUnknownBases(AbstractAlignmentClassifier):
 
     def run(self):
         self.get_fasta()
+        n_gaps = seq_lib.get_n_gap_index(self.seq_dict)
         for aln_id, t in self.transcript_iterator():
-            if self.seq_dict[t.chromosome][t.start - 1] == "N":
+            if n_gaps.is_n(t.chromosome, t.start - 1):
                 self.classify_dict[aln_id] = 1
                 left_bed_rec = t.exon_intervals[0].get_bed(self.rgb, self.column)
                 self.details_dict[aln_id].append(left_bed_rec)
-            if len(t.exon_intervals) > 1 and self.seq_dict[t.chromosome][t.stop] == "N":
+            if len(t.exon_intervals) > 1 and n_gaps.is_n(t.chromosome, t.stop):
                 self.classify_dict[aln_id] = 1
                 right_bed_rec = t.exon_intervals[-1].get_bed(self.rgb, "/".join([self.column, aln_id]))
                 self.details_dict[aln_id].append(right_bed_rec)
@@ -336,15 +336,19 @@ class Synonymous(Nonsynonymous):
 class Paralogy(AbstractAlignmentClassifier):
     """
     Does this transcript appear more than once in the transcript dict?
+    Needs to see every alignment at once, so can not be sharded.
     """
+    shardable = False
+
     @property
     def rgb(self):
         return self.colors["mutation"]
 
     def run(self):
-        counts = Counter(psl_lib.remove_alignment_number(aln_id) for aln_id, aln in self.alignment_iterator())
+        self.get_alignment_id_index()
+        counts = Counter(self.alignment_id_index.transcript_id(aln_id) for aln_id, aln in self.alignment_iterator())
         for aln_id, t in self.transcript_iterator():
-            count = counts[psl_lib.remove_alignment_number(aln_id)] - 1
+            count = counts[self.alignment_id_index[aln_id]] - 1
             if count > 0:
                 name = self.column + "_{}_Copies".format(count)
                 bed_rec = seq_lib.transcript_to_bed(t, self.rgb, name)
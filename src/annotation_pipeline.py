@@ -16,7 +16,9 @@ import src.classifiers
 import src.alignment_classifiers
 import src.augustus_classifiers
 import src.attributes
+import src.sharding as sharding
 
+from src.abstract_classifier import FusedClassifier, FusedAttribute
 from src.build_tracks import database_wrapper
 
 __author__ = "Ian Fiddes"
@@ -38,6 +40,12 @@ def parse_args():
         parser.add_argument('--sizes', required=True)
         parser.add_argument('--annotationGp', required=True)
         parser.add_argument('--gencodeAttributes', required=True)
+        parser.add_argument('--fuseClassifiers', action='store_true',
+                            help='Run alignment-free classifiers and attributes as fused jobs that load inputs once.')
+        parser.add_argument('--compactDetails', action='store_true',
+                            help='Store details as packed integer arrays that are decoded when tracks are built.')
+        parser.add_argument('--inProcessBigBed', action='store_true',
+                            help='Write the bigBed tracks in process instead of with bedSort and bedToBigBed.')
         Stack.addJobTreeOptions(parser)  # add jobTree options
     # transMap specific options
     for parser in [aug_parser, tm_parser]:
@@ -46,6 +54,11 @@ def parse_args():
         parser.add_argument('--refPsl', required=True)
         parser.add_argument('--targetGp', required=True)
         parser.add_argument('--fasta', required=True)
+    # sharding options
+    tm_parser.add_argument('--numShards', type=int, default=1,
+                           help='Split the alignments into this many shards for the alignment classifiers.')
+    tm_parser.add_argument('--shardBy', choices=['chromosome', 'count'], default='chromosome',
+                           help='Shard by whole target chromosomes or by balanced transcript counts.')
     # Augustus specific options
     aug_parser.add_argument('--augustusGp', required=True)
     args = parent_parser.parse_args()
@@ -53,45 +66,80 @@ def parse_args():
     return args
 
 
-def run_ref_classifiers(args, target, tmp_dir):
+def input_cache_dir(args):
+    """
+    Files derived from the input genomes and genePreds are cached in the output directory, leaving the inputs alone.
+    """
+    return os.path.join(args.outDir, "input_cache")
+
+
+def add_ref_classifiers(args, target, tmp_dir, fasta, gp, genome):
+    """
+    Adds the alignment-free classifiers for this gene set, either one job per classifier or as one fused job.
+    """
     ref_classifiers = classes_in_module(src.classifiers)
-    for classifier in ref_classifiers:
-        target.addChildTarget(classifier(args.refFasta, args.annotationGp, args.refGenome, tmp_dir))
+    cache_dir = input_cache_dir(args)
+    if args.fuseClassifiers is True:
+        target.addChildTarget(FusedClassifier(fasta, gp, genome, tmp_dir, ref_classifiers, cache_dir))
+    else:
+        for classifier in ref_classifiers:
+            target.addChildTarget(classifier(fasta, gp, genome, tmp_dir, cache_dir))
+
+
+def run_ref_classifiers(args, target, tmp_dir):
+    add_ref_classifiers(args, target, tmp_dir, args.refFasta, args.annotationGp, args.refGenome)
 
 
 def run_tm_classifiers(args, target, tmp_dir):
+    if args.numShards > 1:
+        shard_root = os.path.join(tmp_dir, "shards")
+        shards = sharding.shard_inputs(args.psl, args.targetGp, shard_root, args.numShards, args.shardBy)
+    else:
+        shards = [[args.psl, args.targetGp, tmp_dir]]
+    cache_dir = input_cache_dir(args)
     tm_classifiers = classes_in_module(src.alignment_classifiers)
     for classifier in tm_classifiers:
-        target.addChildTarget(classifier(args.refFasta, args.annotationGp, args.refGenome, tmp_dir, args.genome,
-                                         args.psl, args.refPsl, args.fasta, args.targetGp))
+        for psl, gp, results_dir in sharding.classifier_shards(classifier, shards, args.psl, args.targetGp, tmp_dir):
+            target.addChildTarget(classifier(args.refFasta, args.annotationGp, args.refGenome, results_dir,
+                                             args.genome, psl, args.refPsl, args.fasta, gp, cache_dir))
     attributes = classes_in_module(src.attributes)
-    for attribute in attributes:
-        target.addChildTarget(attribute(args.refFasta, args.annotationGp, args.refGenome, tmp_dir, args.genome,
-                                         args.psl, args.refPsl, args.fasta, args.targetGp, args.gencodeAttributes))
-    # in transMap mode we run the alignment-free classifiers on the target genome
-    ref_classifiers = classes_in_module(src.classifiers)
-    for classifier in ref_classifiers:
-        target.addChildTarget(classifier(args.fasta, args.targetGp, args.genome, tmp_dir))
+    for psl, gp, results_dir in shards:
+        if args.fuseClassifiers is True:
+            target.addChildTarget(FusedAttribute(args.refFasta, args.annotationGp, args.refGenome, results_dir,
+                                                 args.genome, psl, args.refPsl, args.fasta, gp, args.gencodeAttributes,
+                                                 attributes, cache_dir))
+        else:
+            for attribute in attributes:
+                target.addChildTarget(attribute(args.refFasta, args.annotationGp, args.refGenome, results_dir,
+                                                args.genome, psl, args.refPsl, args.fasta, gp, args.gencodeAttributes,
+                                                cache_dir))
+        # in transMap mode we run the alignment-free classifiers on the target genome
+        add_ref_classifiers(args, target, results_dir, args.fasta, gp, args.genome)
 
 
 def run_aug_classifiers(args, target, tmp_dir):
     aug_classifiers = classes_in_module(src.augustus_classifiers)
     for classifier in aug_classifiers:
         target.addChildTarget(classifier(args.refFasta, args.annotationGp, args.refGenome, tmp_dir, args.genome,
-                                         args.psl, args.refPsl, args.fasta, args.targetGp, args.augustusGp))
+                                         args.psl, args.refPsl, args.fasta, args.targetGp, args.augustusGp,
+                                         input_cache_dir(args)))
     # in Augustus mode we run the alignment-free classifiers on augustus transcripts
-    ref_classifiers = classes_in_module(src.classifiers)
-    for classifier in ref_classifiers:
-        target.addChildTarget(classifier(args.fasta, args.augustusGp, args.genome, tmp_dir))
+    add_ref_classifiers(args, target, tmp_dir, args.fasta, args.augustusGp, args.genome)
 
 
 
 def build_analyses(target, args):
     """
-    Wrapper function that will call all classifiers. Each classifier will dump its results to disk as a pickled dict.
+    Wrapper function that will call all classifiers. Each classifier will dump its results to disk as spill columns.
     Calls database_wrapper to load these into a sqlite3 database.
     """
     tmp_dir = target.getGlobalTempDir()
+    # build the uppercase genome stores and N gap indices once here instead of racing to build them in every
+    # classifier. .2bit genomes are read directly and need neither
+    for fasta in [args.refFasta] if args.mode == "reference" else [args.refFasta, args.fasta]:
+        if not seq_lib.is_two_bit(fasta):
+            seq_lib.build_genome_store(fasta, input_cache_dir(args))
+            seq_lib.build_n_gap_index(fasta, input_cache_dir(args))
     if args.mode == "reference":
         run_ref_classifiers(args, target, tmp_dir)
     elif args.mode == "transMap":
@@ -100,7 +148,18 @@ def build_analyses(target, args):
         run_aug_classifiers(args, target, tmp_dir)
     else:
         raise RuntimeError("Somehow your argparse object does not contain a valid mode.")
-    # merge the resulting pickled files into sqlite databases and construct BED tracks
+    # merge the resulting column files into sqlite databases and construct BED tracks
+    if args.mode == "transMap" and args.numShards > 1:
+        target.setFollowOnTargetFn(merge_shards_wrapper, memory=8 * (1024 ** 3), args=[args, tmp_dir])
+    else:
+        target.setFollowOnTargetFn(database_wrapper, memory=8 * (1024 ** 3), args=[args, tmp_dir])
+
+
+def merge_shards_wrapper(target, args, tmp_dir):
+    """
+    Merges the per-shard results of a sharded transMap run before the databases are built.
+    """
+    sharding.merge_shards(os.path.join(tmp_dir, "shards"), tmp_dir)
     target.setFollowOnTargetFn(database_wrapper, memory=8 * (1024 ** 3), args=[args, tmp_dir])
 
 
@@ -1,7 +1,6 @@
 from src.abstract_classifier import Attribute
 
 import lib.seq_lib as seq_lib
-import lib.psl_lib as psl_lib
 from lib.general_lib import format_ratio
 
 
@@ -9,64 +8,64 @@ class TranscriptId(Attribute):
     """
     Creates a column representing the transcript Id
     """
-    def run(self):
-        results_dict = {aln_id: psl_lib.remove_alignment_number(aln_id) for aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index"]
+
+    def build(self):
+        return dict(self.alignment_id_index.transcript_ids)
 
 
 class GeneId(Attribute):
     """
     Creates a column representing the gene Id
     """
-    def run(self):
-        self.get_attribute_dict()
-        results_dict = {aln_id: self.attribute_dict[psl_lib.remove_alignment_number(aln_id)].gene_id for aln_id, t in
-                        self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "attribute_dict"]
+
+    def build(self):
+        return {aln_id: self.attribute_dict[tx_id].gene_id for aln_id, tx_id in
+                self.alignment_id_index.transcript_ids.iteritems()}
 
 
 class GeneName(Attribute):
     """
     Creates a column representing the gene name
     """
-    def run(self):
-        self.get_attribute_dict()
-        results_dict = {aln_id: self.attribute_dict[psl_lib.remove_alignment_number(aln_id)].gene_name for aln_id, t in
-                        self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "attribute_dict"]
+
+    def build(self):
+        return {aln_id: self.attribute_dict[tx_id].gene_name for aln_id, tx_id in
+                self.alignment_id_index.transcript_ids.iteritems()}
 
 
 class GeneType(Attribute):
     """
     Creates a column representing the gene type
     """
-    def run(self):
-        self.get_attribute_dict()
-        results_dict = {aln_id: self.attribute_dict[psl_lib.remove_alignment_number(aln_id)].gene_type for aln_id, t in
-                        self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "attribute_dict"]
+
+    def build(self):
+        return {aln_id: self.attribute_dict[tx_id].gene_type for aln_id, tx_id in
+                self.alignment_id_index.transcript_ids.iteritems()}
 
 
 class TranscriptType(Attribute):
     """
     Creates a column representing the transcript type
     """
-    def run(self):
-        self.get_attribute_dict()
-        results_dict = {aln_id: self.attribute_dict[psl_lib.remove_alignment_number(aln_id)].transcript_type for
-                        aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "attribute_dict"]
+
+    def build(self):
+        return {aln_id: self.attribute_dict[tx_id].transcript_type for aln_id, tx_id in
+                self.alignment_id_index.transcript_ids.iteritems()}
 
 
 class SourceChrom(Attribute):
     """
     Creates a column representing the source chromosome
     """
-    def run(self):
-        self.get_annotation_dict()
-        results_dict = {aln_id: self.annotation_dict[psl_lib.remove_alignment_number(aln_id)].chromosome for
-                        aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "annotation_table"]
+
+    def build(self):
+        return self.alignment_id_index.source_values(self.annotation_table.row_chromosomes())
 
 
 class SourceStart(Attribute):
@@ -74,11 +73,10 @@ class SourceStart(Attribute):
     Creates a column representing the source genomic start location.
     (+) strand value, so always smaller than sourceEnd.
     """
-    def run(self):
-        self.get_annotation_dict()
-        results_dict = {aln_id: self.annotation_dict[psl_lib.remove_alignment_number(aln_id)].start for aln_id, t in
-                        self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "annotation_table"]
+
+    def build(self):
+        return self.alignment_id_index.source_values(self.annotation_table.starts)
 
 
 class SourceStop(Attribute):
@@ -86,32 +84,28 @@ class SourceStop(Attribute):
     Creates a column representing the source genomic stop location.
     (+) strand value, so always smaller than sourceEnd.
     """
-    def run(self):
-        self.get_annotation_dict()
-        results_dict = {aln_id: self.annotation_dict[psl_lib.remove_alignment_number(aln_id)].stop for aln_id, t in
-                        self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "annotation_table"]
+
+    def build(self):
+        return self.alignment_id_index.source_values(self.annotation_table.stops)
 
 
 class SourceStrand(Attribute):
     """
     Creates a column representing the source genomic strand.
     """
-    def run(self):
-        self.get_annotation_dict()
-        results_dict = {aln_id: seq_lib.convert_strand(
-                        self.annotation_dict[psl_lib.remove_alignment_number(aln_id)].strand)
-                        for aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_id_index", "annotation_table"]
+
+    def build(self):
+        return self.alignment_id_index.source_values(self.annotation_table.cols["strands"])
 
 
 class DestChrom(Attribute):
     """
     Creates a column representing the dest chromosome
     """
-    def run(self):
-        results_dict = {aln_id: self.transcript_dict[aln_id].chromosome for aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    def build(self):
+        return {aln_id: self.transcript_dict[aln_id].chromosome for aln_id, t in self.transcript_iterator()}
 
 
 class DestStart(Attribute):
@@ -119,9 +113,8 @@ class DestStart(Attribute):
     Creates a column representing the dest genomic start location.
     (+) strand value, so always smaller than destEnd.
     """
-    def run(self):
-        results_dict = {aln_id: self.transcript_dict[aln_id].start for aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    def build(self):
+        return {aln_id: self.transcript_dict[aln_id].start for aln_id, t in self.transcript_iterator()}
 
 
 class DestStop(Attribute):
@@ -129,19 +122,17 @@ class DestStop(Attribute):
     Creates a column representing the dest genomic stop location.
     (+) strand value, so always larger tha destStart
     """
-    def run(self):
-        results_dict = {aln_id: self.transcript_dict[aln_id].stop for aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    def build(self):
+        return {aln_id: self.transcript_dict[aln_id].stop for aln_id, t in self.transcript_iterator()}
 
 
 class DestStrand(Attribute):
     """
     Creates a column representing the dest genomic strand.
     """
-    def run(self):
-        results_dict = {aln_id: seq_lib.convert_strand(self.transcript_dict[aln_id].strand) for aln_id, t in
-                        self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    def build(self):
+        return {aln_id: seq_lib.convert_strand(self.transcript_dict[aln_id].strand) for aln_id, t in
+                self.transcript_iterator()}
 
 
 class AlignmentCoverage(Attribute):
@@ -152,9 +143,10 @@ class AlignmentCoverage(Attribute):
 
     Reports the value as a REAL between 0 and 1
     """
-    def run(self):
-        results_dict = {aln_id: aln.coverage for aln_id, aln in self.alignment_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_table"]
+
+    def build(self):
+        return self.alignment_table.metric_dict(self.alignment_table.coverage())
 
 
 class AlignmentIdentity(Attribute):
@@ -165,9 +157,10 @@ class AlignmentIdentity(Attribute):
 
     Reports the value as a REAL between 0 and 1
     """
-    def run(self):
-        results_dict = {aln_id: aln.identity for aln_id, aln in self.alignment_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_table"]
+
+    def build(self):
+        return self.alignment_table.metric_dict(self.alignment_table.identity())
 
 
 class PercentUnknownBases(Attribute):
@@ -176,29 +169,30 @@ class PercentUnknownBases(Attribute):
 
     n_count / q_size
     """
-    def run(self):
-        results_dict = {aln_id: aln.percent_n for aln_id, aln in self.alignment_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
+    inputs = ["alignment_table"]
+
+    def build(self):
+        return self.alignment_table.metric_dict(self.alignment_table.percent_n())
 
 
 class PercentUnknownCodingBases(Attribute):
     """
     Calculates the percent of coding bases that are Ns in the transcript
     """
-    def run(self):
-        self.get_fasta()
+    inputs = ["transcript_dict", "seq_dict"]
+
+    def build(self):
         results_dict = {}
         for aln_id, t in self.transcript_iterator():
             cds = t.get_cds(self.seq_dict)
             v = 100 * format_ratio(cds.count("N"), len(cds))
             results_dict[aln_id] = v
-        self.dump_attribute_results_to_disk(results_dict)
+        return results_dict
 
 
 class NumberIntrons(Attribute):
     """
     Reports the number of introns for this alignment
     """
-    def run(self):
-        results_dict = {aln_id: len(t.intron_intervals) for aln_id, t in self.transcript_iterator()}
-        self.dump_attribute_results_to_disk(results_dict)
\ No newline at end of file
+    def build(self):
+        return {aln_id: len(t.intron_intervals) for aln_id, t in self.transcript_iterator()}
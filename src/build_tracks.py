@@ -3,15 +3,19 @@ Script to build the databases and tracks from comparativeAnnotator results
 """
 import os
 import subprocess
-import cPickle as pickle
+from itertools import izip
 import pandas as pd
 
 from jobTree.scriptTree.target import Target
 from jobTree.scriptTree.stack import Stack
 
 import lib.sql_lib as sql_lib
+import lib.cache_lib as cache_lib
+import lib.spill_lib as spill_lib
 import lib.seq_lib as seq_lib
 import lib.psl_lib as psl_lib
+import lib.big_bed_lib as big_bed_lib
+import lib.details_lib as details_lib
 from lib.general_lib import mkdir_p
 import etc.config
 
@@ -30,30 +34,32 @@ def database_wrapper(target, args, tmp_dir):
     if args.mode == "augustus":
         for db in ["classify", "details"]:
             db_path = os.path.join(args.outDir, "augustus_{}.db".format(db))
-            database(args.genome, db, db_path, tmp_dir, args.mode)
+            database(args.genome, db, db_path, tmp_dir, args.mode, args.compactDetails)
     elif args.mode == "reference":
         for db in ["classify", "details"]:
             db_path = os.path.join(args.outDir, "{}.db".format(db))
-            database(args.refGenome, db, db_path, tmp_dir, args.mode)
+            database(args.refGenome, db, db_path, tmp_dir, args.mode, args.compactDetails)
         attr_db_path = os.path.join(args.outDir, "attributes.db")
         ref_attr_table(args.refGenome, attr_db_path, args.gencodeAttributes, args.annotationGp)
+        # the transMap evaluations are relative to the reference, so they are stale now
+        sql_lib.build_transmap_evals(args.outDir, args.refGenome, rebuild=True)
     elif args.mode == "transMap":
         for db in ["classify", "details", "attributes"]:
             db_path = os.path.join(args.outDir, "{}.db".format(db))
-            database(args.genome, db, db_path, tmp_dir, args.mode)
+            database(args.genome, db, db_path, tmp_dir, args.mode, args.compactDetails)
+        sql_lib.write_transmap_eval(args.outDir, args.refGenome, args.genome)
     else:
         raise RuntimeError("Somehow your argparse object does not contain a valid mode.")
     target.setFollowOnTargetFn(build_tracks_wrapper, args=[args])
 
 
-def database(genome, db, db_path, tmp_dir, mode):
-    data_dict = {}
+def database(genome, db, db_path, tmp_dir, mode, compact_details=False):
     mkdir_p(os.path.dirname(db_path))
-    data_path = os.path.join(tmp_dir, db)
-    for col in os.listdir(data_path):
-        p = os.path.join(data_path, col)
-        with open(p) as p_h:
-            data_dict[col] = pickle.load(p_h)
+    columns = spill_lib.spilled_columns(os.path.join(tmp_dir, db))
+    if db == "details" and compact_details is True:
+        data_dict = {col: details_lib.EncodedDetailsColumn(x, col) for col, x in columns.iteritems()}
+    else:
+        data_dict = dict(columns)
     if mode == "reference":
         index_label = "TranscriptId"
     elif mode == "transMap":
@@ -61,8 +67,8 @@ def database(genome, db, db_path, tmp_dir, mode):
     else:
         index_label = "AugustusAlignmentId"
         # Hack to add transMap alignment ID column to Augustus databases.
-        aug_ids = data_dict.itervalues().next().viewkeys()
-        data_dict["AlignmentId"] = {x: psl_lib.remove_augustus_alignment_number(x) for x in aug_ids}
+        aug_ids = columns.itervalues().next().ids()
+        data_dict["AlignmentId"] = psl_lib.build_alignment_id_index(aug_ids).transmap_ids
     sql_lib.write_dict(data_dict, db_path, genome, index_label)
 
 
@@ -72,12 +78,14 @@ def ref_attr_table(ref_genome, db_path, attr_file, ref_gp):
     Basically directly dumping the tsv into sqlite3 with the addition of a refChrom column.
     """
     df = pd.read_table(attr_file, sep="\t", index_col=3, header=0)
-    ref_dict = seq_lib.get_transcript_dict(ref_gp)
-    chromosome_dict = {"refChrom": {x: y.chromosome for x, y in ref_dict.iteritems()}}
+    ref_table = seq_lib.get_transcript_table(ref_gp)
+    chromosome_dict = {"refChrom": dict(izip(ref_table.names.tolist(), ref_table.row_chromosomes().tolist()))}
     chromosome_df = pd.DataFrame.from_dict(chromosome_dict)
     df2 = pd.merge(df, chromosome_df, left_index=True, right_index=True)
     with sql_lib.ExclusiveSqlConnection(db_path) as con:
         df2.to_sql(ref_genome, con, if_exists="replace", index_label="TranscriptId")
+        sql_lib.create_indices(con, ref_genome)
+        cache_lib.record_generation(con, ref_genome)
 
 
 def build_tracks_wrapper(target, args):
@@ -112,31 +120,52 @@ def make_big_bed(out_bed_path, sizes, out_big_bed_path):
     subprocess.call(["bedToBigBed", "-extraIndex=name", out_bed_path, sizes, out_big_bed_path])
 
 
+def write_track(bed_recs, out_bed_path, out_big_bed_path, args, tmp_dir):
+    """
+    Writes an iterable of BED strings to a sorted BED and a bigBed indexed on name. The bigBed is built by bedSort and
+    bedToBigBed, unless --inProcessBigBed was set, in which case big_bed_lib writes both files without the Kent tools.
+    """
+    if args.inProcessBigBed is True:
+        big_bed_lib.write_big_bed(bed_recs, args.sizes, out_big_bed_path, out_bed_path, tmp_dir)
+    else:
+        with open(out_bed_path, "w") as outf:
+            for rec in bed_recs:
+                outf.write(rec)
+        make_big_bed(out_bed_path, args.sizes, out_big_bed_path)
+
+
 def build_classifier_tracks(target, query_fn, genome, args):
     query = query_fn(genome)
     query_name = query_fn.__name__
     con, cur = sql_lib.attach_databases(args.outDir, mode=args.mode)
-    bed_recs = sql_lib.execute_query(cur, query)
+    recs = details_lib.decode_rows(sql_lib.execute_query(cur, query))
     out_bed_path, out_big_bed_path = get_bed_paths(args.outDir, query_name, genome)
-    with open(out_bed_path, "w") as outf:
-        for recs in bed_recs:
-            for rec in recs:
-                if rec is not None:
-                    outf.write(rec)
-    make_big_bed(out_bed_path, args.sizes, out_big_bed_path)
+    write_track(recs, out_bed_path, out_big_bed_path, args, target.getLocalTempDir())
 
 
 def get_all_tm_pass(cur, ref_genome, genome):
     """
-    transMap pass varies depending on if the transcript is coding or noncoding. We will build a set of IDs for both.
+    transMap pass varies depending on if the transcript is coding or noncoding. The evaluation table has already
+    applied the criteria of each biotype.
     """
-    biotypes = sql_lib.get_all_biotypes(cur, genome, gene_level=False)
-    all_ids = set()
-    for biotype in biotypes:
-        query = etc.config.transMapEval(ref_genome, genome, biotype=biotype, passing=False)
-        query_ids = sql_lib.get_query_ids(cur, query)
-        all_ids |= query_ids
-    return all_ids
+    tm_evals = sql_lib.get_transmap_eval(cur, ref_genome, genome)
+    return {aln_id for aln_id, tm_eval in tm_evals.iteritems() if tm_eval == "Excellent"}
+
+
+def pass_track_recs(gp_dict, id_index, pass_ids, biotype_map, colors):
+    """
+    Yields a BED line for every transcript, colored by whether it passes and if so by its biotype.
+    """
+    for aln_id, rec in gp_dict.iteritems():
+        tx_id = id_index.transcript_id(aln_id)
+        if aln_id in pass_ids:
+            if biotype_map[tx_id] == "protein_coding":
+                bed = rec.get_bed(rgb=colors["coding"])
+            else:
+                bed = rec.get_bed(rgb=colors["noncoding"])
+        else:
+            bed = rec.get_bed(rgb=colors["not_pass"])
+        yield "".join(["\t".join(map(str, bed)), "\n"])
 
 
 def build_pass_track(target, args):
@@ -151,28 +180,19 @@ def build_pass_track(target, args):
         pass_ids = sql_lib.get_query_ids(cur, query)
         out_pass_bed_path, out_pass_big_bed_path = get_bed_paths(args.outDir, "augustus", args.genome)
         gp_dict = seq_lib.get_transcript_dict(args.augustusGp)
+        id_index = psl_lib.build_alignment_id_index(gp_dict)
     elif args.mode == "reference":  # for reference, we are more interested in what is NOT Good
         query = etc.config.refEval(args.refGenome)
         pass_ids = biotype_map.viewkeys() - sql_lib.get_query_ids(cur, query)  # actually not pass
         out_pass_bed_path, out_pass_big_bed_path = get_bed_paths(args.outDir, "reference", args.refGenome)
         gp_dict = seq_lib.get_transcript_dict(args.annotationGp)
+        id_index = psl_lib.build_alignment_id_index(gp_dict)
     elif args.mode == "transMap":
         pass_ids = get_all_tm_pass(cur, args.refGenome, args.genome)
         out_pass_bed_path, out_pass_big_bed_path = get_bed_paths(args.outDir, "transMap", args.genome)
         gp_dict = seq_lib.get_transcript_dict(args.targetGp)
+        id_index = sql_lib.get_alignment_id_index(cur, args.genome)
     else:
         raise RuntimeError("Somehow your argparse object does not contain a valid mode.")
-    with open(out_pass_bed_path, "w") as outf:
-        for aln_id, rec in gp_dict.iteritems():
-            tx_id = psl_lib.strip_alignment_numbers(aln_id)
-            if aln_id in pass_ids:
-                if biotype_map[tx_id] == "protein_coding":
-                    bed = rec.get_bed(rgb=colors["coding"])
-                    outf.write("".join(["\t".join(map(str, bed)), "\n"]))
-                else:
-                    bed = rec.get_bed(rgb=colors["noncoding"])
-                    outf.write("".join(["\t".join(map(str, bed)), "\n"]))
-            else:
-                bed = rec.get_bed(rgb=colors["not_pass"])
-                outf.write("".join(["\t".join(map(str, bed)), "\n"]))
-    make_big_bed(out_pass_bed_path, args.sizes, out_pass_big_bed_path)
\ No newline at end of file
+    recs = pass_track_recs(gp_dict, id_index, pass_ids, biotype_map, colors)
+    write_track(recs, out_pass_bed_path, out_pass_big_bed_path, args, target.getLocalTempDir())
\ No newline at end of file
@@ -1,4 +1,5 @@
 import re
+from itertools import izip
 
 import lib.seq_lib as seq_lib
 import lib.comp_ann_lib as comp_ann_lib
@@ -17,20 +18,18 @@ class StartOutOfFrame(AbstractClassifier):
     def rgb(self):
         return self.colors["alignment"]
 
-    def run(self):
-        for ens_id, a in self.annotation_iterator():
-            # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
-            if comp_ann_lib.short_cds(a):
-                self.classify_dict[ens_id] = 0
-                continue
-            # remove all -1 frames because those are UTR exons
-            a_frames = [x for x in a.exon_frames if x != -1]
-            if a.strand is True and a_frames[0] != 0 or a.strand is False and a_frames[-1] != 0:
-                self.classify_dict[ens_id] = 1
-                self.details_dict[ens_id].append(seq_lib.cds_coordinate_to_bed(a, 0, 3, self.rgb, self.column))
-            else:
-                self.classify_dict[ens_id] = 0
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a):
+        # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
+        if comp_ann_lib.short_cds(a):
+            self.classify_dict[ens_id] = 0
+            return
+        # remove all -1 frames because those are UTR exons
+        a_frames = [x for x in a.exon_frames if x != -1]
+        if a.strand is True and a_frames[0] != 0 or a.strand is False and a_frames[-1] != 0:
+            self.classify_dict[ens_id] = 1
+            self.details_dict[ens_id].append(seq_lib.cds_coordinate_to_bed(a, 0, 3, self.rgb, self.column))
+        else:
+            self.classify_dict[ens_id] = 0
 
 
 class BadFrame(AbstractClassifier):
@@ -43,19 +42,17 @@ class BadFrame(AbstractClassifier):
     def rgb(self):
         return self.colors["generic"]
 
-    def run(self):
-        for ens_id, a in self.annotation_iterator():
-            # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
-            if comp_ann_lib.short_cds(a):
-                self.classify_dict[ens_id] = 0
-                continue
-            if a.cds_size % 3 != 0:
-                bed_rec = seq_lib.chromosome_coordinate_to_bed(a, a.thick_start, a.thick_stop, self.rgb, self.column)
-                self.details_dict[ens_id].append(bed_rec)
-                self.classify_dict[ens_id] = 1
-            else:
-                self.classify_dict[ens_id] = 0
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a):
+        # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
+        if comp_ann_lib.short_cds(a):
+            self.classify_dict[ens_id] = 0
+            return
+        if a.cds_size % 3 != 0:
+            bed_rec = seq_lib.chromosome_coordinate_to_bed(a, a.thick_start, a.thick_stop, self.rgb, self.column)
+            self.details_dict[ens_id].append(bed_rec)
+            self.classify_dict[ens_id] = 1
+        else:
+            self.classify_dict[ens_id] = 0
 
 
 class BeginStart(AbstractClassifier):
@@ -64,23 +61,22 @@ class BeginStart(AbstractClassifier):
 
     Returns a BED record of the first 3 bases if this is NOT true
     """
+    uses_sequence = True
+
     @property
     def rgb(self):
         return self.colors["generic"]
 
-    def run(self):
-        self.get_fasta()
-        for ens_id, a in self.annotation_iterator():
-            # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
-            if comp_ann_lib.short_cds(a):
-                self.classify_dict[ens_id] = 0
-            elif a.get_cds(self.ref_seq_dict)[:3] != "ATG":
-                bed_rec = seq_lib.cds_coordinate_to_bed(a, 0, 3, self.rgb, self.column)
-                self.details_dict[ens_id].append(bed_rec)
-                self.classify_dict[ens_id] = 1
-            else:
-                self.classify_dict[ens_id] = 0
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a):
+        # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
+        if comp_ann_lib.short_cds(a):
+            self.classify_dict[ens_id] = 0
+        elif a.get_cds(self.ref_seq_dict)[:3] != "ATG":
+            bed_rec = seq_lib.cds_coordinate_to_bed(a, 0, 3, self.rgb, self.column)
+            self.details_dict[ens_id].append(bed_rec)
+            self.classify_dict[ens_id] = 1
+        else:
+            self.classify_dict[ens_id] = 0
 
 
 class EndStop(AbstractClassifier):
@@ -88,24 +84,22 @@ class EndStop(AbstractClassifier):
     Are the last three bases a stop codon?
     If this is NOT true, will report a BED record of the last 3 bases.
     """
+    uses_sequence = True
+
     @property
     def rgb(self):
         return self.colors["alignment"]
 
-    def run(self):
-        self.get_fasta()
-        stop_codons = {'TAA', 'TGA', 'TAG'}
-        for ens_id, a in self.annotation_iterator():
-            # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
-            if comp_ann_lib.short_cds(a):
-                self.classify_dict[ens_id] = 0
-            elif a.get_cds(self.ref_seq_dict)[-3:] not in stop_codons:
-                bed_rec = seq_lib.cds_coordinate_to_bed(a, a.cds_size - 3, a.cds_size, self.rgb, self.column)
-                self.details_dict[ens_id].append(bed_rec)
-                self.classify_dict[ens_id] = 1
-            else:
-                self.classify_dict[ens_id] = 0
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a, stop_codons=frozenset(['TAA', 'TGA', 'TAG'])):
+        # do not include noncoding transcripts or lift-overs that contain less than short_cds_size
+        if comp_ann_lib.short_cds(a):
+            self.classify_dict[ens_id] = 0
+        elif a.get_cds(self.ref_seq_dict)[-3:] not in stop_codons:
+            bed_rec = seq_lib.cds_coordinate_to_bed(a, a.cds_size - 3, a.cds_size, self.rgb, self.column)
+            self.details_dict[ens_id].append(bed_rec)
+            self.classify_dict[ens_id] = 1
+        else:
+            self.classify_dict[ens_id] = 0
 
 
 class CdsGap(AbstractClassifier):
@@ -114,20 +108,19 @@ class CdsGap(AbstractClassifier):
 
     Reports a BED record for each intron interval that is too short.
     """
+    uses_sequence = True
+
     @property
     def rgb(self):
         return self.colors["alignment"]
 
-    def run(self, cds_filter_fn=comp_ann_lib.is_cds, mult3=False, skip_n=True):
-        self.get_fasta()
-        for ens_id, a in self.annotation_iterator():
-            for intron in a.intron_intervals:
-                is_gap = comp_ann_lib.analyze_intron_gap(a, intron, self.ref_seq_dict, cds_filter_fn, skip_n, mult3)
-                if is_gap is True:
-                    bed_rec = seq_lib.interval_to_bed(a, intron, self.rgb, self.column)
-                    self.details_dict[ens_id].append(bed_rec)
-            self.classify_dict[ens_id] = len(self.details_dict[ens_id])
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a, cds_filter_fn=comp_ann_lib.is_cds, mult3=False, skip_n=True):
+        for intron in a.intron_intervals:
+            is_gap = comp_ann_lib.analyze_intron_gap(a, intron, self.ref_seq_dict, cds_filter_fn, skip_n, mult3)
+            if is_gap is True:
+                bed_rec = seq_lib.interval_to_bed(a, intron, self.rgb, self.column)
+                self.details_dict[ens_id].append(bed_rec)
+        self.classify_dict[ens_id] = len(self.details_dict[ens_id])
 
 
 class CdsMult3Gap(CdsGap):
@@ -138,8 +131,8 @@ class CdsMult3Gap(CdsGap):
     def rgb(self):
         return self.colors["mutation"]
 
-    def run(self, cds_filter_fn=comp_ann_lib.is_cds, mult3=True, skip_n=True):
-        CdsGap.run(self, cds_filter_fn, mult3, skip_n)
+    def classify(self, ens_id, a, cds_filter_fn=comp_ann_lib.is_cds, mult3=True, skip_n=True):
+        CdsGap.classify(self, ens_id, a, cds_filter_fn, mult3, skip_n)
 
 
 class UtrGap(CdsGap):
@@ -152,8 +145,8 @@ class UtrGap(CdsGap):
     def rgb(self):
         return self.colors["alignment"]
 
-    def run(self, cds_filter_fn=comp_ann_lib.is_not_cds, mult3=None, skip_n=True):
-        CdsGap.run(self, cds_filter_fn, mult3, skip_n)
+    def classify(self, ens_id, a, cds_filter_fn=comp_ann_lib.is_not_cds, mult3=None, skip_n=True):
+        CdsGap.classify(self, ens_id, a, cds_filter_fn, mult3, skip_n)
 
 
 class UnknownGap(CdsGap):
@@ -164,8 +157,8 @@ class UnknownGap(CdsGap):
     def rgb(self):
         return self.colors["assembly"]
 
-    def run(self, cds_filter_fn=lambda intron, t: True, mult3=None, skip_n=False):
-        CdsGap.run(self, cds_filter_fn, mult3, skip_n)
+    def classify(self, ens_id, a, cds_filter_fn=lambda intron, t: True, mult3=None, skip_n=False):
+        CdsGap.classify(self, ens_id, a, cds_filter_fn, mult3, skip_n)
 
 
 class CdsNonCanonSplice(AbstractClassifier):
@@ -178,20 +171,20 @@ class CdsNonCanonSplice(AbstractClassifier):
     This classifier is only applied to introns which are longer than
     a minimum intron size.
     """
+    uses_sequence = True
+
     @property
     def rgb(self):
         return self.colors["mutation"]
 
-    def run(self, cds_filter_fn=comp_ann_lib.is_cds, splice_dict={"GT": "AG"}):
-        self.get_fasta()
-        for ens_id, a in self.annotation_iterator():
-            for intron in a.intron_intervals:
-                splice_is_good = comp_ann_lib.analyze_splice(intron, a, self.ref_seq_dict, cds_filter_fn, splice_dict)
-                if splice_is_good is True:
-                    bed_rec = seq_lib.splice_intron_interval_to_bed(a, intron, self.rgb, self.column)
-                    self.details_dict[ens_id].append(bed_rec)
-            self.classify_dict[ens_id] = len(self.details_dict[ens_id])
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a, cds_filter_fn=comp_ann_lib.is_cds, splice_dict={"GT": "AG"}):
+        for intron, donor_acceptor in izip(a.intron_intervals, a.get_splice_sites(self.ref_seq_dict)):
+            splice_is_good = comp_ann_lib.analyze_splice(intron, a, self.ref_seq_dict, cds_filter_fn, splice_dict,
+                                                         donor_acceptor)
+            if splice_is_good is True:
+                bed_rec = seq_lib.splice_intron_interval_to_bed(a, intron, self.rgb, self.column)
+                self.details_dict[ens_id].append(bed_rec)
+        self.classify_dict[ens_id] = len(self.details_dict[ens_id])
 
 
 class CdsUnknownSplice(CdsNonCanonSplice):
@@ -202,8 +195,8 @@ class CdsUnknownSplice(CdsNonCanonSplice):
     This classifier is only applied to introns which are longer than
     a minimum intron size.
     """
-    def run(self, cds_filter_fn=comp_ann_lib.is_cds, splice_dict={"GT": "AG", "GC": "AG", "AT": "AC"}):
-        CdsNonCanonSplice.run(self, cds_filter_fn, splice_dict)
+    def classify(self, ens_id, a, cds_filter_fn=comp_ann_lib.is_cds, splice_dict={"GT": "AG", "GC": "AG", "AT": "AC"}):
+        CdsNonCanonSplice.classify(self, ens_id, a, cds_filter_fn, splice_dict)
 
 
 class UtrNonCanonSplice(CdsNonCanonSplice):
@@ -214,8 +207,8 @@ class UtrNonCanonSplice(CdsNonCanonSplice):
     This classifier is only applied to introns which are longer than
     a minimum intron size.
     """
-    def run(self, cds_filter_fn=comp_ann_lib.is_not_cds, splice_dict={"GT": "AG"}):
-        CdsNonCanonSplice.run(self, cds_filter_fn, splice_dict)
+    def classify(self, ens_id, a, cds_filter_fn=comp_ann_lib.is_not_cds, splice_dict={"GT": "AG"}):
+        CdsNonCanonSplice.classify(self, ens_id, a, cds_filter_fn, splice_dict)
 
 
 class UtrUnknownSplice(CdsNonCanonSplice):
@@ -226,30 +219,31 @@ class UtrUnknownSplice(CdsNonCanonSplice):
     This classifier is only applied to introns which are longer than
     a minimum intron size.
     """
-    def run(self, cds_filter_fn=comp_ann_lib.is_not_cds, splice_dict={"GT": "AG", "GC": "AG", "AT": "AC"}):
-        CdsNonCanonSplice.run(self, cds_filter_fn, splice_dict)
+    def classify(self, ens_id, a, cds_filter_fn=comp_ann_lib.is_not_cds,
+                 splice_dict={"GT": "AG", "GC": "AG", "AT": "AC"}):
+        CdsNonCanonSplice.classify(self, ens_id, a, cds_filter_fn, splice_dict)
 
 
 class SpliceContainsUnknownBases(AbstractClassifier):
     """
     Do any of the splice junctions contain unknown bases?
     """
+    uses_sequence = True
+
     @property
     def rgb(self):
         return self.colors["assembly"]
 
-    def run(self):
-        self.get_fasta()
-        for ens_id, a in self.annotation_iterator():
-            for intron in a.intron_intervals:
-                if comp_ann_lib.short_intron(intron) is False:
-                    seq = intron.get_sequence(self.ref_seq_dict, strand=True)
-                    donor, acceptor = seq[:2], seq[-2:]
-                    if "N" in donor or "N" in acceptor:
-                        bed_rec = seq_lib.splice_intron_interval_to_bed(a, intron, self.rgb, self.column)
-                        self.details_dict[ens_id].append(bed_rec)
-            self.classify_dict[ens_id] = len(self.details_dict[ens_id])
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a):
+        n_gaps = seq_lib.get_n_gap_index(self.ref_seq_dict)
+        for intron in a.intron_intervals:
+            if comp_ann_lib.short_intron(intron) is False:
+                # the donor and acceptor are the first and last two bases of the intron on either strand
+                if (n_gaps.contains_n(intron.chromosome, intron.start, intron.start + 2) or
+                        n_gaps.contains_n(intron.chromosome, intron.stop - 2, intron.stop)):
+                    bed_rec = seq_lib.splice_intron_interval_to_bed(a, intron, self.rgb, self.column)
+                    self.details_dict[ens_id].append(bed_rec)
+        self.classify_dict[ens_id] = len(self.details_dict[ens_id])
 
 
 class InFrameStop(AbstractClassifier):
@@ -260,22 +254,19 @@ class InFrameStop(AbstractClassifier):
 
     Returns a BED record of the position of the in frame stop if it exists.
     """
+    uses_sequence = True
+
     @property
     def rgb(self):
         return self.colors["mutation"]
 
-    def run(self):
-        self.get_fasta()
-        for ens_id, a in self.annotation_iterator():
-            cds = a.get_cds(self.ref_seq_dict)
-            offset = seq_lib.find_offset(a.exon_frames, a.strand)
-            for i, codon in seq_lib.read_codons_with_position(cds, offset, skip_last=True):
-                amino_acid = seq_lib.codon_to_amino_acid(codon)
-                if amino_acid == "*":
-                    bed_rec = seq_lib.cds_coordinate_to_bed(a, i, i + 3, self.rgb, self.column)
-                    self.details_dict[ens_id].append(bed_rec)
-            self.classify_dict[ens_id] = len(self.details_dict[ens_id])
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a):
+        cds = a.get_cds(self.ref_seq_dict)
+        offset = seq_lib.find_offset(a.exon_frames, a.strand)
+        for i in seq_lib.find_in_frame_stops(cds, offset, skip_last=True):
+            bed_rec = seq_lib.cds_coordinate_to_bed(a, i, i + 3, self.rgb, self.column)
+            self.details_dict[ens_id].append(bed_rec)
+        self.classify_dict[ens_id] = len(self.details_dict[ens_id])
 
 
 class ShortCds(AbstractClassifier):
@@ -286,15 +277,13 @@ class ShortCds(AbstractClassifier):
     def rgb(self):
         return self.colors["alignment"]
 
-    def run(self):
-        for ens_id, a in self.annotation_iterator():
-            if comp_ann_lib.short_cds(a) is True and a.cds_size != 0:
-                bed_rec = seq_lib.cds_coordinate_to_bed(a, 0, a.cds_size, self.rgb, self.column)
-                self.details_dict[ens_id].append(bed_rec)
-                self.classify_dict[ens_id] = 1
-            else:
-                self.classify_dict[ens_id] = 0
-        self.dump_results_to_disk()
+    def classify(self, ens_id, a):
+        if comp_ann_lib.short_cds(a) is True and a.cds_size != 0:
+            bed_rec = seq_lib.cds_coordinate_to_bed(a, 0, a.cds_size, self.rgb, self.column)
+            self.details_dict[ens_id].append(bed_rec)
+            self.classify_dict[ens_id] = 1
+        else:
+            self.classify_dict[ens_id] = 0
 
 
 class UnknownBases(AbstractClassifier):
@@ -303,6 +292,8 @@ class UnknownBases(AbstractClassifier):
 
     Only looks at mRNA bases, and restricts to CDS if cds is True
     """
+    uses_sequence = True
+
     @property
     def rgb(self):
         return self.colors["assembly"]
@@ -311,23 +302,21 @@ class UnknownBases(AbstractClassifier):
         for m in re.finditer(r, s):
             yield bed_rec_fn(a, m.start() + 1, m.end() - 1, self.rgb, self.column)
 
-    def run(self, cds=False):
-        self.get_fasta()
-        if cds is True:
-            bed_rec_fn = seq_lib.cds_coordinate_to_bed
-        else:
-            bed_rec_fn = seq_lib.transcript_coordinate_to_bed
-        for ens_id, a in self.annotation_iterator():
+    def classify(self, ens_id, a, cds=False):
+        n_gaps = seq_lib.get_n_gap_index(self.ref_seq_dict)
+        # only fetch the sequence if an exon overlaps a run of N
+        if any(n_gaps.contains_n(a.chromosome, x.start, x.stop) for x in a.exon_intervals):
             if cds is True:
                 s = a.get_cds(self.ref_seq_dict)
+                bed_rec_fn = seq_lib.cds_coordinate_to_bed
             else:
                 s = a.get_mrna(self.ref_seq_dict)
+                bed_rec_fn = seq_lib.transcript_coordinate_to_bed
             for bed_rec in self.make_bed_recs(a, s, bed_rec_fn):
                 self.details_dict[ens_id].append(bed_rec)
-            self.classify_dict[ens_id] = len(self.details_dict[ens_id])
-        self.dump_results_to_disk()
+        self.classify_dict[ens_id] = len(self.details_dict[ens_id])
 
 
 class UnknownCdsBases(UnknownBases):
-    def run(self, cds=True):
-        UnknownBases.run(self, cds)
+    def classify(self, ens_id, a, cds=True):
+        UnknownBases.classify(self, ens_id, a, cds)
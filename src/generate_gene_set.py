@@ -55,7 +55,7 @@ def get_stats(cur, genome, mode):
         return tm_stats
 
 
-def build_data_dict(id_names, id_list, transcript_gene_map, gene_transcript_map):
+def build_data_dict(id_names, id_list, transcript_gene_map, gene_transcript_map, id_index):
     """
     Builds a dictionary mapping gene_id -> transcript_ids -> aln_ids in id_names bins (as an OrderedDict)
     """
@@ -65,7 +65,7 @@ def build_data_dict(id_names, id_list, transcript_gene_map, gene_transcript_map)
             data_dict[gene_id][ens_id] = OrderedDict((x, []) for x in id_names)
     for ids, n in zip(*[id_list, id_names]):
         for aln_id in ids:
-            ens_id = psl_lib.strip_alignment_numbers(aln_id)
+            ens_id = id_index.transcript_id(aln_id)
             if ens_id not in transcript_gene_map:
                 # Augustus was fed chrY transcripts
                 continue
@@ -216,7 +216,7 @@ def find_consensus(binned_transcripts, stats, gps, ref_intervals, tgt_intervals,
 
 
 def consensus_by_biotype(cur, ref_genome, genome, biotype, gps, transcript_gene_map, gene_transcript_map, stats, mode,
-                         ref_intervals, tgt_intervals):
+                         ref_intervals, tgt_intervals, id_index):
     """
     Main consensus finding function.
     """
@@ -231,7 +231,7 @@ def consensus_by_biotype(cur, ref_genome, genome, biotype, gps, transcript_gene_
     else:
         id_names = ["fail_ids", "pass_specific_ids", "excel_ids"]
         id_list = [fail_ids, pass_specific_ids, excel_ids]
-    data_dict = build_data_dict(id_names, id_list, transcript_gene_map, gene_transcript_map)
+    data_dict = build_data_dict(id_names, id_list, transcript_gene_map, gene_transcript_map, id_index)
     binned_transcripts = find_best_transcripts(data_dict, stats, mode, biotype)
     consensus = find_consensus(binned_transcripts, stats, gps, ref_intervals, tgt_intervals, mode)
     return binned_transcripts, consensus
@@ -361,7 +361,7 @@ def deduplicate_consensus(consensus, gps, stats):
     return deduplicated_consensus, dup_count
 
 
-def fix_gene_pred(gp, transcript_gene_map):
+def fix_gene_pred(gp, transcript_gene_map, id_index):
     """
     These genePreds have a few problems. First, the alignment numbers must be removed. Second, we want to fix
     the name2 field to be the gene name. Third, we want to set the unique ID field. Finally, we want to sort the whole
@@ -374,7 +374,7 @@ def fix_gene_pred(gp, transcript_gene_map):
     fixed = []
     for x in gp:
         x[10] = x[0]  # use unique Aug/TM ID as unique identifier
-        tx_id = psl_lib.strip_alignment_numbers(x[0])
+        tx_id = id_index.transcript_id(x[0])
         x[0] = tx_id
         gene_id = transcript_gene_map[tx_id]
         x[11] = gene_id
@@ -384,7 +384,7 @@ def fix_gene_pred(gp, transcript_gene_map):
     return len(genes), len(txs), ["\t".join(x) for x in fixed]
 
 
-def write_gps(consensus, gps, consensus_base_path, biotype, transcript_gene_map, mode):
+def write_gps(consensus, gps, consensus_base_path, biotype, transcript_gene_map, mode, id_index):
     """
     Writes the final consensus gene set to a genePred, after fixing the names. Reports the number of genes and txs
     in the final set
@@ -395,7 +395,7 @@ def write_gps(consensus, gps, consensus_base_path, biotype, transcript_gene_map,
         p = os.path.join(consensus_base_path, biotype + ".augustus_consensus_gene_set.gp")
     mkdir_p(os.path.dirname(p))
     gp_recs = [gps[aln_id] for aln_id in consensus]
-    num_genes, num_txs, fixed_gp_recs = fix_gene_pred(gp_recs, transcript_gene_map)
+    num_genes, num_txs, fixed_gp_recs = fix_gene_pred(gp_recs, transcript_gene_map, id_index)
     with open(p, "w") as outf:
         for rec in fixed_gp_recs:
             outf.write(rec)
@@ -437,6 +437,7 @@ def main():
     transcript_gene_map = sql_lib.get_transcript_gene_map(cur, args.refGenome, biotype=None,
                                                           filter_chroms=args.filterChroms)
     gps = load_gps(args.gps)  # load all Augustus and transMap transcripts into one big dict
+    id_index = psl_lib.build_alignment_id_index(gps)  # strip every alignment ID once for all biotypes
     consensus_base_path = os.path.join(args.outDir, args.genome)
     stats = get_stats(cur, args.genome, args.mode)
     ref_gene_intervals = build_ref_intervals(cur, args.genome)
@@ -446,11 +447,11 @@ def main():
                                                               filter_chroms=args.filterChroms)
         binned_transcripts, consensus = consensus_by_biotype(cur, args.refGenome, args.genome, biotype, gps,
                                                              transcript_gene_map, gene_transcript_map, stats, args.mode,
-                                                             ref_gene_intervals, tgt_intervals)
+                                                             ref_gene_intervals, tgt_intervals, id_index)
         deduplicated_consensus, dup_count = deduplicate_consensus(consensus, gps, stats)
         if len(deduplicated_consensus) > 0:  # some biotypes we may have nothing
             num_genes, num_txs = write_gps(deduplicated_consensus, gps, consensus_base_path, biotype,
-                                           transcript_gene_map, args.mode)
+                                           transcript_gene_map, args.mode, id_index)
             if biotype == "protein_coding":
                 gene_transcript_evals = evaluate_coding_consensus(binned_transcripts, stats, ref_gene_intervals, gps, args.mode)
             else:
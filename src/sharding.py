@@ -0,0 +1,97 @@
+"""
+Splits the transMap inputs of a genome into shards so that the alignment classifiers can be run on many cores, and
+merges the per-shard results back together before the databases are built.
+"""
+import os
+from collections import defaultdict
+
+import lib.spill_lib as spill_lib
+from lib.general_lib import mkdir_p, tokenize_stream
+
+__author__ = "Ian Fiddes"
+
+
+def gene_pred_positions(gp):
+    """
+    Streams the alignment ID, target chromosome and start position of every transcript in a genePred.
+    """
+    for tokens in tokenize_stream(open(gp)):
+        yield tokens[0], tokens[1], int(tokens[3])
+
+
+def bin_by_chromosome(positions, num_shards):
+    """
+    Greedily packs whole target chromosomes into num_shards bins balanced by the number of transcripts.
+    Returns a dict mapping each alignment ID to a shard number.
+    """
+    chrom_ids = defaultdict(list)
+    for aln_id, chrom, start in positions:
+        chrom_ids[chrom].append(aln_id)
+    bins = [[0, i] for i in xrange(num_shards)]
+    shard_map = {}
+    for chrom, aln_ids in sorted(chrom_ids.iteritems(), key=lambda x: -len(x[1])):
+        smallest = min(bins)
+        smallest[0] += len(aln_ids)
+        for aln_id in aln_ids:
+            shard_map[aln_id] = smallest[1]
+    return shard_map
+
+
+def bin_by_count(positions, num_shards):
+    """
+    Splits the transcripts, sorted by genomic position, into num_shards contiguous buckets whose sizes differ by at
+    most one.
+    Returns a dict mapping each alignment ID to a shard number.
+    """
+    ordered = sorted(positions, key=lambda x: (x[1], x[2]))
+    return {aln_id: i * num_shards // len(ordered) for i, (aln_id, chrom, start) in enumerate(ordered)}
+
+
+def shard_inputs(psl, gp, shard_root, num_shards, shard_by="chromosome"):
+    """
+    Partitions a transMap PSL and target genePred into at most num_shards pairs of files under shard_root.
+    Only the position of each transcript is held in memory; the records themselves are streamed into the shards.
+    Returns a list of [psl_path, gp_path, results_dir] for each non-empty shard.
+    """
+    assert shard_by in ["chromosome", "count"]
+    if shard_by == "chromosome":
+        shard_map = bin_by_chromosome(gene_pred_positions(gp), num_shards)
+    else:
+        shard_map = bin_by_count(gene_pred_positions(gp), num_shards)
+    shard_dirs = [os.path.join(shard_root, str(i)) for i in sorted(set(shard_map.itervalues()))]
+    handles = {}
+    for shard_dir in shard_dirs:
+        mkdir_p(os.path.join(shard_dir, "results"))
+        i = int(os.path.basename(shard_dir))
+        handles[i] = [open(os.path.join(shard_dir, "aln.psl"), "w"), open(os.path.join(shard_dir, "tgt.gp"), "w")]
+    for tokens in tokenize_stream(open(gp)):
+        handles[shard_map[tokens[0]]][1].write("\t".join(tokens) + "\n")
+    for tokens in tokenize_stream(open(psl)):
+        assert tokens[9] in shard_map, "alignment {} is missing from the target genePred".format(tokens[9])
+        handles[shard_map[tokens[9]]][0].write("\t".join(tokens) + "\n")
+    for psl_h, gp_h in handles.itervalues():
+        psl_h.close()
+        gp_h.close()
+    return [[os.path.join(x, "aln.psl"), os.path.join(x, "tgt.gp"), os.path.join(x, "results")] for x in shard_dirs]
+
+
+def classifier_shards(classifier, shards, psl, gp, tmp_dir):
+    """
+    Returns the shards a classifier is run on. Classifiers that look across all alignments for a transcript are not
+    shardable and are run once on the whole genome instead.
+    """
+    return shards if classifier.shardable is True else [[psl, gp, tmp_dir]]
+
+
+def merge_shards(shard_root, tmp_dir):
+    """
+    Merges the results dumped by each shard into tmp_dir, one column at a time.
+    """
+    results_dirs = [os.path.join(shard_root, x, "results") for x in os.listdir(shard_root)]
+    columns = {(db, col) for results_dir in results_dirs for db in os.listdir(results_dir)
+               for col in os.listdir(os.path.join(results_dir, db))}
+    for db, col in columns:
+        paths = [os.path.join(results_dir, db, col) for results_dir in results_dirs]
+        base_p = os.path.join(tmp_dir, db)
+        mkdir_p(base_p)
+        spill_lib.merge_column_files([p for p in paths if os.path.exists(p)], os.path.join(base_p, col))
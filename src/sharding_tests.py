@@ -0,0 +1,213 @@
+"""
+Tests that running the transMap classifiers on shards and merging the results gives the same columns as one
+unsharded run. Run from the root of the repository with python -m src.sharding_tests
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import lib.spill_lib as spill_lib
+from lib.general_lib import classes_in_module
+import src.sharding as sharding
+import src.classifiers
+import src.alignment_classifiers
+import src.attributes
+from src.alignment_classifiers import Paralogy
+
+__author__ = "Ian Fiddes"
+
+
+def write_fasta(path, chroms):
+    with open(path, "w") as outf:
+        for name, seq in chroms:
+            outf.write(">" + name + "\n")
+            for i in xrange(0, len(seq), 60):
+                outf.write(seq[i:i + 60] + "\n")
+
+
+def gene_pred_line(name, chrom, strand, exons, thick_start, thick_stop):
+    """
+    Builds a genePred line for a transcript whose CDS covers thick_start to thick_stop, with matching exon frames.
+    """
+    frames = [-1] * len(exons)
+    cds_pos = 0
+    for i in xrange(len(exons)) if strand == "+" else reversed(xrange(len(exons))):
+        start, stop = max(exons[i][0], thick_start), min(exons[i][1], thick_stop)
+        if start < stop:
+            frames[i] = cds_pos % 3
+            cds_pos += stop - start
+    return "\t".join(map(str, [name, chrom, strand, exons[0][0], exons[-1][1], thick_start, thick_stop, len(exons),
+                               ",".join(str(x[0]) for x in exons) + ",", ",".join(str(x[1]) for x in exons) + ",",
+                               0, "gene", "cmpl", "cmpl", ",".join(map(str, frames)) + ","]))
+
+
+def psl_line(name, q_size, chrom, t_size, strand, blocks):
+    """
+    Builds a PSL line from a list of (query start, target start, size) blocks.
+    """
+    q_start, q_end = blocks[0][0], blocks[-1][0] + blocks[-1][2]
+    return "\t".join(map(str, [sum(x[2] for x in blocks), 0, 0, 0, 0, 0, 0, 0, strand, name, q_size, q_start, q_end,
+                               chrom, t_size, blocks[0][1], blocks[-1][1] + blocks[-1][2], len(blocks),
+                               ",".join(str(x[2]) for x in blocks) + ",", ",".join(str(x[0]) for x in blocks) + ",",
+                               ",".join(str(x[1]) for x in blocks) + ","]))
+
+
+def write_test_data(data_dir, seed=1):
+    """
+    Writes a small reference and target genome, an annotation set aligned to the reference and transMap alignments
+    to the target. Some transcripts map more than once, to other chromosomes, and some alignments have a deletion
+    inside an exon.
+    """
+    rand = random.Random(seed)
+    sequence = lambda size: "".join(rand.choice("ACGT") for _ in xrange(size))
+    ref_chroms = [("chr1", sequence(20000)), ("chr2", sequence(20000))]
+    tgt_chroms = [("scaf1", sequence(30000)), ("scaf2", sequence(30000)), ("scaf3", sequence(30000))]
+    write_fasta(os.path.join(data_dir, "ref.fa"), ref_chroms)
+    write_fasta(os.path.join(data_dir, "tgt.fa"), tgt_chroms)
+    ann_gp, ref_psl, tgt_gp, tgt_psl, attributes = [], [], [], [], []
+    for i in xrange(24):
+        name = "ENST{:07d}.1".format(i)
+        chrom, seq = ref_chroms[i % 2]
+        pos = 500 + 700 * (i // 2)
+        exons = []
+        for size in [rand.randint(30, 150) for _ in xrange(rand.randint(1, 4))]:
+            exons.append((pos, pos + size))
+            pos += size + rand.randint(60, 200)
+        strand = rand.choice("+-")
+        positions = [p for start, stop in exons for p in xrange(start, stop)]
+        thick_start, thick_stop = positions[rand.randint(0, 20)], positions[-rand.randint(1, 20)] + 1
+        ann_gp.append(gene_pred_line(name, chrom, strand, exons, thick_start, thick_stop))
+        sizes = [stop - start for start, stop in exons]
+        q_starts = [sum(sizes[:j]) for j in xrange(len(sizes))]
+        ref_psl.append(psl_line(name, sum(sizes), chrom, len(seq), strand, zip(q_starts, [x[0] for x in exons], sizes)))
+        attributes.append("\t".join(["ENSG{:07d}.1".format(i), "GENE{}".format(i), "protein_coding", name,
+                                     "protein_coding"]))
+        # the blocks of the query in mRNA order, which is the target order of a + strand alignment
+        sizes = sizes if strand == "+" else sizes[::-1]
+        for copy in xrange(1 if i % 3 else 2):
+            tgt_chrom, tgt_seq = tgt_chroms[(i + copy) % 3]
+            t = 500 + 900 * i
+            q = 0
+            blocks, tgt_exons = [], []
+            for j, size in enumerate(sizes):
+                exon_start = t
+                if j == 1 and size > 40 and i % 4 == 0:
+                    # split this exon with a deletion in the target
+                    blocks.append((q, t, 20))
+                    q, t = q + 22, t + 20
+                    size -= 22
+                blocks.append((q, t, size))
+                q += size
+                t += size
+                tgt_exons.append((exon_start, t))
+                t += rand.randint(60, 200)
+            aln_id = "{}-{}".format(name, copy + 1)
+            tgt_psl.append(psl_line(aln_id, q, tgt_chrom, len(tgt_seq), "+", blocks))
+            positions = [p for start, stop in tgt_exons for p in xrange(start, stop)]
+            tgt_gp.append(gene_pred_line(aln_id, tgt_chrom, "+", tgt_exons, positions[rand.randint(0, 20)],
+                                         positions[-rand.randint(1, 20)] + 1))
+    for file_name, lines in [["ann.gp", ann_gp], ["ref.psl", ref_psl], ["tgt.gp", tgt_gp], ["tgt.psl", tgt_psl],
+                             ["attributes.tsv", attributes]]:
+        with open(os.path.join(data_dir, file_name), "w") as outf:
+            outf.write("\n".join(lines) + "\n")
+
+
+def read_results(tmp_dir):
+    """
+    Reads every column dumped to tmp_dir into a dict of (database, column) -> dict of ID -> value.
+    """
+    r = {}
+    for db in ["classify", "details", "attributes"]:
+        for col in os.listdir(os.path.join(tmp_dir, db)):
+            r[(db, col)] = spill_lib.read_column_dict(os.path.join(tmp_dir, db, col))
+    return r
+
+
+class ShardingTests(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        write_test_data(self.data_dir)
+        self.psl = self.path("tgt.psl")
+        self.gp = self.path("tgt.gp")
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def run_classifiers(self, tmp_dir, shards):
+        """
+        Runs every transMap classifier, attribute and target genome classifier on the shards in the same way as
+        annotation_pipeline.run_tm_classifiers does.
+        """
+        for classifier in classes_in_module(src.alignment_classifiers):
+            for psl, gp, results_dir in sharding.classifier_shards(classifier, shards, self.psl, self.gp, tmp_dir):
+                classifier(self.path("ref.fa"), self.path("ann.gp"), "ref", results_dir, "tgt", psl,
+                           self.path("ref.psl"), self.path("tgt.fa"), gp).run()
+        for psl, gp, results_dir in shards:
+            for attribute in classes_in_module(src.attributes):
+                attribute(self.path("ref.fa"), self.path("ann.gp"), "ref", results_dir, "tgt", psl,
+                          self.path("ref.psl"), self.path("tgt.fa"), gp, self.path("attributes.tsv")).run()
+            for classifier in classes_in_module(src.classifiers):
+                classifier(self.path("tgt.fa"), gp, "tgt", results_dir).run()
+
+    def run_unsharded(self):
+        tmp_dir = self.path("unsharded")
+        self.run_classifiers(tmp_dir, [[self.psl, self.gp, tmp_dir]])
+        return read_results(tmp_dir)
+
+    def run_sharded(self, num_shards, shard_by):
+        tmp_dir = self.path("sharded_" + shard_by)
+        shard_root = os.path.join(tmp_dir, "shards")
+        shards = sharding.shard_inputs(self.psl, self.gp, shard_root, num_shards, shard_by)
+        self.run_classifiers(tmp_dir, shards)
+        sharding.merge_shards(shard_root, tmp_dir)
+        return shards, read_results(tmp_dir)
+
+    def assert_same_results(self, shard_by):
+        unsharded = self.run_unsharded()
+        shards, sharded = self.run_sharded(3, shard_by)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sorted(unsharded), sorted(sharded))
+        for key in unsharded:
+            self.assertEqual(unsharded[key], sharded[key], "{} differs".format(key))
+        self.assertTrue(any(x > 0 for x in unsharded[("classify", "CodingDeletions")].itervalues()))
+
+    def test_shard_by_chromosome(self):
+        self.assert_same_results("chromosome")
+
+    def test_shard_by_count(self):
+        self.assert_same_results("count")
+
+    def test_shards_partition_inputs(self):
+        shards = sharding.shard_inputs(self.psl, self.gp, self.path("shards"), 3, "count")
+        gp_ids = [[x.split("\t")[0] for x in open(gp)] for psl, gp, results_dir in shards]
+        psl_ids = [[x.split("\t")[9] for x in open(psl)] for psl, gp, results_dir in shards]
+        self.assertEqual([sorted(x) for x in gp_ids], [sorted(x) for x in psl_ids])
+        self.assertEqual(sorted(sum(gp_ids, [])), sorted(x.split("\t")[0] for x in open(self.gp)))
+        sizes = sorted(len(x) for x in gp_ids)
+        self.assertTrue(sizes[-1] - sizes[0] <= 1)
+
+    def test_paralogy_is_not_sharded(self):
+        """
+        Copies of a transcript land on different chromosomes, and so in different shards. Paralogy must still see
+        all of them.
+        """
+        self.assertFalse(Paralogy.shardable)
+        tmp_dir = self.path("paralogy")
+        shards = sharding.shard_inputs(self.psl, self.gp, os.path.join(tmp_dir, "shards"), 3, "chromosome")
+        self.assertEqual(sharding.classifier_shards(Paralogy, shards, self.psl, self.gp, tmp_dir),
+                         [[self.psl, self.gp, tmp_dir]])
+        Paralogy(self.path("ref.fa"), self.path("ann.gp"), "ref", tmp_dir, "tgt", self.psl, self.path("ref.psl"),
+                 self.path("tgt.fa"), self.gp).run()
+        counts = spill_lib.read_column_dict(os.path.join(tmp_dir, "classify", "Paralogy"))
+        self.assertEqual(counts["ENST0000000.1-1"], 1)
+        self.assertEqual(counts["ENST0000000.1-2"], 1)
+        self.assertEqual(counts["ENST0000001.1-1"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()